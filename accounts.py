@@ -0,0 +1,176 @@
+import json
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import tzlocal
+
+from data import (
+    Metrics,
+    date_filter,
+    get_data,
+    new_subscriber_mode,
+    report_message_id,
+    subscriber_segment,
+    unsubscribed_filter,
+)
+from instrumentation import registry, response_cache_lookups
+from response_cache import get_response_cache, metrics_key, open_ttl
+
+# Name recorded for the single KLAVIYO_API_KEY account
+default_account = os.environ.get("KLAVIYO_ACCOUNT_NAME", "default")
+
+# Accounts fetched at once, each in its own process
+max_account_processes = int(os.environ.get("KLAVIYO_ACCOUNT_PROCESSES", "4"))
+
+
+def load_accounts() -> list:
+    """Accounts to load, each with its API key, report message and segment
+
+    Read from the KLAVIYO_ACCOUNTS_FILE JSON file or the KLAVIYO_ACCOUNTS
+    JSON string; each entry gives its key directly as "api_key" or names an
+    environment variable holding it as "api_key_env", and the id of its own
+    reported message as "report_message_id". "subscriber_segment" defaults to
+    KLAVIYO_SUBSCRIBER_SEGMENT. Without an accounts list, the KLAVIYO_API_KEY
+    account is used with KLAVIYO_REPORT_MESSAGE_ID.
+    """
+    accounts_file = os.environ.get("KLAVIYO_ACCOUNTS_FILE")
+    if accounts_file:
+        with open(accounts_file) as f:
+            config = f.read()
+    else:
+        config = os.environ.get("KLAVIYO_ACCOUNTS", "")
+    if not config.strip():
+        return [
+            {
+                "name": default_account,
+                "api_key": os.environ.get("KLAVIYO_API_KEY", ""),
+                "report_message_id": report_message_id,
+                "subscriber_segment": subscriber_segment,
+            }
+        ]
+
+    accounts = []
+    for entry in json.loads(config):
+        api_key = entry.get("api_key") or os.environ.get(entry.get("api_key_env", ""))
+        if not entry.get("name") or not api_key:
+            raise ValueError(
+                f"Account needs a name and an API key: {entry.get('name')}"
+            )
+        # Message ids are per account; another account's id would match nothing
+        if not entry.get("report_message_id"):
+            raise ValueError(f"Account needs a report_message_id: {entry['name']}")
+        accounts.append(
+            {
+                "name": entry["name"],
+                "api_key": api_key,
+                "report_message_id": entry["report_message_id"],
+                "subscriber_segment": entry.get(
+                    "subscriber_segment", subscriber_segment
+                ),
+            }
+        )
+    names = [account["name"] for account in accounts]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Duplicate account names: {names}")
+    return accounts
+
+
+def fetch_account_metrics(account: dict) -> Metrics:
+    """get_data for one account, raising instead of returning a stack trace"""
+    metrics = get_data(
+        klaviyo_api_key=account["api_key"],
+        report_message_id=account["report_message_id"],
+        subscriber_segment=account["subscriber_segment"],
+    )
+    if not isinstance(metrics, Metrics):
+        raise RuntimeError(f"get_data failed for {account['name']}: {metrics}")
+    return metrics
+
+
+def fetch_account_metrics_in_worker(account: dict) -> tuple:
+    """fetch_account_metrics plus the instrumentation it recorded, for merging"""
+    before = registry.snapshot()
+    metrics = fetch_account_metrics(account)
+    return metrics, registry.delta(before)
+
+
+def metrics_cache_key(account: dict) -> str:
+    """Response cache key of an account's Metrics for the current local day"""
+    return metrics_key(
+        account["api_key"],
+        datetime.now(tzlocal.get_localzone()).date(),
+        {
+            "window": date_filter,
+            "report_message_id": account["report_message_id"],
+            "subscriber_segment": account["subscriber_segment"],
+            "new_subscriber_mode": new_subscriber_mode,
+            "unsubscribed_filter": unsubscribed_filter,
+        },
+    )
+
+
+def fetch_all_accounts(accounts: list, max_processes: int = max_account_processes):
+    """Fetch every account, reusing the Metrics a recent run computed for today
+
+    Returns ({name: Metrics}, {name: error message}). Each account's Metrics
+    are kept in the response cache for open_ttl seconds, looked up here
+    rather than in the account processes, so a re-run after a failed
+    BigQuery step makes no API calls.
+    """
+    cache = get_response_cache()
+    if cache is None:
+        return fetch_accounts(accounts, max_processes)
+
+    keys = {account["name"]: metrics_cache_key(account) for account in accounts}
+    cached = {}
+    for name, key in keys.items():
+        value = cache.get(key)
+        response_cache_lookups.inc(
+            kind="metrics", result="miss" if value is None else "hit"
+        )
+        if value is not None:
+            cached[name] = Metrics(**value)
+    pending = [account for account in accounts if account["name"] not in cached]
+    results, errors = fetch_accounts(pending, max_processes)
+    for name, metrics in results.items():
+        cache.put(keys[name], metrics._asdict(), ttl=open_ttl)
+    return {**cached, **results}, errors
+
+
+def fetch_accounts(accounts: list, max_processes: int = max_account_processes):
+    """Fetch every account in parallel processes, isolating failures
+
+    Returns ({name: Metrics}, {name: error message}). Each process builds its
+    own HTTP clients, so every account keeps its own rate limiter.
+    """
+    if not accounts:
+        return {}, {}
+    if len(accounts) == 1:
+        account = accounts[0]
+        try:
+            return {account["name"]: fetch_account_metrics(account)}, {}
+        except Exception as e:
+            return {}, {account["name"]: str(e)}
+
+    results = {}
+    errors = {}
+    # spawn rather than fork: the caller is a multi-threaded web worker
+    with ProcessPoolExecutor(
+        max_workers=min(max_processes, len(accounts)),
+        mp_context=multiprocessing.get_context("spawn"),
+    ) as executor:
+        futures = {
+            account["name"]: executor.submit(fetch_account_metrics_in_worker, account)
+            for account in accounts
+        }
+        for name, future in futures.items():
+            try:
+                results[name], recorded = future.result()
+                registry.merge(recorded)
+            except Exception as e:
+                logging.error(f"Fetching Klaviyo account {name} failed: {e}")
+                errors[name] = str(e)
+    return results, errors
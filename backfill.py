@@ -0,0 +1,282 @@
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+import tzlocal
+from dotenv import load_dotenv
+
+from accounts import default_account, load_accounts
+from data import (
+    Metrics,
+    RunContext,
+    get_data,
+    new_subscriber_mode,
+    start_of_day,
+    subscriber_history,
+    window_start,
+)
+from incremental import state_dir
+from warehouse import (
+    build_rows,
+    bulk_upsert_rows,
+    ensure_table,
+    get_client,
+    klaviyo_schema,
+)
+
+# Days computed before their rows are checkpointed together
+chunk_days = int(os.environ.get("KLAVIYO_BACKFILL_CHUNK_DAYS", "30"))
+
+# Days computed at once per account; their requests share the account's rate limiter
+day_workers = int(os.environ.get("KLAVIYO_BACKFILL_DAY_WORKERS", "4"))
+
+
+class BackfillCheckpoint:
+    """Rows of every (account, day) already computed, kept in SQLite
+
+    A re-run of the same range skips those days, so a crash only loses the
+    chunk in progress.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self.connect() as connection:
+            connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS days (
+                    account TEXT, day TEXT, rows TEXT,
+                    PRIMARY KEY (account, day)
+                )
+                """
+            )
+
+    def connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30)
+
+    def done(self, account: str, start: date, end: date) -> set:
+        """Days in [start, end] already computed for `account`"""
+        with self.connect() as connection:
+            days = connection.execute(
+                "SELECT day FROM days WHERE account = ? AND day >= ? AND day <= ?",
+                (account, start.isoformat(), end.isoformat()),
+            ).fetchall()
+        return {date.fromisoformat(day) for (day,) in days}
+
+    def save(self, account: str, rows_by_day: dict):
+        with self.lock, self.connect() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO days VALUES (?, ?, ?)",
+                [
+                    (account, day.isoformat(), json.dumps(rows, default=str))
+                    for day, rows in rows_by_day.items()
+                ],
+            )
+
+    def rows(self, accounts: list, start: date, end: date) -> list:
+        """Stored rows of `accounts` in [start, end], with their dates restored"""
+        rows = []
+        with self.connect() as connection:
+            for account in accounts:
+                stored = connection.execute(
+                    "SELECT rows FROM days"
+                    " WHERE account = ? AND day >= ? AND day <= ? ORDER BY day",
+                    (account, start.isoformat(), end.isoformat()),
+                ).fetchall()
+                for (day_rows,) in stored:
+                    for row in json.loads(day_rows):
+                        row["date"] = date.fromisoformat(row["date"])
+                        rows.append(row)
+        return rows
+
+
+def date_range(start: date, end: date) -> list:
+    """Every day from start to end, both included"""
+    return [start + timedelta(days=offset) for offset in range((end - start).days + 1)]
+
+
+def backfill_day(account: dict, day: date, subscribers: dict = None) -> list:
+    """Table rows for one account as of the end of `day`
+
+    `subscribers` are the day's SubscriberHistory counts. There is no
+    history of the unsubscribed count, so the rows' unsubscribed_rate is None.
+    """
+    metrics = get_data(
+        klaviyo_api_key=account["api_key"],
+        as_of=day,
+        subscribers=subscribers,
+        report_message_id=account["report_message_id"],
+        subscriber_segment=account["subscriber_segment"],
+    )
+    if not isinstance(metrics, Metrics):
+        raise RuntimeError(f"get_data failed for {account['name']} on {day}: {metrics}")
+    return build_rows(account["name"], day, metrics)
+
+
+def compute_days(
+    accounts: list,
+    start: date,
+    end: date,
+    checkpoint: BackfillCheckpoint,
+    chunk_days: int = chunk_days,
+    day_workers: int = day_workers,
+) -> dict:
+    """Compute and checkpoint every missing (account, day), chunk by chunk
+
+    Returns {(account, day): error message} for the days that failed; they
+    are retried by the next run. The subscriber segment's joins since the
+    first missing day are scanned once per account, and every day's segment
+    size and new subscribers are derived from them.
+    """
+    errors = {}
+    local_timezone = tzlocal.get_localzone()
+    with ThreadPoolExecutor(max_workers=day_workers) as executor:
+        for account in accounts:
+            done = checkpoint.done(account["name"], start, end)
+            missing = [day for day in date_range(start, end) if day not in done]
+            logging.info(
+                f"Backfilling {account['name']}: {len(missing)} days to compute, "
+                f"{len(done)} already checkpointed"
+            )
+            if not missing:
+                continue
+            try:
+                history = subscriber_history(
+                    RunContext(
+                        account["api_key"],
+                        None,
+                        local_timezone,
+                        subscriber_segment=account["subscriber_segment"],
+                    ),
+                    start_of_day(missing[0], local_timezone),
+                )
+            except Exception as e:
+                logging.error(f"Subscriber scan of {account['name']} failed: {e}")
+                errors.update({(account["name"], day): str(e) for day in missing})
+                continue
+            for offset in range(0, len(missing), chunk_days):
+                chunk = missing[offset : offset + chunk_days]
+                futures = {
+                    day: executor.submit(
+                        backfill_day, account, day, history.counts(day)
+                    )
+                    for day in chunk
+                }
+                rows_by_day = {}
+                for day, future in futures.items():
+                    try:
+                        rows_by_day[day] = future.result()
+                    except Exception as e:
+                        logging.error(
+                            f"Backfill of {account['name']} {day} failed: {e}"
+                        )
+                        errors[(account["name"], day)] = str(e)
+                checkpoint.save(account["name"], rows_by_day)
+                logging.info(
+                    f"Checkpointed {len(rows_by_day)} days of {account['name']} "
+                    f"up to {chunk[-1]}"
+                )
+    return errors
+
+
+def run_backfill(
+    start: date,
+    end: date,
+    table_id: str,
+    accounts: list = None,
+    checkpoint: BackfillCheckpoint = None,
+    chunk_days: int = chunk_days,
+    day_workers: int = day_workers,
+) -> dict:
+    """Backfill [start, end] for every account and write it in one bulk load
+
+    Days computed by an earlier, interrupted run are taken from the
+    checkpoint. Rows of the days that succeeded are written even when
+    others failed.
+    """
+    if new_subscriber_mode == "consent":
+        raise ValueError("Backfill needs KLAVIYO_NEW_SUBSCRIBER_MODE=joined")
+    accounts = accounts if accounts is not None else load_accounts()
+    checkpoint = checkpoint or BackfillCheckpoint(
+        os.path.join(state_dir, "klaviyo_backfill.sqlite3")
+    )
+    errors = compute_days(accounts, start, end, checkpoint, chunk_days, day_workers)
+
+    rows = checkpoint.rows([account["name"] for account in accounts], start, end)
+    affected = 0
+    if rows:
+        client = get_client()
+        ensure_table(
+            client, table_id, klaviyo_schema, defaults={"account": default_account}
+        )
+        merge_job = bulk_upsert_rows(client, table_id, rows, klaviyo_schema)
+        affected = merge_job.num_dml_affected_rows
+        logging.info(f"Merged {len(rows)} backfilled rows into {table_id}")
+    return {"rows": len(rows), "affected": affected, "errors": errors}
+
+
+def main(argv: list = None) -> int:
+    load_dotenv()
+    parser = argparse.ArgumentParser(
+        description="Backfill the Klaviyo table for a range of past days"
+    )
+    parser.add_argument("start", type=date.fromisoformat, help="first day, YYYY-MM-DD")
+    parser.add_argument("end", type=date.fromisoformat, help="last day, YYYY-MM-DD")
+    parser.add_argument(
+        "--account", action="append", help="only backfill this account (repeatable)"
+    )
+    parser.add_argument("--chunk-days", type=int, default=chunk_days)
+    parser.add_argument("--day-workers", type=int, default=day_workers)
+    parser.add_argument(
+        "--checkpoint",
+        default=os.path.join(state_dir, "klaviyo_backfill.sqlite3"),
+        help="SQLite file keeping computed days between runs",
+    )
+    args = parser.parse_args(argv)
+    if args.end < args.start:
+        parser.error("end is before start")
+    if args.start < date.fromisoformat(window_start):
+        parser.error(f"start is before KLAVIYO_WINDOW_START ({window_start})")
+    if args.end >= date.today():
+        parser.error("end must be a past day; today is written by the daily load")
+    if new_subscriber_mode == "consent":
+        parser.error(
+            "KLAVIYO_NEW_SUBSCRIBER_MODE=consent cannot count past days; use joined"
+        )
+
+    accounts = load_accounts()
+    if args.account:
+        unknown = set(args.account) - {account["name"] for account in accounts}
+        if unknown:
+            parser.error(f"unknown accounts: {sorted(unknown)}")
+        accounts = [account for account in accounts if account["name"] in args.account]
+
+    logging.basicConfig(level=logging.INFO)
+    table_id = (
+        f"{os.environ.get('PROJECT_ID', '')}.{os.environ.get('DATASET_ID', '')}"
+        f".{os.environ.get('TABLE_NAME', '')}"
+    )
+    result = run_backfill(
+        args.start,
+        args.end,
+        table_id,
+        accounts=accounts,
+        checkpoint=BackfillCheckpoint(args.checkpoint),
+        chunk_days=args.chunk_days,
+        day_workers=args.day_workers,
+    )
+    print(f"Merged {result['rows']} rows ({result['affected']} affected)")
+    for (account, day), error in sorted(result["errors"].items()):
+        print(f"Failed {account} {day}: {error}", file=sys.stderr)
+    return 1 if result["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
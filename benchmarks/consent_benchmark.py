@@ -0,0 +1,112 @@
+"""Benchmark consent-timestamp counting: per-profile loop vs vectorized batch
+
+Usage: python benchmarks/consent_benchmark.py [sizes...]
+"""
+import logging
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from profiles import ProfileColumns  # noqa: E402
+
+local_timezone = ZoneInfo("Asia/Bangkok")
+cutoff_datetime = datetime(2024, 5, 1, tzinfo=local_timezone)
+
+# Profiles per page of a segment scan
+page_size = 100
+
+
+def make_profiles(size: int, seed: int = 0) -> list:
+    rng = random.Random(seed)
+    start = datetime(2022, 1, 1, tzinfo=timezone.utc)
+    profiles = []
+    for _ in range(size):
+        consent_timestamp = None
+        if rng.random() > 0.05:
+            consent_timestamp = (
+                start + timedelta(seconds=rng.randrange(0, 3 * 365 * 86400))
+            ).isoformat()
+        profiles.append(
+            {
+                "attributes": {
+                    "subscriptions": {
+                        "email": {
+                            "marketing": {
+                                "consent": rng.choice(
+                                    ["SUBSCRIBED", "SUBSCRIBED", "UNSUBSCRIBED"]
+                                ),
+                                "consent_timestamp": consent_timestamp,
+                            }
+                        }
+                    }
+                }
+            }
+        )
+    return profiles
+
+
+def convert_to_local_timezone(iso: str, local_timezone: ZoneInfo):
+    """Convert any timezone to local timezone"""
+    if iso is None:
+        return None
+    try:
+        return datetime.fromisoformat(iso).astimezone(local_timezone)
+    except ValueError as e:
+        logging.error(f"Error converting datetime: {e}")
+        return None
+
+
+def legacy_count(subscribers: list) -> int:
+    """The per-profile parse and compare loop this benchmark is measured against"""
+    subscribers_before_today = []
+    for subscriber in subscribers:
+        marketing = subscriber["attributes"]["subscriptions"]["email"]["marketing"]
+        subscriber_updated_local = convert_to_local_timezone(
+            marketing["consent_timestamp"], local_timezone
+        )
+        if (
+            subscriber_updated_local is not None
+            and subscriber_updated_local < cutoff_datetime
+            and marketing["consent"] == "SUBSCRIBED"
+        ):
+            subscribers_before_today.append(subscriber)
+    return len(subscribers_before_today)
+
+
+def vectorized_count(subscribers: list) -> int:
+    """What the consent scan does: columns built page by page, then one compare"""
+    pages = (
+        subscribers[offset : offset + page_size]
+        for offset in range(0, len(subscribers), page_size)
+    )
+    return ProfileColumns.from_pages(pages).count_consented_before(cutoff_datetime)
+
+
+def timed(fn, *args) -> tuple:
+    started = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - started
+
+
+def main(sizes: list):
+    # Loads pyarrow's timestamp parser before anything is timed
+    vectorized_count(make_profiles(page_size))
+    print(f"{'profiles':>10} {'loop s':>10} {'vector s':>10} {'speedup':>8}")
+    for size in sizes:
+        profiles = make_profiles(size)
+        expected, loop_seconds = timed(legacy_count, profiles)
+        result, vector_seconds = timed(vectorized_count, profiles)
+        assert result == expected, (result, expected)
+        print(
+            f"{size:>10} {loop_seconds:>10.3f} {vector_seconds:>10.3f} "
+            f"{loop_seconds / vector_seconds:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main([int(size) for size in sys.argv[1:]] or [100_000, 1_000_000])
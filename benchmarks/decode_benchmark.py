@@ -0,0 +1,78 @@
+"""Decoding one page of profiles: json.loads vs decoding.loads
+
+Pages are built from the fake Klaviyo audience, either with every profile
+field or with only the consent fields the sparse fieldset of the consent
+scan asks for. Time is per page; peak memory is traced with tracemalloc.
+
+Usage: python benchmarks/decode_benchmark.py [page sizes...]
+"""
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import decoding  # noqa: E402
+from fake_klaviyo import FakeKlaviyo, sparse  # noqa: E402
+
+repeat = 20
+
+# What fields[profile] of the consent scan returns
+consent_attributes = [
+    "subscriptions",
+    "subscriptions.email.marketing.consent",
+    "subscriptions.email.marketing.consent_timestamp",
+]
+
+
+def page_body(fake: FakeKlaviyo, size: int, attributes: list = None) -> bytes:
+    profiles = [fake.profile(index) for index in range(size)]
+    if attributes:
+        for profile in profiles:
+            profile["attributes"] = sparse(profile["attributes"], attributes)
+    page = {
+        "data": profiles,
+        "links": {"self": "http://localhost/profiles", "next": None},
+    }
+    return json.dumps(page).encode()
+
+
+def measure(decode, body: bytes) -> tuple:
+    """(milliseconds per page, traced peak bytes) of decode(body)"""
+    decode(body)
+    started = time.perf_counter()
+    for _ in range(repeat):
+        decode(body)
+    seconds = (time.perf_counter() - started) / repeat
+    tracemalloc.start()
+    page = decode(body)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del page
+    return seconds * 1000, peak
+
+
+def main(sizes: list):
+    fake = FakeKlaviyo(max(sizes))
+    fake.server.server_close()
+    decoders = {"json.loads": json.loads, "decoding.loads": decoding.loads}
+    print(
+        f"decoding.loads uses {'orjson' if decoding.use_orjson else 'the stdlib'}"
+    )
+    print(f"{'page':>6} {'fields':>7} {'decoder':>15} {'ms/page':>9} {'peak KB':>9}")
+    for size in sizes:
+        for fields, attributes in (("all", None), ("sparse", consent_attributes)):
+            body = page_body(fake, size, attributes)
+            for name, decode in decoders.items():
+                milliseconds, peak = measure(decode, body)
+                print(
+                    f"{size:>6} {fields:>7} {name:>15} {milliseconds:>9.2f} "
+                    f"{peak / 1024:>9.0f}"
+                )
+
+
+if __name__ == "__main__":
+    main([int(size) for size in sys.argv[1:]] or [100, 1000])
@@ -0,0 +1,577 @@
+"""Local stand-in for the Klaviyo API endpoints get_data uses
+
+Serves /api/metrics, /api/metric-aggregates, /api/segments and /api/profiles
+over a synthetic audience generated on the fly, so millions of profiles cost
+no memory. Supports cursor pagination, sparse fieldsets, the joined_group_at
+and suppression filters get_data sends, a configurable per-request latency
+and Klaviyo's fixed-window rate limits with RateLimit-* headers and 429s.
+Responses are gzipped when the client accepts it, as the real API does.
+
+Usage: python benchmarks/fake_klaviyo.py [--profiles N] [--latency-ms MS] [--port P]
+"""
+import argparse
+import gzip
+import hashlib
+import itertools
+import json
+import math
+import os
+import re
+import threading
+import time
+from datetime import date, datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, unquote, urlsplit
+
+metric_names = [
+    "Received Email",
+    "Dropped Email",
+    "Marked Email as Spam",
+    "Opened Email",
+    "Clicked Email",
+    "Bounced Email",
+    "Viewed Product",
+    "Active on Site",
+    "Placed Order",
+    "Unsubscribed from List",
+    "Subscribed to List",
+]
+
+# Values each grouping dimension takes in aggregate responses; "{report}" is
+# the account's report message, see report_message_id
+dimension_values = {
+    "$message": ["{report}", "Xk29Pq", "Lm83Rt"],
+    "$attributed_message": ["", "{report}", "Xk29Pq"],
+    "$attributed_flow": ["", "Fl0w01"],
+    "$flow": ["", "Fl0w01", "Fl0w02"],
+    "Bounce Type": ["hard", "soft"],
+}
+
+# Limits per endpoint class as (burst per second, steady per minute), counted
+# the way Klaviyo documents it: in fixed windows aligned to the clock. This is
+# the server's own model, kept apart from the client's RateLimitScheduler so
+# the scheduler is not tested against itself.
+published_limits = {
+    "metric-aggregates": (3, 60),
+    "metrics": (10, 150),
+    "profiles": (75, 700),
+    "segments": (75, 700),
+}
+default_limits = (10, 150)
+
+segment_id = "SEGALL"
+segment_name = "All Subscribers Segment"
+
+# Every tenth profile is unsubscribed
+unsubscribed_every = 10
+
+# Responses smaller than this are sent uncompressed
+min_compressed_size = 1024
+
+# Profiles joined evenly over this many days up to server start
+audience_days = 3 * 365
+
+max_page_size = 100
+
+# Profile attributes only returned when asked for with additional-fields
+additional_fields = ["subscriptions", "predictive_analytics"]
+
+window_pattern = re.compile(
+    r"^(greater-or-equal|less-than)\(datetime,([0-9]{4}-[0-9]{2}-[0-9]{2})[^)]*\)$"
+)
+joined_pattern = re.compile(
+    r"(greater-or-equal|less-than)\(joined_group_at,([^)]+)\)"
+)
+not_empty_pattern = re.compile(r'^not\(equals\(([^,]+),""\)\)$')
+
+
+def parse_time(value: str) -> datetime:
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def stable_int(*parts) -> int:
+    return int.from_bytes(
+        hashlib.sha256(json.dumps(parts).encode()).digest()[:8], "big"
+    )
+
+
+def report_message_id(api_key: str) -> str:
+    """Id of the message an account's deliveries are reported on, per API key
+
+    Every account has its own, so a run using another account's id counts 0.
+    """
+    return f"Msg{stable_int('report message', api_key) % 1_000_000:06d}"
+
+
+def endpoint_class(path: str) -> str:
+    """First path segment after /api, e.g. /api/segments/X/profiles -> segments"""
+    parts = [part for part in path.split("/") if part]
+    if parts and parts[0] == "api":
+        parts = parts[1:]
+    return parts[0] if parts else "default"
+
+
+def sparse(attributes: dict, fields: list) -> dict:
+    """Keep only the requested (possibly dotted) attribute paths"""
+    kept = {}
+    for field in fields:
+        source, target = attributes, kept
+        path = field.split(".")
+        for name in path[:-1]:
+            if not isinstance(source, dict) or name not in source:
+                break
+            source = source[name]
+            target = target.setdefault(name, {})
+        else:
+            if isinstance(source, dict) and path[-1] in source:
+                target[path[-1]] = source[path[-1]]
+    return kept
+
+
+class FakeKlaviyo:
+    """Synthetic Klaviyo account served over HTTP on localhost
+
+    Profile i joined `audience_days` * i / profiles days after the audience
+    origin, so the profiles matching a joined_group_at range are a
+    contiguous index range and are never materialized. Request and response
+    body bytes are counted per endpoint class.
+    """
+
+    def __init__(
+        self,
+        profiles: int = 10_000,
+        latency: float = 0.0,
+        rate_limit_scale: float = 1.0,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        compress: bool = True,
+    ):
+        self.profiles = profiles
+        self.latency = latency
+        self.rate_limit_scale = rate_limit_scale
+        self.compress = compress
+        self.now = datetime.now(timezone.utc).replace(microsecond=0)
+        self.origin = self.now - timedelta(days=audience_days)
+        self.step = audience_days * 86400 / max(profiles, 1)
+        self.windows = {}
+        self.lock = threading.Lock()
+        self.reset_stats()
+        self.server = ThreadingHTTPServer((host, port), self.handler_class())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/api"
+
+    def start(self) -> "FakeKlaviyo":
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {
+                "requests": {},
+                "throttled": 0,
+                "bytes_in": 0,
+                "bytes_out": 0,
+                "bytes_out_uncompressed": 0,
+            }
+
+    def record(
+        self,
+        endpoint: str,
+        bytes_in: int,
+        bytes_out: int,
+        bytes_out_uncompressed: int,
+        throttled: bool,
+    ):
+        with self.lock:
+            requests = self.stats["requests"]
+            requests[endpoint] = requests.get(endpoint, 0) + 1
+            self.stats["throttled"] += throttled
+            self.stats["bytes_in"] += bytes_in
+            self.stats["bytes_out"] += bytes_out
+            self.stats["bytes_out_uncompressed"] += bytes_out_uncompressed
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return json.loads(json.dumps(self.stats))
+
+    # Rate limits
+
+    def throttle(self, endpoint: str) -> tuple:
+        """(retry after seconds or 0, RateLimit-* headers) for one request
+
+        Requests are counted per endpoint class in the current 1 second and
+        60 second windows; one that would go over either quota is refused
+        until that window ends and does not use up the other.
+        """
+        burst, steady = published_limits.get(endpoint, default_limits)
+        burst, steady = burst * self.rate_limit_scale, steady * self.rate_limit_scale
+        limits = ((burst, 1), (steady, 60))
+        with self.lock:
+            now = time.time()
+            counts = self.windows.setdefault(endpoint, {})
+            windows = [
+                (quota, seconds, int(now // seconds)) for quota, seconds in limits
+            ]
+            refused = [
+                (index + 1) * seconds - now
+                for quota, seconds, index in windows
+                if counts.get((seconds, index), 0) + 1 > quota
+            ]
+            if not refused:
+                for _, seconds, index in windows:
+                    counts[(seconds, index)] = counts.get((seconds, index), 0) + 1
+            for key in [key for key in counts if key[1] < int(now // key[0])]:
+                del counts[key]
+            steady_index = windows[1][2]
+            remaining = max(0, int(steady) - counts.get((60, steady_index), 0))
+            reset = max(refused) if refused else (steady_index + 1) * 60 - now
+        headers = {
+            "RateLimit-Limit": f"{int(burst)}, {int(burst)};w=1, {int(steady)};w=60",
+            "RateLimit-Remaining": str(remaining),
+            "RateLimit-Reset": str(math.ceil(reset)),
+        }
+        return (max(refused) if refused else 0.0), headers
+
+    # Audience
+
+    def joined_at(self, index: int) -> datetime:
+        return self.origin + timedelta(seconds=int(index * self.step))
+
+    def first_joined_at_or_after(self, moment: datetime) -> int:
+        position = math.ceil((moment - self.origin).total_seconds() / self.step)
+        return min(max(position, 0), self.profiles)
+
+    def profile(self, index: int) -> dict:
+        joined = self.joined_at(index).isoformat().replace("+00:00", "Z")
+        unsubscribed = index % unsubscribed_every == 0
+        return {
+            "type": "profile",
+            "id": f"P{index:08d}",
+            "attributes": {
+                "email": f"profile{index}@example.com",
+                "created": joined,
+                "updated": joined,
+                "joined_group_at": joined,
+                "location": {"country": "United States", "timezone": "UTC"},
+                "subscriptions": {
+                    "email": {
+                        "marketing": {
+                            "consent": "UNSUBSCRIBED" if unsubscribed else "SUBSCRIBED",
+                            "consent_timestamp": joined,
+                            "suppression": (
+                                [{"reason": "UNSUBSCRIBE", "timestamp": joined}]
+                                if unsubscribed
+                                else []
+                            ),
+                        }
+                    }
+                },
+                "predictive_analytics": {"churn_probability": 0.1},
+            },
+        }
+
+    def profile_view(self, path: str, params: dict) -> tuple:
+        """(count, position -> profile index) of the profiles a listing selects"""
+        filter = params.get("filter", "")
+        if path.endswith("/profiles") and path.startswith("/api/segments/"):
+            start, end = 0, self.profiles
+            for operator, value in joined_pattern.findall(filter):
+                position = self.first_joined_at_or_after(parse_time(value))
+                if operator == "greater-or-equal":
+                    start = max(start, position)
+                else:
+                    end = min(end, position)
+            return max(0, end - start), lambda position: start + position
+        if "UNSUBSCRIBE" in filter:
+            return (
+                math.ceil(self.profiles / unsubscribed_every),
+                lambda position: position * unsubscribed_every,
+            )
+        return self.profiles, lambda position: position
+
+    def page(self, base: str, path: str, query: str, params: dict, records) -> dict:
+        """One page of `records(offset, size)` with a cursor link to the next"""
+        size = min(int(params.get("page[size]", max_page_size)), max_page_size)
+        offset = int(params.get("page[cursor]", 0))
+        data, total = records(offset, size)
+        links = {"self": f"{base}{path}/?{query}", "next": None}
+        if offset + size < total:
+            kept = [
+                part
+                for part in query.split("&")
+                if unquote(part.split("=")[0]) != "page[cursor]"
+            ]
+            kept.append(f"page[cursor]={offset + size}")
+            links["next"] = f"{base}{path}/?{'&'.join(kept)}"
+        return {"data": data, "links": links}
+
+    def list_profiles(self, base: str, path: str, query: str, params: dict) -> dict:
+        count, index_of = self.profile_view(path, params)
+        fields = [
+            field for field in params.get("fields[profile]", "").split(",") if field
+        ]
+        additional = [
+            field
+            for field in params.get("additional-fields[profile]", "").split(",")
+            if field
+        ]
+        if fields:
+            fields += additional
+
+        def records(offset: int, size: int) -> tuple:
+            data = []
+            for position in range(offset, min(offset + size, count)):
+                profile = self.profile(index_of(position))
+                for name in additional_fields:
+                    if name not in additional:
+                        profile["attributes"].pop(name)
+                if fields:
+                    profile["attributes"] = sparse(profile["attributes"], fields)
+                data.append(profile)
+            return data, count
+
+        return self.page(base, path, query, params, records)
+
+    # Metrics
+
+    def list_metrics(self, base: str, path: str, query: str, params: dict) -> dict:
+        metrics = [
+            {"type": "metric", "id": f"M{number:05d}", "attributes": {"name": name}}
+            for number, name in enumerate(metric_names)
+        ]
+        return self.page(
+            base,
+            path,
+            query,
+            params,
+            lambda offset, size: (metrics[offset : offset + size], len(metrics)),
+        )
+
+    def aggregate(self, payload: dict, api_key: str = "") -> dict:
+        attributes = payload["data"]["attributes"]
+        start = end = None
+        excluded = {}
+        for condition in attributes.get("filter", []):
+            window = window_pattern.match(condition)
+            not_empty = not_empty_pattern.match(condition)
+            if window and window.group(1) == "greater-or-equal":
+                start = date.fromisoformat(window.group(2))
+            elif window:
+                end = date.fromisoformat(window.group(2))
+            elif not_empty:
+                excluded[not_empty.group(1)] = ""
+        start = start or (self.now.date() - timedelta(days=30))
+        end = end or self.now.date()
+        days = [start + timedelta(days=n) for n in range((end - start).days)]
+
+        if attributes.get("interval") == "day":
+            periods = [[day] for day in days]
+        else:
+            months = {}
+            for day in days:
+                months.setdefault(day.replace(day=1), []).append(day)
+            periods = list(months.values())
+
+        by = attributes.get("by", [])
+        scale = max(1, self.profiles // 10_000)
+        data = []
+        for dimensions in itertools.product(
+            *[
+                [
+                    value.replace("{report}", report_message_id(api_key))
+                    for value in dimension_values.get(name, ["value"])
+                ]
+                for name in by
+            ]
+        ):
+            if any(
+                excluded.get(name) == value
+                for name, value in zip(by, dimensions)
+                if name in excluded
+            ):
+                continue
+            measurements = {}
+            for measurement in attributes["measurements"]:
+                values = []
+                for period in periods:
+                    total = sum(
+                        stable_int(
+                            attributes["metric_id"], dimensions, measurement, str(day)
+                        )
+                        % 50
+                        for day in period
+                    )
+                    values.append(float(total * scale))
+                measurements[measurement] = values
+            data.append({"dimensions": list(dimensions), "measurements": measurements})
+        return {
+            "data": {
+                "type": "metric-aggregate",
+                "id": hashlib.sha256(json.dumps(attributes).encode()).hexdigest()[:16],
+                "attributes": {
+                    "dates": [
+                        f"{period[0].isoformat()}T00:00:00+00:00" for period in periods
+                    ],
+                    "data": data,
+                },
+            }
+        }
+
+    # Segments
+
+    def list_segments(self, base: str, path: str, query: str, params: dict) -> dict:
+        segments = [
+            {"type": "segment", "id": segment_id, "attributes": {"name": segment_name}},
+            {"type": "segment", "id": "SEGVIP", "attributes": {"name": "VIP"}},
+        ]
+        return self.page(
+            base,
+            path,
+            query,
+            params,
+            lambda offset, size: (segments[offset : offset + size], len(segments)),
+        )
+
+    def get_segment(self, segment: str, params: dict) -> dict:
+        attributes = {
+            "name": segment_name if segment == segment_id else "VIP",
+            "created": self.origin.isoformat(),
+            "updated": self.now.isoformat(),
+        }
+        fields = [
+            field for field in params.get("fields[segment]", "").split(",") if field
+        ]
+        if fields:
+            attributes = sparse(attributes, fields)
+        # Additional fields are returned whatever fields[segment] lists
+        if "profile_count" in params.get("additional-fields[segment]", "").split(","):
+            attributes["profile_count"] = self.profiles
+        return {"data": {"type": "segment", "id": segment, "attributes": attributes}}
+
+    def route(
+        self,
+        method: str,
+        path: str,
+        query: str,
+        body: bytes,
+        base: str,
+        api_key: str = "",
+    ):
+        """(status, JSON body) for one request"""
+        path = path.rstrip("/")
+        params = dict(parse_qsl(query, keep_blank_values=True))
+        parts = path.split("/")[2:]
+        if method == "GET" and parts == ["metrics"]:
+            return 200, self.list_metrics(base, path, query, params)
+        if method == "POST" and parts == ["metric-aggregates"]:
+            return 200, self.aggregate(json.loads(body), api_key)
+        if method == "GET" and parts == ["segments"]:
+            return 200, self.list_segments(base, path, query, params)
+        if method == "GET" and len(parts) == 2 and parts[0] == "segments":
+            return 200, self.get_segment(parts[1], params)
+        if method == "GET" and (
+            parts == ["profiles"]
+            or (len(parts) == 3 and parts[0] == "segments" and parts[2] == "profiles")
+        ):
+            return 200, self.list_profiles(base, path, query, params)
+        return 404, {"errors": [{"status": 404, "detail": f"No route for {path}"}]}
+
+    def handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body are separate writes; with Nagle each keep-alive
+            # response would wait ~40ms for the client's delayed ACK
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def handle_request(self, method: str):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                if fake.latency:
+                    time.sleep(fake.latency)
+                split = urlsplit(self.path)
+                endpoint = endpoint_class(split.path)
+                retry_after, headers = fake.throttle(endpoint)
+                if retry_after > 0:
+                    status = 429
+                    response = {"errors": [{"status": 429, "detail": "Throttled"}]}
+                    headers["Retry-After"] = str(math.ceil(retry_after))
+                else:
+                    host, port = fake.server.server_address[:2]
+                    api_key = self.headers.get("Authorization", "").split(" ")[-1]
+                    status, response = fake.route(
+                        method,
+                        split.path,
+                        split.query,
+                        body,
+                        f"http://{host}:{port}",
+                        api_key,
+                    )
+                payload = json.dumps(response).encode()
+                uncompressed = len(payload)
+                accepted = self.headers.get("Accept-Encoding", "")
+                if (
+                    fake.compress
+                    and "gzip" in accepted
+                    and uncompressed >= min_compressed_size
+                ):
+                    payload = gzip.compress(payload, compresslevel=6)
+                    headers["Content-Encoding"] = "gzip"
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+                fake.record(
+                    endpoint, len(body), len(payload), uncompressed, status == 429
+                )
+
+            def do_GET(self):
+                self.handle_request("GET")
+
+            def do_POST(self):
+                self.handle_request("POST")
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--profiles", type=int, default=10_000)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--rate-limit-scale", type=float, default=1.0)
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--no-compression", action="store_true")
+    args = parser.parse_args()
+    fake = FakeKlaviyo(
+        args.profiles,
+        args.latency_ms / 1000,
+        args.rate_limit_scale,
+        port=args.port,
+        compress=not args.no_compression,
+    )
+    print(f"Serving {args.profiles} profiles at {fake.url}")
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
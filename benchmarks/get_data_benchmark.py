@@ -0,0 +1,167 @@
+"""End-to-end get_data benchmark against the local fake Klaviyo server
+
+Each audience size runs get_data once, cold, in a fresh process and reports
+wall time, API calls, throttled calls, bytes transferred (request and
+response bodies as sent, and before compression) and the peak RSS of that
+process. Save a run with --save
+and compare later runs against it with --baseline; the exit status is 1
+when any figure regresses by more than --tolerance.
+
+Usage: python benchmarks/get_data_benchmark.py [--profiles N ...] [--latency-ms MS]
+           [--save FILE] [--baseline FILE]
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_klaviyo import FakeKlaviyo, report_message_id  # noqa: E402
+
+api_key = "pk_benchmark"
+
+# Figures compared against the baseline; lower is better for all of them
+compared = ["seconds", "calls", "bytes", "peak_rss_mb"]
+
+
+def run_child():
+    """Run get_data once in this process and print its figures as JSON"""
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from data import Metrics, get_data
+
+    started = time.perf_counter()
+    metrics = get_data()
+    seconds = time.perf_counter() - started
+    print(
+        json.dumps(
+            {
+                "ok": isinstance(metrics, Metrics),
+                "seconds": seconds,
+                "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                / 1024,
+                "metrics": metrics._asdict()
+                if isinstance(metrics, Metrics)
+                else str(metrics),
+            }
+        )
+    )
+
+
+def run_once(profiles: int, args) -> dict:
+    fake = FakeKlaviyo(
+        profiles,
+        args.latency_ms / 1000,
+        args.rate_limit_scale,
+        compress=not args.no_compression,
+    )
+    fake.start()
+    try:
+        with tempfile.TemporaryDirectory() as state:
+            env = dict(
+                os.environ,
+                KLAVIYO_API_URL=fake.url,
+                KLAVIYO_API_KEY=api_key,
+                KLAVIYO_REPORT_MESSAGE_ID=report_message_id(api_key),
+                KLAVIYO_RESPONSE_CACHE="0",
+                KLAVIYO_INCREMENTAL="0",
+                KLAVIYO_CATALOG_DIR=state,
+                KLAVIYO_STATE_DIR=state,
+                KLAVIYO_NEW_SUBSCRIBER_MODE=args.mode,
+            )
+            child = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--child"],
+                env=env,
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+        result = json.loads(child.stdout.strip().splitlines()[-1])
+    finally:
+        fake.stop()
+    stats = fake.snapshot()
+    if not result["ok"]:
+        raise RuntimeError(f"get_data failed with {profiles} profiles: {result}")
+    return {
+        "profiles": profiles,
+        "seconds": round(result["seconds"], 3),
+        "calls": sum(stats["requests"].values()),
+        "throttled": stats["throttled"],
+        "bytes": stats["bytes_in"] + stats["bytes_out"],
+        "bytes_uncompressed": stats["bytes_in"] + stats["bytes_out_uncompressed"],
+        "peak_rss_mb": round(result["peak_rss_mb"], 1),
+        "requests": stats["requests"],
+    }
+
+
+def compare(results: list, baseline: dict, tolerance: float) -> list:
+    """Figures more than `tolerance` worse than the baseline"""
+    regressions = []
+    for result in results:
+        before = baseline.get(str(result["profiles"]))
+        if before is None:
+            continue
+        for name in compared:
+            if before[name] and result[name] > before[name] * (1 + tolerance):
+                regressions.append(
+                    f"{result['profiles']} profiles: {name} {before[name]} -> "
+                    f"{result[name]} ({result[name] / before[name]:.2f}x)"
+                )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument(
+        "--profiles", type=int, nargs="+", default=[10_000, 100_000, 1_000_000]
+    )
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    parser.add_argument("--rate-limit-scale", type=float, default=1.0)
+    parser.add_argument("--mode", choices=["joined", "consent"], default="joined")
+    parser.add_argument(
+        "--no-compression", action="store_true", help="never gzip responses"
+    )
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against results saved earlier")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args()
+    if args.child:
+        run_child()
+        return
+
+    print(
+        f"{'profiles':>10} {'wall s':>8} {'calls':>7} {'429s':>5} "
+        f"{'KB':>10} {'raw KB':>10} {'peak MB':>8}"
+    )
+    results = []
+    for profiles in args.profiles:
+        result = run_once(profiles, args)
+        results.append(result)
+        print(
+            f"{profiles:>10} {result['seconds']:>8.2f} {result['calls']:>7} "
+            f"{result['throttled']:>5} {result['bytes'] / 1024:>10.1f} "
+            f"{result['bytes_uncompressed'] / 1024:>10.1f} "
+            f"{result['peak_rss_mb']:>8.1f}"
+        )
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(
+                {str(result["profiles"]): result for result in results}, f, indent=2
+            )
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""Memory per scanned profile: nested JSON dicts vs ProfileColumns
+
+Profiles come from the fake Klaviyo audience with every field the full
+segment scan used to request. Sizes are traced with tracemalloc.
+
+Usage: python benchmarks/profile_store_benchmark.py [sizes...]
+"""
+import json
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_klaviyo import FakeKlaviyo  # noqa: E402
+from profiles import ProfileColumns  # noqa: E402
+
+page_size = 100
+
+
+def pages(fake: FakeKlaviyo, size: int):
+    """Pages as decoded from the API, one at a time"""
+    for start in range(0, size, page_size):
+        end = min(start + page_size, size)
+        page = [fake.profile(index) for index in range(start, end)]
+        yield json.loads(json.dumps(page))
+
+
+def build_columns(fake: FakeKlaviyo, size: int) -> ProfileColumns:
+    columns = ProfileColumns.from_pages(pages(fake, size))
+    columns.flush()
+    return columns
+
+
+def traced(build) -> tuple:
+    tracemalloc.start()
+    result = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, size
+
+
+def main(sizes: list):
+    fake = FakeKlaviyo(max(sizes))
+    fake.server.server_close()
+    # Keep pyarrow's one-off kernel setup out of the traced figures
+    build_columns(fake, page_size)
+    print(f"{'profiles':>10} {'dicts B/p':>10} {'columns B/p':>12} {'ratio':>7}")
+    for size in sizes:
+        kept, dict_bytes = traced(
+            lambda: [profile for page in pages(fake, size) for profile in page]
+        )
+        del kept
+        columns, column_bytes = traced(lambda: build_columns(fake, size))
+        print(
+            f"{size:>10} {dict_bytes / size:>10.0f} {column_bytes / size:>12.1f} "
+            f"{dict_bytes / column_bytes:>6.0f}x"
+        )
+
+
+if __name__ == "__main__":
+    main([int(size) for size in sys.argv[1:]] or [10_000, 100_000])
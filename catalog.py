@@ -0,0 +1,106 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from utils import iter_pagination_metrics
+
+# Seconds a fetched metric catalog stays fresh, in memory and on disk
+catalog_ttl = int(os.environ.get("KLAVIYO_CATALOG_TTL", "86400"))
+catalog_dir = os.environ.get("KLAVIYO_CATALOG_DIR", tempfile.gettempdir())
+
+
+class MetricCatalog:
+    """Lazily loaded metric name -> metric ids mapping for one account
+
+    Nothing is fetched until the first lookup. A fresh copy is kept in memory
+    and persisted to `path`, so new workers start from the local copy and only
+    refetch `/metrics` once it is older than `ttl` seconds. A stale local copy
+    is still used if the refetch fails.
+    """
+
+    def __init__(
+        self, url: str, klaviyo_api_key: str, path: str, ttl: int = catalog_ttl
+    ):
+        self.url = url
+        self.klaviyo_api_key = klaviyo_api_key
+        self.path = path
+        self.ttl = ttl
+        self.metrics = None
+        self.fetched_at = 0.0
+        self.lock = threading.Lock()
+
+    def is_fresh(self, fetched_at: float) -> bool:
+        return time.time() - fetched_at < self.ttl
+
+    def read_local(self):
+        try:
+            with open(self.path) as f:
+                cached = json.load(f)
+            return cached["metrics"], cached["fetched_at"]
+        except (OSError, ValueError, KeyError):
+            return None, 0.0
+
+    def write_local(self):
+        directory = os.path.dirname(self.path) or "."
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump({"fetched_at": self.fetched_at, "metrics": self.metrics}, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.error(f"Error writing metric catalog {self.path}: {e}")
+
+    def fetch(self) -> dict:
+        metrics = {}
+        for metric in iter_pagination_metrics(self.url, self.klaviyo_api_key):
+            ids = metrics.setdefault(metric["attributes"]["name"], [])
+            if metric["id"] not in ids:
+                ids.append(metric["id"])
+        return metrics
+
+    def load(self) -> dict:
+        with self.lock:
+            if self.metrics is not None and self.is_fresh(self.fetched_at):
+                return self.metrics
+
+            metrics, fetched_at = self.read_local()
+            if metrics is not None and self.is_fresh(fetched_at):
+                self.metrics, self.fetched_at = metrics, fetched_at
+                return self.metrics
+
+            try:
+                self.metrics, self.fetched_at = self.fetch(), time.time()
+            except Exception as e:
+                if metrics is None:
+                    raise
+                logging.error(f"Error refreshing metric catalog, using stale copy: {e}")
+                self.metrics, self.fetched_at = metrics, fetched_at
+                return self.metrics
+            self.write_local()
+            return self.metrics
+
+    def ids(self, name: str) -> list:
+        """Ids of every metric called `name` (one per integration)"""
+        return self.load().get(name, [])
+
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+def get_metric_catalog(url: str, klaviyo_api_key: str) -> MetricCatalog:
+    """Shared catalog per account, persisted under catalog_dir"""
+    with _catalogs_lock:
+        catalog = _catalogs.get(klaviyo_api_key)
+        if catalog is None:
+            account = hashlib.sha256(klaviyo_api_key.encode()).hexdigest()[:16]
+            path = os.path.join(catalog_dir, f"klaviyo_metric_catalog_{account}.json")
+            catalog = _catalogs[klaviyo_api_key] = MetricCatalog(
+                url, klaviyo_api_key, path
+            )
+        return catalog
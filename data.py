@@ -1,7 +1,8 @@
 from utils import (
     get_subscribers,
-    get_metrics,
     get_pagination_metrics,
+    iter_pagination_pages,
+    count_pagination_metrics,
     calculate_rate_metric,
 )
 import os
@@ -9,570 +10,457 @@ import pandas as pd
 from dotenv import load_dotenv
 import tzlocal
 import os
-from datetime import datetime
+from datetime import date, datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
 import traceback
 import sys
 import logging
+from collections import Counter
+from typing import NamedTuple, Optional
+from catalog import get_metric_catalog
+from fieldsets import api_url
+from incremental import get_incremental_store
+from profiling import ProfiledThreadPoolExecutor
+from profiles import ProfileColumns
+from specs import AggregateSpec, MetricPlan, ProfileCountSpec
 
 load_dotenv()
 
 klaviyo_api_key = os.environ.get("KLAVIYO_API_KEY", "")
-klaviyo_url = "https://a.klaviyo.com/api"
+klaviyo_url = os.environ.get("KLAVIYO_API_URL", "https://a.klaviyo.com/api")
 
 
-statistic_url = (
-    f"{klaviyo_url}/metrics/?fields[metric]=name,updated,created,integration"
-)
-statistics = get_pagination_metrics(statistic_url, klaviyo_api_key)
+statistic_url = api_url(klaviyo_url, "metrics", "metric", ("attributes.name",))
 
 report_url = f"{klaviyo_url}/metric-aggregates"
 
+# Upper bound on metric-aggregate requests in flight at once
+max_workers = int(os.environ.get("KLAVIYO_MAX_WORKERS", "8"))
 
-def convert_to_local_timezone(iso: str, local_timezone: ZoneInfo):
-    """Convert any timezone to local timezone"""
-    if iso is None:
-        return None
-    try:
-        dt = datetime.fromisoformat(iso).astimezone(local_timezone)
-        return dt
-    except ValueError as e:
-        logging.error(f"Error converting datetime: {e}")
-        return None
+# Reporting window for the aggregate metrics, end exclusive
+window_start = os.environ.get("KLAVIYO_WINDOW_START", "2023-12-01")
+window_end = os.environ.get("KLAVIYO_WINDOW_END", "2024-04-30")
 
+date_filter = [
+    f"greater-or-equal(datetime,{window_start})",
+    f"less-than(datetime,{window_end})",
+]
+
+
+def window_filter_as_of(as_of: date) -> list:
+    """Reporting window cut off at the end of `as_of`"""
+    end = min(date.fromisoformat(window_end), as_of + timedelta(days=1))
+    return [
+        f"greater-or-equal(datetime,{window_start})",
+        f"less-than(datetime,{end.isoformat()})",
+    ]
 
-def get_subscribers_before_today(
-    subscribers: list, cutoff_datetime: datetime, local_timezone: ZoneInfo
-):
-    """Get subscribers subscribed before a given cutoff date and time"""
-    try:
-        subscribers_before_today = []
-        for subscriber in subscribers:
-            subscriber_updated_local = convert_to_local_timezone(
-                subscriber["attributes"]["subscriptions"]["email"]["marketing"][
-                    "consent_timestamp"
-                ],
-                local_timezone,
-            )
-            if (
-                subscriber_updated_local is not None
-                and subscriber_updated_local < cutoff_datetime
-                and subscriber["attributes"]["subscriptions"]["email"]["marketing"][
-                    "consent"
-                ]
-                == "SUBSCRIBED"
-            ):
-                subscribers_before_today.append(subscriber)
-        return len(subscribers_before_today)
-    except Exception as e:
-        logging.error(f"Error getting subscribers before today: {e}")
-        return 0
 
+# Serve additive aggregates from stored daily partials, fetching only new days
+incremental = os.environ.get("KLAVIYO_INCREMENTAL", "").lower() in ("1", "true")
 
-def get_data() -> list:
+# Largest page[size] the profile endpoints accept
+profile_page_size = 100
+
+# Server-side filter selecting unsubscribed profiles; empty scans every profile
+unsubscribed_filter = os.environ.get(
+    "KLAVIYO_UNSUBSCRIBED_FILTER",
+    'equals(subscriptions.email.marketing.suppression.reason,"UNSUBSCRIBE")',
+)
+
+# "joined" counts segment members who joined since the cutoff with a server-side
+# filter, "consent" scans the whole segment and compares consent timestamps
+new_subscriber_mode = os.environ.get("KLAVIYO_NEW_SUBSCRIBER_MODE", "joined")
+
+# Message whose deliveries and opens are reported, and the segment whose size
+# and new members are counted, for the single KLAVIYO_API_KEY account; each
+# account in KLAVIYO_ACCOUNTS names its own (see accounts.load_accounts)
+report_message_id = os.environ.get("KLAVIYO_REPORT_MESSAGE_ID", "UjjW7L")
+subscriber_segment = os.environ.get(
+    "KLAVIYO_SUBSCRIBER_SEGMENT", "All Subscribers Segment"
+)
+
+
+class Metrics(NamedTuple):
+    """Counters computed by get_data, in the order main.py historically unpacked"""
+
+    delivered_email_count: int = 0
+    bounced_email_count: int = 0
+    spam_email_count: int = 0
+    dropped_email_count: int = 0
+    opened_email_count: int = 0
+    clicked_email_count: int = 0
+    # None for a past day, which has no unsubscribed history
+    unsubscribed_count: Optional[int] = 0
+    conversion_active_on_site_count: int = 0
+    conversion_viewed_product_count: int = 0
+    revenue_unique_count: int = 0
+    total_revenue_count: int = 0
+    total_order_count: int = 0
+    delivered_email_unique_count: int = 0
+    revenue_count: int = 0
+    subscriber_count: int = 0
+    new_subscriber_count: int = 0
+
+
+class RunContext(NamedTuple):
+    """Inputs shared by the profile counters of one run"""
+
+    klaviyo_api_key: str
+    cutoff_time: datetime
+    local_timezone: ZoneInfo
+    # End of the reported day, set when computing a past day
+    end_time: Optional[datetime] = None
+    report_message_id: str = report_message_id
+    subscriber_segment: str = subscriber_segment
+
+
+def is_unsubscribed(profile: dict) -> bool:
+    """Whether a profile's email marketing consent is UNSUBSCRIBED"""
     try:
-        # Initialize variables
-        delivered_email_count = int(0)
-        bounced_email_count = int(0)
-        spam_email_count = int(0)
-        dropped_email_count = int(0)
-        opened_email_count = int(0)
-        clicked_email_count = int(0)
-        unsubscribed_count = 0
-        conversion_active_on_site_count = 0
-        conversion_viewed_product_count = 0
-        revenue_unique_count = int(0)
-        total_revenue_count = int(0)
-        total_order_count = int(0)
-        delivered_email_unique_count = int(0)
-        revenue_count = int(0)
-        subscriber_count = int(0)
-        new_subscriber_count = int(0)
-        # new_subscriber_data = list()
+        marketing = profile["attributes"]["subscriptions"]["email"]["marketing"]
+    except (KeyError, TypeError):
+        return False
+    return isinstance(marketing, dict) and marketing.get("consent") == "UNSUBSCRIBED"
+
+
+# What is_unsubscribed reads from each profile record
+unsubscribed_fields = ("attributes.subscriptions.email.marketing.consent",)
+
+
+def count_unsubscribed(context: RunContext) -> dict:
+    """Count profiles whose email marketing consent is UNSUBSCRIBED
+
+    The suppression filter is applied by the API, so only unsubscribed
+    profiles are paged through, 100 at a time and with nothing but the
+    consent field. The consent is still checked on each returned profile.
+    """
+    unsubscribed_url = api_url(
+        klaviyo_url,
+        "profiles",
+        "profile",
+        unsubscribed_fields,
+        filter=unsubscribed_filter,
+        page_size=profile_page_size,
+    )
+    unsubscribed_count = count_pagination_metrics(
+        unsubscribed_url,
+        context.klaviyo_api_key,
+        is_unsubscribed,
+    )
+    return {"unsubscribed_count": unsubscribed_count}
+
+
+def utc_timestamp(moment: datetime) -> str:
+    return moment.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def count_joined_since(segment_id: str, context: RunContext) -> int:
+    """Count segment members who joined since the cutoff (the start of today)
+
+    The date predicate is applied by the API, so only those members are
+    paged through instead of the whole segment.
+    """
+    cutoff = utc_timestamp(context.cutoff_time)
+    # Nothing but the count is read
+    joined_url = api_url(
+        klaviyo_url,
+        f"segments/{segment_id}/profiles",
+        "profile",
+        filter=f"greater-or-equal(joined_group_at,{cutoff})",
+        page_size=profile_page_size,
+    )
+    return count_pagination_metrics(joined_url, context.klaviyo_api_key)
+
+
+# What count_joins_by_day reads from each profile record
+joined_fields = ("attributes.joined_group_at",)
+
+
+def count_joins_by_day(
+    segment_id: str, context: RunContext, start: datetime
+) -> Counter:
+    """Segment members who joined at or after `start`, by local day of joining
+
+    One scan filtered by the API and reading only joined_group_at, however
+    many days are later derived from it.
+    """
+    joined_url = api_url(
+        klaviyo_url,
+        f"segments/{segment_id}/profiles",
+        "profile",
+        joined_fields,
+        filter=f"greater-or-equal(joined_group_at,{utc_timestamp(start)})",
+        page_size=profile_page_size,
+    )
+    joins = Counter()
+    for page in iter_pagination_pages(joined_url, context.klaviyo_api_key):
+        for profile in page:
+            joined_at = profile["attributes"].get("joined_group_at")
+            if joined_at:
+                joined_at = datetime.fromisoformat(joined_at)
+                joins[joined_at.astimezone(context.local_timezone).date()] += 1
+    return joins
+
+
+class SubscriberHistory(NamedTuple):
+    """Current subscriber segment size and its joins per local day since a start
+
+    Members who joined after a day are the only difference between the
+    segment then and now, so one joins scan yields the counts of every day.
+    """
+
+    profile_count: int
+    joins: Counter
+
+    def counts(self, day: date) -> dict:
+        """subscriber_count at the end of `day` and new_subscriber_count on it"""
+        joined_after = sum(
+            count for joined_on, count in self.joins.items() if joined_on > day
+        )
+        return {
+            "subscriber_count": self.profile_count - joined_after,
+            "new_subscriber_count": self.joins[day],
+        }
+
+
+# What ProfileColumns reads from each profile record
+consent_fields = (
+    "attributes.subscriptions.email.marketing.consent",
+    "attributes.subscriptions.email.marketing.consent_timestamp",
+)
 
+
+def count_subscribed_before(segment_id: str, context: RunContext) -> int:
+    """Count segment members whose consent was given before the cutoff (full scan)"""
+    new_subscriber_url = api_url(
+        klaviyo_url,
+        f"segments/{segment_id}/profiles",
+        "profile",
+        consent_fields,
+        page_size=profile_page_size,
+    )
+    # Each page is reduced to 9 bytes per profile as it arrives
+    profiles = ProfileColumns.from_pages(
+        iter_pagination_pages(new_subscriber_url, context.klaviyo_api_key)
+    )
+    return profiles.count_consented_before(context.cutoff_time)
+
+
+def subscriber_segments(context: RunContext) -> list:
+    """(id, profile_count) of each segment named the account's subscriber_segment
+
+    An account without one is an error rather than a count of 0.
+    """
+    segment_url = api_url(klaviyo_url, "segments", "segment", ("attributes.name",))
+    segments = get_pagination_metrics(segment_url, context.klaviyo_api_key)
+    matched = []
+    for seg in segments:
+        if seg["attributes"]["name"] == context.subscriber_segment:
+            subscriber_url = api_url(
+                klaviyo_url,
+                f"segments/{seg['id']}",
+                "segment",
+                ("attributes.profile_count",),
+            )
+            subscribers = get_subscribers(subscriber_url, context.klaviyo_api_key)
+            profile_count = subscribers["data"]["attributes"]["profile_count"]
+            matched.append((seg["id"], profile_count))
+    if not matched:
+        raise ValueError(f"No segment named {context.subscriber_segment!r}")
+    return matched
+
+
+def subscriber_history(context: RunContext, start: datetime) -> SubscriberHistory:
+    """SubscriberHistory of the account's subscriber segment since `start`"""
+    profile_count = 0
+    joins = Counter()
+    for segment_id, count in subscriber_segments(context):
+        profile_count += count
+        joins.update(count_joins_by_day(segment_id, context, start))
+    return SubscriberHistory(profile_count, joins)
+
+
+def count_subscribers(context: RunContext) -> dict:
+    """Count the subscriber segment's profiles and those who joined since cutoff
+
+    Past days (an `end_time`) are read from a SubscriberHistory and need the
+    joined mode: consent timestamps only tell who consented before the
+    cutoff, not who was a member at the end.
+    """
+    if context.end_time is not None:
+        if new_subscriber_mode == "consent":
+            raise ValueError(
+                "KLAVIYO_NEW_SUBSCRIBER_MODE=consent only counts the current day; "
+                "use joined for past days"
+            )
+        history = subscriber_history(context, context.cutoff_time)
+        return history.counts(context.cutoff_time.date())
+
+    subscriber_count = 0
+    new_subscriber_count = 0
+    for segment_id, profile_count in subscriber_segments(context):
+        subscriber_count += profile_count
+        if new_subscriber_mode == "consent":
+            new_subscriber_count += profile_count - count_subscribed_before(
+                segment_id, context
+            )
+        else:
+            new_subscriber_count += count_joined_since(segment_id, context)
+    return {
+        "subscriber_count": subscriber_count,
+        "new_subscriber_count": new_subscriber_count,
+    }
+
+
+def delivered_message(dimensions: list, context: RunContext) -> bool:
+    return dimensions == [context.report_message_id]
+
+
+def attributed(dimensions: list, context: RunContext) -> bool:
+    return dimensions != [""]
+
+
+attributed_message_filter = ('not(equals($attributed_message,""))',)
+
+# Every counter get_data produces and where it comes from
+metric_specs = [
+    AggregateSpec(
+        "Received Email",
+        "delivered_email_count",
+        ("$message",),
+        "count",
+        dimensions=delivered_message,
+    ),
+    AggregateSpec(
+        "Received Email", "delivered_email_unique_count", ("$message",), "unique"
+    ),
+    AggregateSpec("Dropped Email", "dropped_email_count", ("$message",), "count"),
+    AggregateSpec("Marked Email as Spam", "spam_email_count", ("$message",), "count"),
+    AggregateSpec(
+        "Opened Email",
+        "opened_email_count",
+        ("$message",),
+        "unique",
+        dimensions=delivered_message,
+    ),
+    AggregateSpec("Clicked Email", "clicked_email_count", ("$message",), "unique"),
+    AggregateSpec("Bounced Email", "bounced_email_count", ("Bounce Type",), "unique"),
+    AggregateSpec(
+        "Viewed Product",
+        "conversion_viewed_product_count",
+        ("$attributed_message",),
+        "unique",
+        dimensions=attributed,
+    ),
+    AggregateSpec(
+        "Active on Site",
+        "conversion_active_on_site_count",
+        ("$attributed_message",),
+        "unique",
+        dimensions=attributed,
+    ),
+    AggregateSpec(
+        "Placed Order",
+        "revenue_count",
+        ("$attributed_message", "$attributed_flow"),
+        "sum_value",
+        attributed_message_filter,
+    ),
+    AggregateSpec(
+        "Placed Order",
+        "revenue_unique_count",
+        ("$attributed_message", "$attributed_flow"),
+        "unique",
+        attributed_message_filter,
+    ),
+    AggregateSpec("Placed Order", "total_order_count", ("$flow",), "count"),
+    AggregateSpec("Placed Order", "total_revenue_count", ("$flow",), "sum_value"),
+    ProfileCountSpec(
+        "Unsubscribed from List", ("unsubscribed_count",), count_unsubscribed
+    ),
+    ProfileCountSpec(
+        "Subscribed to List",
+        ("subscriber_count", "new_subscriber_count"),
+        count_subscribers,
+    ),
+]
+
+metric_plan = MetricPlan(metric_specs, date_filter)
+
+
+def past_day_specs(subscribers: dict = None) -> list:
+    """metric_specs for a past day
+
+    The unsubscribed count only exists for the current state, so it is left
+    out. `subscribers`, the day's SubscriberHistory counts, stand in for
+    the subscriber scan when given.
+    """
+    specs = []
+    for spec in metric_specs:
+        count = getattr(spec, "count", None)
+        if count is count_unsubscribed:
+            continue
+        if count is count_subscribers and subscribers is not None:
+            spec = ProfileCountSpec(
+                spec.metric, spec.targets, lambda context: dict(subscribers)
+            )
+        specs.append(spec)
+    return specs
+
+
+def start_of_day(day: date, local_timezone: ZoneInfo) -> datetime:
+    return datetime(day.year, day.month, day.day, tzinfo=local_timezone)
+
+
+def get_data(
+    klaviyo_api_key: str = klaviyo_api_key,
+    max_workers: int = max_workers,
+    as_of: date = None,
+    subscribers: dict = None,
+    report_message_id: str = report_message_id,
+    subscriber_segment: str = subscriber_segment,
+) -> Metrics:
+    """Run the metric plan, with aggregate queries and profile scans in parallel
+
+    With `as_of`, computes a past day as a run at the end of that day would
+    have: aggregates up to and including it, the subscribers who joined on
+    it and the segment size at its end (joined mode only; pass the day's
+    SubscriberHistory counts as `subscribers` to skip the scan). Its
+    unsubscribed_count is None, as there is no history of it.
+    `report_message_id` and `subscriber_segment` are the account's, see
+    accounts.load_accounts.
+    """
+    executor = ProfiledThreadPoolExecutor(max_workers=max_workers)
+    try:
         local_timezone = tzlocal.get_localzone()
         current_time = datetime.now(local_timezone)
-        cutoff_time = datetime(
-            current_time.year,
-            current_time.month,
-            current_time.day,
-            0,
-            0,
-            0,
-            0,
-            tzinfo=local_timezone,
+        day = as_of or current_time.date()
+        cutoff_time = start_of_day(day, local_timezone)
+        plan = metric_plan
+        end_time = None
+        if as_of is not None:
+            plan = MetricPlan(past_day_specs(subscribers), window_filter_as_of(as_of))
+            end_time = cutoff_time + timedelta(days=1)
+
+        totals = plan.run(
+            get_metric_catalog(statistic_url, klaviyo_api_key),
+            executor,
+            report_url,
+            klaviyo_api_key,
+            context=RunContext(
+                klaviyo_api_key,
+                cutoff_time,
+                local_timezone,
+                end_time,
+                report_message_id,
+                subscriber_segment,
+            ),
+            incremental_store=get_incremental_store() if incremental else None,
         )
-
-        processed_metric_ids = set()
-        for stat in statistics:
-            metric_id = stat["id"]
-
-            if metric_id in processed_metric_ids:
-                continue
-            processed_metric_ids.add(metric_id)
-
-            if stat["attributes"]["name"] == "Received Email":
-                delivered_emails = get_metrics(
-                    ["$message"],
-                    metric_id,
-                    report_url,
-                    ["count"],
-                    [
-                        "greater-or-equal(datetime,2023-12-01)",
-                        "less-than(datetime,2024-04-30)",
-                    ],
-                    klaviyo_api_key,
-                )
-                if isinstance(delivered_emails, list):
-                    for delivered_email in delivered_emails:
-                        if (
-                            isinstance(delivered_email, dict)
-                            and "measurements" in delivered_email
-                            and "count" in delivered_email["measurements"]
-                        ):
-                            if delivered_email["dimensions"] == [
-                                "UjjW7L"
-                            ]:  # ID of report
-                                delivered_email_count += sum(
-                                    delivered_email["measurements"]["count"]
-                                )
-                        else:
-                            logging.error(
-                                f"Unexpected delivered_email structure: {delivered_email}"
-                            )
-                            return f"Unexpected delivered_email structure: {delivered_email}"
-                else:
-                    logging.error(f"delivered_emails is not a list: {delivered_emails}")
-                    return f"delivered_emails is not a list: {delivered_emails}"
-
-                delivered_email_uniques = get_metrics(
-                    ["$message"],
-                    metric_id,
-                    report_url,
-                    ["unique"],
-                    [
-                        "greater-or-equal(datetime,2023-12-01)",
-                        "less-than(datetime,2024-04-30)",
-                    ],
-                    klaviyo_api_key,
-                )
-                if isinstance(delivered_email_uniques, list):
-                    for delivered_email_unique in delivered_email_uniques:
-                        if (
-                            isinstance(delivered_email_unique, dict)
-                            and "measurements" in delivered_email_unique
-                            and "unique" in delivered_email_unique["measurements"]
-                        ):
-                            delivered_email_unique_count += sum(
-                                delivered_email_unique["measurements"]["unique"]
-                            )
-                        else:
-                            logging.error(
-                                f"Unexpected delivered_email_unique structure: {delivered_email_unique}"
-                            )
-                            return f"Unexpected delivered_email_unique structure: {delivered_email_unique}"
-                else:
-                    logging.error(
-                        f"delivered_email_uniques is not a list: {delivered_email_uniques}"
-                    )
-                    return f"delivered_email_uniques is not a list: {delivered_email_uniques}"
-
-            if stat["attributes"]["name"] == "Dropped Email":
-                dropped_emails = get_metrics(
-                    ["$message"],
-                    metric_id,
-                    report_url,
-                    ["count"],
-                    [
-                        "greater-or-equal(datetime,2023-12-01)",
-                        "less-than(datetime,2024-04-30)",
-                    ],
-                    klaviyo_api_key,
-                )
-
-                for dropped_email in dropped_emails:
-                    if (
-                        isinstance(dropped_email, dict)
-                        and "measurements" in dropped_email
-                        and "count" in dropped_email["measurements"]
-                    ):
-                        dropped_email_count += sum(
-                            dropped_email["measurements"]["count"]
-                        )
-                    else:
-                        logging.error(
-                            f"Unexpected dropped_email structure: {dropped_email}"
-                        )
-                        return f"Unexpected dropped_email structure: {dropped_email}"
-
-            if stat["attributes"]["name"] == "Marked Email as Spam":
-                spam_emails = get_metrics(
-                    ["$message"],
-                    metric_id,
-                    report_url,
-                    ["count"],
-                    [
-                        "greater-or-equal(datetime,2023-12-01)",
-                        "less-than(datetime,2024-04-30)",
-                    ],
-                    klaviyo_api_key,
-                )
-                if isinstance(spam_emails, list):
-                    for spam_email in spam_emails:
-                        if (
-                            isinstance(spam_email, dict)
-                            and "measurements" in spam_email
-                            and "count" in spam_email["measurements"]
-                        ):
-                            spam_email_count += sum(spam_email["measurements"]["count"])
-                        else:
-                            logging.error(
-                                f"Unexpected spam_email structure: {spam_email}"
-                            )
-                            return f"Unexpected spam_email structure: {spam_email}"
-                else:
-                    logging.error(f"spam_emails is not a list: {spam_emails}")
-                    return f"spam_emails is not a list: {spam_emails}"
-
-            if stat["attributes"]["name"] == "Opened Email":
-                opened_emails = get_metrics(
-                    ["$message"],
-                    metric_id,
-                    report_url,
-                    ["unique"],
-                    [
-                        "greater-or-equal(datetime,2023-12-01)",
-                        "less-than(datetime,2024-04-30)",
-                    ],
-                    klaviyo_api_key,
-                )
-                if isinstance(opened_emails, list):
-                    for opened_email in opened_emails:
-                        if (
-                            isinstance(opened_email, dict)
-                            and "measurements" in opened_email
-                            and "unique" in opened_email["measurements"]
-                        ):
-                            if opened_email["dimensions"] == ["UjjW7L"]:  # ID of report
-                                opened_email_count += sum(
-                                    opened_email["measurements"]["unique"]
-                                )
-                        else:
-                            logging.error(
-                                f"Unexpected opened_email structure: {opened_email}"
-                            )
-                            return f"Unexpected opened_email structure: {opened_email}"
-                else:
-                    logging.error(f"opened_emails is not a list: {opened_emails}")
-                    return f"opened_emails is not a list: {opened_emails}"
-
-            if stat["attributes"]["name"] == "Clicked Email":
-                clicked_emails = get_metrics(
-                    ["$message"],
-                    metric_id,
-                    report_url,
-                    ["unique"],
-                    [
-                        "greater-or-equal(datetime,2023-12-01)",
-                        "less-than(datetime,2024-04-30)",
-                    ],
-                    klaviyo_api_key,
-                )
-                if isinstance(clicked_emails, list):
-                    for clicked_email in clicked_emails:
-                        if (
-                            isinstance(clicked_email, dict)
-                            and "measurements" in clicked_email
-                            and "unique" in clicked_email["measurements"]
-                        ):
-                            clicked_email_count += sum(
-                                clicked_email["measurements"]["unique"]
-                            )
-                        else:
-                            logging.error(
-                                f"Unexpected clicked_email structure: {clicked_email}"
-                            )
-                            return (
-                                f"Unexpected clicked_email structure: {clicked_email}"
-                            )
-                else:
-                    logging.error(f"clicked_emails is not a list: {clicked_emails}")
-                    return f"clicked_emails is not a list: {clicked_emails}"
-
-            if stat["attributes"]["name"] == "Unsubscribed from List":
-                unsubscribed_url = f"{klaviyo_url}/profiles/?additional-fields[profile]=subscriptions&fields[profile]=title&page[size]=100"
-                unsubscribed_data = get_pagination_metrics(
-                    unsubscribed_url, klaviyo_api_key
-                )
-                if isinstance(unsubscribed_data, list):
-                    for unsubscribed in unsubscribed_data:
-                        if (
-                            isinstance(unsubscribed, dict)
-                            and "attributes" in unsubscribed
-                            and "subscriptions" in unsubscribed["attributes"]
-                            and "email" in unsubscribed["attributes"]["subscriptions"]
-                            and "marketing"
-                            in unsubscribed["attributes"]["subscriptions"]["email"]
-                        ):
-                            if (
-                                unsubscribed["attributes"]["subscriptions"]["email"][
-                                    "marketing"
-                                ]["consent"]
-                                == "UNSUBSCRIBED"
-                            ):
-                                unsubscribed_count += 1
-
-            if stat["attributes"]["name"] == "Bounced Email":
-                bounced_emails = get_metrics(
-                    ["Bounce Type"],
-                    metric_id,
-                    report_url,
-                    ["unique"],
-                    [
-                        "greater-or-equal(datetime,2023-12-01)",
-                        "less-than(datetime,2024-04-30)",
-                    ],
-                    klaviyo_api_key,
-                )
-                if isinstance(bounced_emails, list):
-                    for bounced_email in bounced_emails:
-                        if (
-                            isinstance(bounced_email, dict)
-                            and "measurements" in bounced_email
-                            and "unique" in bounced_email["measurements"]
-                        ):
-                            bounced_email_count += sum(
-                                bounced_email["measurements"]["unique"]
-                            )
-                        else:
-                            logging.error(
-                                f"Unexpected bounced_email structure: {bounced_email}"
-                            )
-                            return (
-                                f"Unexpected bounced_email structure: {bounced_email}"
-                            )
-                else:
-                    logging.error(f"bounced_emails is not a list: {bounced_emails}")
-                    return f"bounced_emails is not a list: {bounced_emails}"
-
-            if stat["attributes"]["name"] == "Viewed Product":
-                conversion_viewed_products = get_metrics(
-                    ["$attributed_message"],
-                    metric_id,
-                    report_url,
-                    ["unique"],
-                    [
-                        "greater-or-equal(datetime,2023-12-01)",
-                        "less-than(datetime,2024-04-30)",
-                    ],
-                    klaviyo_api_key,
-                )
-                if isinstance(conversion_viewed_products, list):
-                    for conversion_viewed_product in conversion_viewed_products:
-                        if (
-                            isinstance(conversion_viewed_product, dict)
-                            and "measurements" in conversion_viewed_product
-                            and "unique" in conversion_viewed_product["measurements"]
-                        ):
-                            if conversion_viewed_product["dimensions"] != [""]:
-                                conversion_viewed_product_count += sum(
-                                    conversion_viewed_product["measurements"]["unique"]
-                                )
-
-                        else:
-                            logging.error(
-                                f"Unexpected conversion_viewed_product structure: {conversion_viewed_product}"
-                            )
-                            return f"Unexpected conversion_viewed_product structure: {conversion_viewed_product}"
-                else:
-                    logging.error(
-                        f"conversion_viewed_products is not a list: {conversion_viewed_products}"
-                    )
-                    return f"conversion_viewed_products is not a list: {conversion_viewed_products}"
-            if stat["attributes"]["name"] == "Active on Site":
-                conversion_active_on_sites = get_metrics(
-                    ["$attributed_message"],
-                    metric_id,
-                    report_url,
-                    ["unique"],
-                    [
-                        "greater-or-equal(datetime,2023-12-01)",
-                        "less-than(datetime,2024-04-30)",
-                    ],
-                    klaviyo_api_key,
-                )
-                if isinstance(conversion_active_on_sites, list):
-                    for conversion_active_on_site in conversion_active_on_sites:
-                        if (
-                            isinstance(conversion_active_on_site, dict)
-                            and "measurements" in conversion_active_on_site
-                            and "unique" in conversion_active_on_site["measurements"]
-                        ):
-                            if conversion_active_on_site["dimensions"] != [""]:
-                                conversion_active_on_site_count += sum(
-                                    conversion_active_on_site["measurements"]["unique"]
-                                )
-                        else:
-                            logging.error(
-                                f"Unexpected conversion_active_on_site structure: {conversion_active_on_site}"
-                            )
-                            return f"Unexpected conversion_active_on_site structure: {conversion_active_on_site}"
-                else:
-                    logging.error(
-                        f"conversion_active_on_sites is not a list: {conversion_active_on_sites}"
-                    )
-                    return f"conversion_active_on_sites is not a list: {conversion_active_on_sites}"
-
-            if stat["attributes"]["name"] == "Placed Order":
-                revenues = get_metrics(
-                    ["$attributed_message", "$attributed_flow"],
-                    metric_id,
-                    report_url,
-                    ["sum_value"],
-                    [
-                        "greater-or-equal(datetime,2023-12-01)",
-                        "less-than(datetime,2024-04-30)",
-                        'not(equals($attributed_message,""))',
-                    ],
-                    klaviyo_api_key,
-                )
-                if isinstance(revenues, list):
-                    for revenue in revenues:
-                        if (
-                            isinstance(revenue, dict)
-                            and "measurements" in revenue
-                            and "sum_value" in revenue["measurements"]
-                        ):
-
-                            revenue_count += sum(revenue["measurements"]["sum_value"])
-                        else:
-                            logging.error(f"Unexpected revenue structure: {revenue}")
-                            return f"Unexpected revenue structure: {revenue}"
-                else:
-                    logging.error(f"revenues is not a list: {revenues}")
-                    return logging.error(f"revenues is not a list: {revenues}")
-
-                revenue_uniques = get_metrics(
-                    ["$attributed_message", "$attributed_flow"],
-                    metric_id,
-                    report_url,
-                    ["unique"],
-                    [
-                        "greater-or-equal(datetime,2023-12-01)",
-                        "less-than(datetime,2024-04-30)",
-                        'not(equals($attributed_message,""))',
-                    ],
-                    klaviyo_api_key,
-                )
-                for revenue_unique in revenue_uniques:
-                    revenue_unique_count += sum(
-                        revenue_unique["measurements"]["unique"]
-                    )
-
-                total_orders = get_metrics(
-                    ["$flow"],
-                    metric_id,
-                    report_url,
-                    ["count"],
-                    [
-                        "greater-or-equal(datetime,2023-12-01)",
-                        "less-than(datetime,2024-04-30)",
-                    ],
-                    klaviyo_api_key,
-                )
-                if isinstance(total_orders, list):
-                    for total_order in total_orders:
-                        if (
-                            isinstance(total_order, dict)
-                            and "measurements" in total_order
-                            and "count" in total_order["measurements"]
-                        ):
-                            total_order_count += sum(
-                                total_order["measurements"]["count"]
-                            )
-                        else:
-                            logging.error(
-                                f"Unexpected total_order structure: {total_order}"
-                            )
-                            return f"Unexpected total_order structure: {total_order}"
-                            # print("Unexpected total_order structure:", total_order)
-                else:
-                    logging.error(f"total_orders is not a list: {total_orders}")
-                    return logging.error(f"total_orders is not a list: {total_orders}")
-
-                total_revenues = get_metrics(
-                    ["$flow"],
-                    metric_id,
-                    report_url,
-                    ["sum_value"],
-                    [
-                        "greater-or-equal(datetime,2023-12-01)",
-                        "less-than(datetime,2024-04-30)",
-                    ],
-                    klaviyo_api_key,
-                )
-                if isinstance(total_revenues, list):
-                    for total_revenue in total_revenues:
-                        if (
-                            isinstance(total_revenue, dict)
-                            and "measurements" in total_revenue
-                            and "sum_value" in total_revenue["measurements"]
-                        ):
-                            total_revenue_count += sum(
-                                total_revenue["measurements"]["sum_value"]
-                            )
-                        else:
-                            logging.error(
-                                f"Unexpected total_revenue structure: {total_revenue}"
-                            )
-                            return (
-                                f"Unexpected total_revenue structure: {total_revenue}"
-                            )
-                else:
-                    logging.error(f"total_revenues is not a list: {total_revenues}")
-                    return logging.error(
-                        f"total_revenues is not a list: {total_revenues}"
-                    )
-
-            if stat["attributes"]["name"] == "Subscribed to List":
-                segment_url = f"{klaviyo_url}/segments/?fields[segment]=name"
-                segments = get_pagination_metrics(segment_url, klaviyo_api_key)
-                for seg in segments:
-                    if seg["attributes"]["name"] == "All Subscribers Segment":
-                        subscriber_id = seg["id"]
-                        subscriber_url = f"{klaviyo_url}/segments/{subscriber_id}/?additional-fields[segment]=profile_count&fields[segment]=name,created,updated&fields[tag]=name&include=tags"
-                        subscribers = get_subscribers(subscriber_url, klaviyo_api_key)
-                        subscriber_count += subscribers["data"]["attributes"][
-                            "profile_count"
-                        ]
-
-                        new_subscriber_url = f"{klaviyo_url}/segments/{subscriber_id}/profiles/?additional-fields[profile]=subscriptions,predictive_analytics&fields[profile]=created,updated,location,email&page[size]=100"
-                        new_subscribers = get_pagination_metrics(
-                            new_subscriber_url, klaviyo_api_key
-                        )
-                subscriber_before_today_count = get_subscribers_before_today(
-                    new_subscribers, cutoff_time, local_timezone
-                )
-                new_subscriber_count = subscriber_count - subscriber_before_today_count
-
-        return [
-            delivered_email_count,
-            bounced_email_count,
-            spam_email_count,
-            dropped_email_count,
-            opened_email_count,
-            clicked_email_count,
-            unsubscribed_count,
-            conversion_active_on_site_count,
-            conversion_viewed_product_count,
-            revenue_unique_count,
-            total_revenue_count,
-            total_order_count,
-            delivered_email_unique_count,
-            revenue_count,
-            subscriber_count,
-            new_subscriber_count,
-        ]
+        if as_of is not None:
+            totals["unsubscribed_count"] = None
+        return Metrics(**totals)
     except Exception as e:
         ex_type, ex_value, ex_traceback = sys.exc_info()
         trace_back = traceback.extract_tb(ex_traceback)
@@ -585,74 +473,81 @@ def get_data() -> list:
             f"File : {stack_trace[0]} , Line : {stack_trace[1]}, Func.Name : {stack_trace[2]}, Message : {stack_trace[3]}, Exception type: {ex_type}, Exception message: {ex_value}"
         )
         return stack_trace
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
 
 
 def calculate_rate_metric(numerator, denominator):
     return (numerator / denominator) * 100 if denominator else 0
 
 
+def calculate_rates(metrics: Metrics) -> dict:
+    """Derive the reported rates from the raw counters"""
+    total_recipients = (
+        metrics.delivered_email_count
+        + metrics.bounced_email_count
+        + metrics.spam_email_count
+        + metrics.dropped_email_count
+    )
+    delivered_email_count = metrics.delivered_email_count
+    return {
+        "open_rate": calculate_rate_metric(
+            metrics.opened_email_count, delivered_email_count
+        ),
+        "click_rate": calculate_rate_metric(
+            metrics.clicked_email_count, delivered_email_count
+        ),
+        "unsubscribed_rate": (
+            calculate_rate_metric(metrics.unsubscribed_count, total_recipients)
+            if metrics.unsubscribed_count is not None
+            else None
+        ),
+        "bounce_rate": calculate_rate_metric(
+            metrics.bounced_email_count, total_recipients
+        ),
+        "delivery_rate": calculate_rate_metric(
+            delivered_email_count, total_recipients
+        ),
+        "conversion_active_on_site_rate": calculate_rate_metric(
+            metrics.conversion_active_on_site_count, delivered_email_count
+        ),
+        "conversion_viewed_product_rate": calculate_rate_metric(
+            metrics.conversion_viewed_product_count, delivered_email_count
+        ),
+        "revenue_per_email": (
+            metrics.revenue_count / delivered_email_count
+            if delivered_email_count != 0
+            else 0
+        ),
+        "product_purchase_rate": calculate_rate_metric(
+            metrics.revenue_unique_count, metrics.delivered_email_unique_count
+        ),
+        "average_order_value": (
+            metrics.total_revenue_count / metrics.total_order_count
+            if metrics.total_order_count != 0
+            else 0
+        ),
+    }
+
+
 def data_handler():
     try:
         metrics = get_data()
-        (
-            delivered_email_count,
-            bounced_email_count,
-            spam_email_count,
-            dropped_email_count,
-            opened_email_count,
-            clicked_email_count,
-            unsubscribed_count,
-            conversion_active_on_site_count,
-            conversion_viewed_product_count,
-            revenue_unique_count,
-            total_revenue_count,
-            total_order_count,
-            delivered_email_unique_count,
-            revenue_count,
-            subscriber_count,
-            new_subscriber_count,
-        ) = metrics
-
-        total_recipients = (
-            delivered_email_count
-            + bounced_email_count
-            + spam_email_count
-            + dropped_email_count
-        )
-        open_rate = calculate_rate_metric(opened_email_count, delivered_email_count)
-        click_rate = calculate_rate_metric(clicked_email_count, delivered_email_count)
-        unsubscribed_rate = calculate_rate_metric(unsubscribed_count, total_recipients)
-        bounce_rate = calculate_rate_metric(bounced_email_count, total_recipients)
-        delivery_rate = calculate_rate_metric(delivered_email_count, total_recipients)
-        conversion_active_on_site_rate = calculate_rate_metric(
-            conversion_active_on_site_count, delivered_email_count
-        )
-        conversion_viewed_product_rate = calculate_rate_metric(
-            conversion_viewed_product_count, delivered_email_count
-        )
-        revenue_per_email = (
-            revenue_count / delivered_email_count if delivered_email_count != 0 else 0
-        )
-        product_purchase_rate = calculate_rate_metric(
-            revenue_unique_count, delivered_email_unique_count
-        )
-        average_order_value = (
-            total_revenue_count / total_order_count if total_order_count != 0 else 0
-        )
+        rates = calculate_rates(metrics)
 
         return [
-            str(open_rate),
-            str(click_rate),
-            str(unsubscribed_rate),
-            str(bounce_rate),
-            str(delivery_rate),
-            str(conversion_active_on_site_rate),
-            str(conversion_viewed_product_rate),
-            str(revenue_per_email),
-            str(product_purchase_rate),
-            str(average_order_value),
-            str(subscriber_count),
-            str(new_subscriber_count),
+            str(rates["open_rate"]),
+            str(rates["click_rate"]),
+            str(rates["unsubscribed_rate"]),
+            str(rates["bounce_rate"]),
+            str(rates["delivery_rate"]),
+            str(rates["conversion_active_on_site_rate"]),
+            str(rates["conversion_viewed_product_rate"]),
+            str(rates["revenue_per_email"]),
+            str(rates["product_purchase_rate"]),
+            str(rates["average_order_value"]),
+            str(metrics.subscriber_count),
+            str(metrics.new_subscriber_count),
         ]
 
     except Exception as e:
@@ -0,0 +1,22 @@
+import json
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# "auto" uses orjson when it is installed, "json" always uses the stdlib
+json_decoder = os.environ.get("KLAVIYO_JSON_DECODER", "auto")
+
+use_orjson = orjson is not None and json_decoder != "json"
+
+
+def loads(body: bytes):
+    """Decode a JSON body with the fastest decoder available
+
+    Both decoders raise a ValueError subclass on invalid JSON.
+    """
+    if use_orjson:
+        return orjson.loads(body)
+    return json.loads(body)
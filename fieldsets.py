@@ -0,0 +1,60 @@
+from typing import Iterable
+
+# Attributes a resource only returns when asked for with additional-fields[...]
+ADDITIONAL_FIELDS = {
+    "profile": ("subscriptions", "predictive_analytics"),
+    "segment": ("profile_count",),
+}
+
+# Requested when a consumer reads no attribute at all (e.g. a count), since a
+# sparse fieldset cannot be empty; usually null, so the cheapest to return
+PLACEHOLDER_FIELDS = {"profile": "external_id", "segment": "name", "metric": "name"}
+
+
+def attribute_paths(fields: Iterable[str]) -> list:
+    """Attribute paths of dotted record paths, e.g. attributes.email -> email
+
+    `id` and `type` are always returned and need no fieldset.
+    """
+    prefix = "attributes."
+    return sorted(
+        {field[len(prefix) :] for field in fields if field.startswith(prefix)}
+    )
+
+
+def fieldset_params(resource: str, fields: Iterable[str]) -> list:
+    """Minimal fields[...] and additional-fields[...] params to read `fields`
+
+    `fields` are the dotted record paths the consumer reads, so the request
+    asks for exactly what is read. An additional attribute read whole (e.g.
+    a segment's profile_count) is only named in additional-fields, which the
+    API returns whatever fields[...] lists; paths inside one (e.g.
+    subscriptions.email.marketing.consent) also narrow fields[...].
+    """
+    extra = ADDITIONAL_FIELDS.get(resource, ())
+    paths = attribute_paths(fields)
+    additional = sorted({path.split(".")[0] for path in paths} & set(extra))
+    selected = [path for path in paths if path not in extra]
+    selected = selected or [PLACEHOLDER_FIELDS[resource]]
+    params = []
+    if additional:
+        params.append((f"additional-fields[{resource}]", ",".join(additional)))
+    params.append((f"fields[{resource}]", ",".join(selected)))
+    return params
+
+
+def api_url(
+    base: str,
+    path: str,
+    resource: str,
+    fields: Iterable[str] = (),
+    filter: str = None,
+    page_size: int = None,
+) -> str:
+    """URL of `path` asking only for the `fields` of `resource` that are read"""
+    query = fieldset_params(resource, fields)
+    if filter:
+        query.append(("filter", filter))
+    if page_size:
+        query.append(("page[size]", page_size))
+    return f"{base}/{path}/?" + "&".join(f"{name}={value}" for name, value in query)
@@ -0,0 +1,275 @@
+import json
+import logging
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+from datetime import date, datetime, timedelta, timezone
+from typing import Optional
+
+from utils import get_metric_aggregates
+
+# Measurements whose per-day values can be summed into a window total
+ADDITIVE_MEASUREMENTS = {"count", "sum_value"}
+
+state_dir = os.environ.get("KLAVIYO_STATE_DIR", tempfile.gettempdir())
+
+# Longest range requested with interval "day" in one aggregate query
+max_days_per_request = 365
+
+window_start_pattern = re.compile(r"^greater-or-equal\(datetime,([0-9-]{10})\)$")
+window_end_pattern = re.compile(r"^less-than\(datetime,([0-9-]{10})\)$")
+
+
+def split_window(filter: list):
+    """Split a filter list into (start, end, remaining filters)
+
+    Returns None when the filter does not bound datetime on both sides.
+    """
+    start = end = None
+    rest = []
+    for condition in filter:
+        start_match = window_start_pattern.match(condition)
+        end_match = window_end_pattern.match(condition)
+        if start_match and start is None:
+            start = date.fromisoformat(start_match.group(1))
+        elif end_match and end is None:
+            end = date.fromisoformat(end_match.group(1))
+        else:
+            rest.append(condition)
+    if start is None or end is None:
+        return None
+    return start, end, rest
+
+
+# Concurrent runs (e.g. backfill days) never move a watermark backwards: the
+# stored range grows to the union when the two ranges touch, otherwise the
+# range reaching the later day is kept. SET expressions read the old row.
+upsert_watermark = """
+INSERT INTO watermarks VALUES (?, ?, ?, ?)
+ON CONFLICT (query, measurement) DO UPDATE SET
+    first_day = CASE
+        WHEN excluded.first_day <= date(day, '+1 day')
+        AND excluded.day >= date(first_day, '-1 day')
+        THEN MIN(first_day, excluded.first_day)
+        WHEN excluded.day > day THEN excluded.first_day
+        ELSE first_day
+    END,
+    day = MAX(day, excluded.day)
+"""
+
+
+class IncrementalAggregateStore:
+    """Per-day partial aggregates per query with a closed-day watermark
+
+    Additive measurements are fetched with interval "day" and every closed
+    day is stored. Each run only requests the days after the watermark (the
+    last fully closed day already stored), plus today, which is never stored.
+    Days are UTC days, as Klaviyo reads bare filter dates as UTC. Window
+    totals are rebuilt from the stored partials, so API work per run stays
+    constant as history grows.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self.connect() as connection:
+            connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS partials (
+                    query TEXT, measurement TEXT, day TEXT, dimensions TEXT,
+                    value REAL,
+                    PRIMARY KEY (query, measurement, day, dimensions)
+                )
+                """
+            )
+            connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS watermarks (
+                    query TEXT, measurement TEXT, first_day TEXT, day TEXT,
+                    PRIMARY KEY (query, measurement)
+                )
+                """
+            )
+
+    def connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30)
+
+    @staticmethod
+    def supports(measurement: list, filter: list) -> bool:
+        return (
+            set(measurement) <= ADDITIVE_MEASUREMENTS
+            and split_window(filter) is not None
+        )
+
+    @staticmethod
+    def query_key(metric_id: str, by: list, filter: list) -> str:
+        return json.dumps([metric_id, list(by), sorted(filter)])
+
+    def watermark(self, query: str, measurement: str) -> Optional[tuple]:
+        """(first stored day, last fully closed stored day) or None"""
+        with self.connect() as connection:
+            row = connection.execute(
+                "SELECT first_day, day FROM watermarks"
+                " WHERE query = ? AND measurement = ?",
+                (query, measurement),
+            ).fetchone()
+        if row is None:
+            return None
+        return date.fromisoformat(row[0]), date.fromisoformat(row[1])
+
+    def fetch_days(
+        self,
+        by: list,
+        metric_id: str,
+        url: str,
+        measurement: list,
+        filter: list,
+        klaviyo_api_key: str,
+        start: date,
+        end: date,
+    ) -> dict:
+        """Daily values in [start, end) as {(day, dimensions): {measurement: value}}"""
+        days = {}
+        while start < end:
+            chunk_end = min(end, start + timedelta(days=max_days_per_request))
+            reports = get_metric_aggregates(
+                by,
+                metric_id,
+                url,
+                measurement,
+                filter
+                + [
+                    f"greater-or-equal(datetime,{start.isoformat()})",
+                    f"less-than(datetime,{chunk_end.isoformat()})",
+                ],
+                klaviyo_api_key,
+                interval="day",
+            )
+            dates = [date.fromisoformat(day[:10]) for day in reports["dates"]]
+            for row in reports["data"]:
+                dimensions = json.dumps(row["dimensions"])
+                for name in measurement:
+                    for day, value in zip(dates, row["measurements"][name]):
+                        if start <= day < chunk_end:
+                            values = days.setdefault((day, dimensions), {})
+                            values[name] = values.get(name, 0) + value
+            start = chunk_end
+        return days
+
+    def get_metrics(
+        self,
+        by: list,
+        metric_id: str,
+        url: str,
+        measurement: list,
+        filter: list,
+        klaviyo_api_key: str,
+        today: date = None,
+    ) -> list:
+        """Drop-in for utils.get_metrics backed by the stored daily partials"""
+        try:
+            today = today or datetime.now(timezone.utc).date()
+            start, end, rest = split_window(filter)
+            query = self.query_key(metric_id, by, rest)
+
+            watermarks = [self.watermark(query, name) for name in measurement]
+            if any(
+                watermark is None or start < watermark[0] for watermark in watermarks
+            ):
+                fetch_from = start
+                first_day = start
+            else:
+                last_day = min(watermark[1] for watermark in watermarks)
+                fetch_from = max(start, last_day + timedelta(days=1))
+                first_day = min(watermark[0] for watermark in watermarks)
+            closed_end = min(end, today)
+
+            days = {}
+            if fetch_from < end:
+                days = self.fetch_days(
+                    by,
+                    metric_id,
+                    url,
+                    measurement,
+                    rest,
+                    klaviyo_api_key,
+                    fetch_from,
+                    end,
+                )
+            logging.info(
+                f"Incremental aggregate {metric_id} {measurement}: fetched "
+                f"{max(0, (end - fetch_from).days)} of {(end - start).days} days"
+            )
+
+            with self.lock, self.connect() as connection:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO partials VALUES (?, ?, ?, ?, ?)",
+                    [
+                        (query, name, day.isoformat(), dimensions, value)
+                        for (day, dimensions), values in days.items()
+                        if day < closed_end
+                        for name, value in values.items()
+                    ],
+                )
+                if fetch_from < closed_end:
+                    connection.executemany(
+                        upsert_watermark,
+                        [
+                            (
+                                query,
+                                name,
+                                first_day.isoformat(),
+                                (closed_end - timedelta(days=1)).isoformat(),
+                            )
+                            for name in measurement
+                        ],
+                    )
+                stored = connection.execute(
+                    f"""
+                    SELECT dimensions, measurement, SUM(value) FROM partials
+                    WHERE query = ? AND day >= ? AND day < ?
+                    AND measurement IN ({",".join("?" * len(measurement))})
+                    GROUP BY dimensions, measurement
+                    """,
+                    [query, start.isoformat(), closed_end.isoformat()]
+                    + list(measurement),
+                ).fetchall()
+
+            totals = {}
+            for dimensions, name, value in stored:
+                totals.setdefault(dimensions, {})[name] = value
+            # Open days are used as fetched but never stored
+            for (day, dimensions), values in days.items():
+                if day >= closed_end:
+                    for name, value in values.items():
+                        row = totals.setdefault(dimensions, {})
+                        row[name] = row.get(name, 0) + value
+
+            return [
+                {
+                    "dimensions": json.loads(dimensions),
+                    "measurements": {
+                        name: [values.get(name, 0)] for name in measurement
+                    },
+                }
+                for dimensions, values in totals.items()
+            ]
+        except Exception as e:
+            return str(e)
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_incremental_store(path: str = None) -> IncrementalAggregateStore:
+    """Shared store per sqlite path, defaulting to state_dir"""
+    path = path or os.path.join(state_dir, "klaviyo_aggregates.sqlite3")
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is None:
+            store = _stores[path] = IncrementalAggregateStore(path)
+        return store
@@ -0,0 +1,251 @@
+import bisect
+import math
+import threading
+
+# Upper bounds in seconds of the latency histogram buckets
+latency_buckets = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# Upper bounds of the pages-per-scan histogram buckets
+page_buckets = (1, 2, 5, 10, 50, 100, 500, 1000, 5000, 10000, 50000)
+
+
+class Counter:
+    """Monotonic counter per label values"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self.lock:
+            state = self.series.setdefault(key, [0.0])
+            state[0] += amount
+
+    def samples(self, key: tuple, state: list) -> list:
+        return [(self.name, key, (), state[0])]
+
+
+class Histogram:
+    """Cumulative-bucket histogram per label values"""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: tuple = (),
+        buckets: tuple = latency_buckets,
+    ):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets) + (math.inf,)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self.lock:
+            # [count per bucket..., sum, count]
+            state = self.series.setdefault(key, [0.0] * (len(self.buckets) + 2))
+            state[bisect.bisect_left(self.buckets, value)] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def samples(self, key: tuple, state: list) -> list:
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, state):
+            cumulative += count
+            le = "+Inf" if bound == math.inf else repr(float(bound))
+            samples.append((f"{self.name}_bucket", key, (("le", le),), cumulative))
+        samples.append((f"{self.name}_sum", key, (), state[-2]))
+        samples.append((f"{self.name}_count", key, (), state[-1]))
+        return samples
+
+
+class Registry:
+    """Process-level set of metrics, rendered in the Prometheus text format
+
+    `snapshot`, `delta` and `merge` work on plain, picklable state so work
+    done in other processes or during one run can be carried and summarized.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def snapshot(self) -> dict:
+        state = {}
+        for metric in self.metrics.values():
+            with metric.lock:
+                for key, values in metric.series.items():
+                    state[(metric.name, key)] = list(values)
+        return state
+
+    def delta(self, before: dict) -> dict:
+        """State recorded since the `before` snapshot"""
+        delta = {}
+        for series, values in self.snapshot().items():
+            previous = before.get(series, [0.0] * len(values))
+            change = [value - old for value, old in zip(values, previous)]
+            if any(change):
+                delta[series] = change
+        return delta
+
+    def merge(self, state: dict):
+        """Add state recorded elsewhere, e.g. by a worker process"""
+        for (name, key), values in state.items():
+            metric = self.metrics.get(name)
+            if metric is None:
+                continue
+            with metric.lock:
+                current = metric.series.setdefault(key, [0.0] * len(values))
+                for index, value in enumerate(values):
+                    current[index] += value
+
+    def summarize(self, state: dict) -> dict:
+        """Readable {"name{label=value}": total or {"count", "sum"}} of a delta"""
+        summary = {}
+        for (name, key), values in sorted(state.items()):
+            metric = self.metrics[name]
+            labels = ",".join(
+                f"{label}={value}" for label, value in zip(metric.labelnames, key)
+            )
+            series = f"{name}{{{labels}}}" if labels else name
+            if metric.kind == "histogram":
+                summary[series] = {
+                    "count": int(values[-1]),
+                    "sum": round(values[-2], 3),
+                }
+            else:
+                summary[series] = round(values[0], 3)
+        return summary
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            with metric.lock:
+                series = {key: list(values) for key, values in metric.series.items()}
+            for key, values in sorted(series.items()):
+                for name, _, extra, sample in metric.samples(key, values):
+                    labels = [
+                        f'{label}="{escape(label_value)}"'
+                        for label, label_value in zip(metric.labelnames, key)
+                    ]
+                    labels += [f'{label}="{bound}"' for label, bound in extra]
+                    label_text = "{" + ",".join(labels) + "}" if labels else ""
+                    lines.append(f"{name}{label_text} {format_sample(sample)}")
+        return "\n".join(lines) + "\n"
+
+
+def format_sample(value: float) -> str:
+    """Shortest exact text of a sample value, as the Prometheus client writes it"""
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    if math.isnan(value):
+        return "NaN"
+    return repr(float(value))
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+registry = Registry()
+
+request_seconds = registry.register(
+    Histogram(
+        "klaviyo_request_seconds",
+        "Klaviyo API request latency per attempt",
+        ("endpoint", "method", "status"),
+    )
+)
+request_retries = registry.register(
+    Counter(
+        "klaviyo_request_retries_total",
+        "Klaviyo API attempts that were retried",
+        ("endpoint", "reason"),
+    )
+)
+request_bytes = registry.register(
+    Counter(
+        "klaviyo_request_bytes_total",
+        "Bytes sent to and received from the Klaviyo API",
+        ("endpoint", "direction"),
+    )
+)
+response_encodings = registry.register(
+    Counter(
+        "klaviyo_response_encodings_total",
+        "Klaviyo API responses by Content-Encoding",
+        ("endpoint", "encoding"),
+    )
+)
+compression_saved_bytes = registry.register(
+    Counter(
+        "klaviyo_compression_saved_bytes_total",
+        "Response bytes saved by compression (decoded minus received)",
+        ("endpoint",),
+    )
+)
+scan_pages = registry.register(
+    Histogram(
+        "klaviyo_scan_pages",
+        "Pages fetched per paginated scan",
+        ("endpoint",),
+        page_buckets,
+    )
+)
+response_cache_lookups = registry.register(
+    Counter(
+        "klaviyo_response_cache_lookups_total",
+        "Response cache lookups of aggregate responses and computed metrics",
+        ("kind", "result"),
+    )
+)
+job_phase_seconds = registry.register(
+    Histogram("klaviyo_job_phase_seconds", "Duration of each job phase", ("phase",))
+)
+bigquery_bytes_processed = registry.register(
+    Counter(
+        "klaviyo_bigquery_bytes_processed_total",
+        "Bytes processed by BigQuery jobs",
+        ("step",),
+    )
+)
+bigquery_bytes_billed = registry.register(
+    Counter(
+        "klaviyo_bigquery_bytes_billed_total",
+        "Bytes billed for BigQuery jobs",
+        ("step",),
+    )
+)
+bigquery_rows_affected = registry.register(
+    Counter(
+        "klaviyo_bigquery_rows_affected_total",
+        "Rows inserted or updated by BigQuery DML",
+        ("step",),
+    )
+)
+
+
+def record_query_job(step: str, job):
+    """Record the bytes and rows of a finished BigQuery query job"""
+    bigquery_bytes_processed.inc(job.total_bytes_processed or 0, step=step)
+    bigquery_bytes_billed.inc(job.total_bytes_billed or 0, step=step)
+    bigquery_rows_affected.inc(job.num_dml_affected_rows or 0, step=step)
@@ -0,0 +1,259 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+from contextlib import contextmanager, nullcontext
+from datetime import timedelta
+from typing import Callable, Optional
+
+from google.api_core.exceptions import GoogleAPIError, NotFound
+from google.cloud import storage
+
+from instrumentation import job_phase_seconds
+from profiling import RunProfiler, profile_dir
+
+jobs_dir = os.environ.get(
+    "KLAVIYO_JOBS_DIR", os.path.join(tempfile.gettempdir(), "klaviyo_jobs")
+)
+# Cloud Storage bucket holding job state, shared by every service and instance
+jobs_bucket = os.environ.get("KLAVIYO_JOBS_BUCKET", "")
+
+# Cloud Tasks queue (projects/P/locations/L/queues/Q) handing queued runs to
+# the worker service; without it runs happen within the request
+task_queue = os.environ.get("KLAVIYO_TASK_QUEUE", "")
+worker_service = os.environ.get("KLAVIYO_WORKER_SERVICE", "worker")
+# Seconds the worker service may take to run a job, at most 24 hours
+task_deadline = int(os.environ.get("KLAVIYO_TASK_DEADLINE", "3600"))
+
+
+class LocalJobStore:
+    """Job state as JSON files in a directory, shared by one instance's processes"""
+
+    def __init__(self, path: str = jobs_dir):
+        self.path = path
+
+    def write(self, job_id: str, state: str):
+        os.makedirs(self.path, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            f.write(state)
+        os.replace(tmp_path, os.path.join(self.path, f"{job_id}.json"))
+
+    def read(self, job_id: str) -> Optional[dict]:
+        try:
+            with open(os.path.join(self.path, f"{job_id}.json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+
+class BucketJobStore:
+    """Job state as JSON objects in a Cloud Storage bucket, shared by every service"""
+
+    def __init__(self, bucket_name: str, prefix: str = "klaviyo_jobs/"):
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.bucket = None
+        self.lock = threading.Lock()
+
+    def get_bucket(self) -> storage.Bucket:
+        with self.lock:
+            if self.bucket is None:
+                self.bucket = storage.Client().bucket(self.bucket_name)
+            return self.bucket
+
+    def write(self, job_id: str, state: str):
+        blob = self.get_bucket().blob(f"{self.prefix}{job_id}.json")
+        blob.upload_from_string(state, content_type="application/json")
+
+    def read(self, job_id: str) -> Optional[dict]:
+        blob = self.get_bucket().blob(f"{self.prefix}{job_id}.json")
+        try:
+            return json.loads(blob.download_as_bytes())
+        except (NotFound, ValueError):
+            return None
+
+
+def get_job_store():
+    """Bucket store with KLAVIYO_JOBS_BUCKET, else files under KLAVIYO_JOBS_DIR"""
+    return BucketJobStore(jobs_bucket) if jobs_bucket else LocalJobStore(jobs_dir)
+
+
+_tasks_client = None
+_tasks_client_lock = threading.Lock()
+
+
+def get_tasks_client():
+    """Process-level Cloud Tasks client, only needed with KLAVIYO_TASK_QUEUE"""
+    global _tasks_client
+    with _tasks_client_lock:
+        if _tasks_client is None:
+            from google.cloud import tasks_v2
+
+            _tasks_client = tasks_v2.CloudTasksClient()
+        return _tasks_client
+
+
+class Job:
+    """One pipeline run with per-phase timings
+
+    Every state change is written to `store`, so any process sharing it can
+    report on the job. With `profile`, the run is captured by a RunProfiler
+    and its artifacts listed in `profile`.
+    """
+
+    def __init__(
+        self,
+        store,
+        name: str,
+        profile: bool = False,
+        job_id: str = None,
+        created_at: float = None,
+    ):
+        self.id = job_id or uuid.uuid4().hex
+        self.name = name
+        self.store = store
+        self.status = "queued"
+        self.created_at = created_at or time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.phases = []
+        self.result = None
+        self.error = None
+        self.profile = [] if profile else None
+        self.profiler = None
+        self.lock = threading.Lock()
+        self.save()
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "name": self.name,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "phases": self.phases,
+            "result": self.result,
+            "error": self.error,
+            "profile": self.profile,
+        }
+
+    def save(self):
+        with self.lock:
+            state = json.dumps(self.to_dict(), default=str)
+        try:
+            self.store.write(self.id, state)
+        except (OSError, GoogleAPIError) as e:
+            logging.error(f"Error saving job {self.id}: {e}")
+
+    @contextmanager
+    def phase(self, name: str):
+        """Time a named phase of the run"""
+        phase = {"name": name, "started_at": time.time(), "seconds": None}
+        with self.lock:
+            self.phases.append(phase)
+        self.save()
+        # Timed inside the profiler's tag, which snapshots memory around it
+        tag = self.profiler.tag(name) if self.profiler is not None else nullcontext()
+        seconds = 0.0
+        try:
+            with tag:
+                started = time.perf_counter()
+                try:
+                    yield
+                finally:
+                    seconds = time.perf_counter() - started
+        finally:
+            job_phase_seconds.observe(seconds, phase=name)
+            phase["seconds"] = round(seconds, 3)
+            self.save()
+            logging.info(f"Job {self.id} phase {name} took {phase['seconds']}s")
+
+    def run(self, fn: Callable):
+        self.status = "running"
+        self.started_at = time.time()
+        self.save()
+        if self.profile is not None:
+            self.profiler = RunProfiler(profile_dir, self.id)
+            self.profiler.start()
+        try:
+            self.result = fn(self)
+            self.status = "succeeded"
+        except Exception:
+            self.error = traceback.format_exc()
+            self.status = "failed"
+            logging.error(f"Job {self.id} failed: {self.error}")
+        finally:
+            if self.profiler is not None:
+                self.profile = self.profiler.stop()
+                self.profiler = None
+                logging.info(f"Job {self.id} profile written to {self.profile}")
+            self.finished_at = time.time()
+            self.save()
+
+
+class JobRunner:
+    """Runs pipeline functions as jobs, within the request or on the worker
+
+    With a Cloud Tasks queue, `enqueue` records the job and hands it to the
+    worker service, which runs it with `resume`; job state then has to be in
+    a store every service shares.
+    """
+
+    def __init__(self, store=None, queue: str = task_queue):
+        self.store = store if store is not None else get_job_store()
+        self.queue = queue
+        if queue and isinstance(self.store, LocalJobStore):
+            raise ValueError("KLAVIYO_TASK_QUEUE needs KLAVIYO_JOBS_BUCKET")
+
+    def enqueue(self, name: str, profile: bool = False) -> Job:
+        """Record a queued job and hand it to the worker service"""
+        job = Job(self.store, name, profile)
+        get_tasks_client().create_task(
+            parent=self.queue,
+            task={
+                "app_engine_http_request": {
+                    "http_method": "POST",
+                    "relative_uri": f"/jobs/{job.id}/run",
+                    "app_engine_routing": {"service": worker_service},
+                },
+                "dispatch_deadline": timedelta(seconds=task_deadline),
+            },
+        )
+        logging.info(f"Job {job.id} queued on {self.queue}")
+        return job
+
+    def run(self, fn: Callable, name: str = None, profile: bool = False) -> Job:
+        """Run `fn(job)` on the calling thread, still recording the job"""
+        job = Job(self.store, name or fn.__name__, profile)
+        job.run(fn)
+        return job
+
+    def resume(self, job_id: str, fn: Callable) -> Optional[Job]:
+        """Run the queued job `job_id` as `fn(job)`, or None if it is unknown
+
+        A retried job runs again from the start under the same id.
+        """
+        state = self.get(job_id)
+        if state is None:
+            return None
+        job = Job(
+            self.store,
+            state["name"],
+            state["profile"] is not None,
+            job_id,
+            state["created_at"],
+        )
+        job.run(fn)
+        return job
+
+    def get(self, job_id: str) -> Optional[dict]:
+        """State of a job started by any process sharing the store"""
+        if not all(char in "0123456789abcdef" for char in job_id):
+            return None
+        return self.store.read(job_id)
@@ -1,14 +1,22 @@
-import pandas as pd
-from flask import Flask
-from google.cloud import bigquery
+from flask import Flask, Response, jsonify, request, url_for
 import os
 from dotenv import load_dotenv
-from data import get_data
-from utils import calculate_rate_metric
+from accounts import default_account, fetch_all_accounts, load_accounts
+from instrumentation import registry
+from jobs import Job, JobRunner
+from profiling import profiling_enabled
+from warehouse import (
+    build_rows,
+    ensure_table,
+    get_client,
+    klaviyo_schema,
+    upsert_rows,
+)
 from datetime import datetime
 import tzlocal
 import traceback
 import sys
+import json
 import logging
 
 # Run flask app with one default URL and other with 'append_data' which will be scheduled
@@ -22,6 +30,8 @@ os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = "klaviyo-423610-43cd801744ab.json
 table_name = os.environ.get("TABLE_NAME", "")
 app.config["TIMEOUT"] = 600
 
+job_runner = JobRunner()
+
 @app.route("/")
 def hello_klaviyo():
     try:
@@ -30,190 +40,95 @@ def hello_klaviyo():
         return str(e)
 
 
-@app.route("/append_klaviyo_data")
-def append_klaviyo_data():
-    """Return a friendly HTTP greeting."""
-    try:
-        client = bigquery.Client()
-        metrics = get_data()
-        (
-            delivered_email_count,
-            bounced_email_count,
-            spam_email_count,
-            dropped_email_count,
-            opened_email_count,
-            clicked_email_count,
-            unsubscribed_count,
-            conversion_active_on_site_count,
-            conversion_viewed_product_count,
-            revenue_unique_count,
-            total_revenue_count,
-            total_order_count,
-            delivered_email_unique_count,
-            revenue_count,
-            subscriber_count,
-            new_subscriber_count,
-        ) = metrics
-
-        total_recipients = (
-            delivered_email_count
-            + bounced_email_count
-            + spam_email_count
-            + dropped_email_count
-        )
-        open_rate = calculate_rate_metric(opened_email_count, delivered_email_count)
+def load_klaviyo_data(job: Job) -> str:
+    """Compute today's metrics for every account and upsert them into BigQuery
 
-        click_rate = calculate_rate_metric(clicked_email_count, delivered_email_count)
+    Accounts that fail are reported after the others have been written. A
+    structured summary of the run is logged when it ends.
+    """
+    before = registry.snapshot()
+    try:
+        return load_accounts_data(job)
+    finally:
+        summary = {
+            "job_id": job.id,
+            "phases": {phase["name"]: phase["seconds"] for phase in job.phases},
+            "instrumentation": registry.summarize(registry.delta(before)),
+        }
+        logging.info(f"Klaviyo run summary {json.dumps(summary)}")
 
-        unsubscribed_rate = calculate_rate_metric(unsubscribed_count, total_recipients)
 
-        bounce_rate = calculate_rate_metric(bounced_email_count, total_recipients)
-        delivery_rate = calculate_rate_metric(delivered_email_count, total_recipients)
-        conversion_active_on_site_rate = calculate_rate_metric(
-            conversion_active_on_site_count, delivered_email_count
-        )
-        conversion_viewed_product_rate = calculate_rate_metric(
-            conversion_viewed_product_count, delivered_email_count
-        )
-        revenue_per_email = (
-            revenue_count / delivered_email_count if delivered_email_count != 0 else 0
-        )
-        product_purchase_rate = calculate_rate_metric(
-            revenue_unique_count, delivered_email_unique_count
-        )
-        average_order_value = (
-            total_revenue_count / total_order_count if total_order_count != 0 else 0
-        )
+def load_accounts_data(job: Job) -> str:
+    accounts = load_accounts()
+    with job.phase("get_data"):
+        results, errors = fetch_all_accounts(accounts)
 
+    with job.phase("build_rows"):
         local_timezone = tzlocal.get_localzone()
         current_time = datetime.now(local_timezone)
-        date = current_time.strftime("%m-%d-%Y")
-
-        results = {
-            "date": [date, date],
-            "title": ["Active on Site", "Viewed Product"],
-            "open_rate": [open_rate, open_rate],
-            "click_rate": [click_rate, click_rate],
-            "unsubscribed_rate": [unsubscribed_rate, unsubscribed_rate],
-            "bounce_rate": [bounce_rate, bounce_rate],
-            "delivery_rate": [delivery_rate, delivery_rate],
-            "conversion_rate": [
-                conversion_active_on_site_rate,
-                conversion_viewed_product_rate,
-            ],
-            "revenue_per_email": [revenue_per_email, revenue_per_email],
-            "product_purchase_rate": [product_purchase_rate, product_purchase_rate],
-            "average_order_value": [average_order_value, average_order_value],
-            "new_subscribers": [new_subscriber_count, new_subscriber_count],
-            "subscriber_counts": [subscriber_count, subscriber_count],
-        }
+        date = current_time.date()
 
-        schema = [
-            bigquery.SchemaField("date", "STRING"),
-            bigquery.SchemaField("title", "STRING"),
-            bigquery.SchemaField("open_rate", "FLOAT"),
-            bigquery.SchemaField("click_rate", "FLOAT"),
-            bigquery.SchemaField("unsubscribed_rate", "FLOAT"),
-            bigquery.SchemaField("bounce_rate", "FLOAT"),
-            bigquery.SchemaField("delivery_rate", "FLOAT"),
-            bigquery.SchemaField("conversion_rate", "FLOAT"),
-            bigquery.SchemaField("revenue_per_email", "FLOAT"),
-            bigquery.SchemaField("product_purchase_rate", "FLOAT"),
-            bigquery.SchemaField("average_order_value", "FLOAT"),
-            bigquery.SchemaField("new_subscribers", "INTEGER"),
-            bigquery.SchemaField("subscriber_counts", "INTEGER"),
-        ]
-
-        klaviyo_df = pd.DataFrame(results)
-
-        # Check if the table exists, create if not
-        table_ref = client.dataset(dataset_id).table(table_name)
-        try:
-            table = client.get_table(table_ref)
-            print(f"Table {table_name} exists.")
-            # Check if the existing schema matches the provided schema
-            if table.schema == schema:
-                print(f"Schema for table {table_name} exists and matches the provided schema.")
-            else:
-                # Update the table schema if it doesn't match
-                table.schema = schema
-                client.update_table(table, ["schema"])
-                print(f"Updated schema for table {table_name}.")
-        except:
-            table = bigquery.Table(table_ref, schema=schema)
-            table = client.create_table(table)
-
-            if table.schema == schema:
-                print(
-                    f"Schema for table {table_name} exists and matches the provided schema."
+        rows = []
+        for account in accounts:
+            if account["name"] in results:
+                rows.extend(
+                    build_rows(account["name"], date, results[account["name"]])
                 )
-            else:
-                # Update the table schema if it doesn't match
-                table.schema = schema
-                client.update_table(table, ["schema"])
-                print(f"Updated schema for table {table_name}.")
 
-            print(f"Created table {table_name}.")
+    if rows:
+        client = get_client()
+        table_id = f"{project_id}.{dataset_id}.{table_name}"
+        with job.phase("ensure_table"):
+            ensure_table(
+                client, table_id, klaviyo_schema, defaults={"account": default_account}
+            )
+
+        # Upsert today's rows for all accounts in one idempotent MERGE
+        with job.phase("upsert"):
+            merge_job = upsert_rows(client, table_id, rows, klaviyo_schema)
+        print(
+            f"Merged {len(rows)} rows for {len(results)} accounts into {table_name} "
+            f"({merge_job.num_dml_affected_rows} affected)"
+        )
+        logging.info(
+            f"Merged {len(rows)} rows for {len(results)} accounts into {table_name} "
+            f"({merge_job.num_dml_affected_rows} affected)"
+        )
 
-        temp_table_name = "temp_klaviyo"
+    if errors:
+        raise RuntimeError(f"Klaviyo accounts failed: {errors}")
+    return "Klaviyo Results Logged!"
 
-        job_config = bigquery.LoadJobConfig()
 
-        # Load data into temp_klaviyo table
-        job = client.load_table_from_dataframe(
-            klaviyo_df,
-            f"{project_id}.{dataset_id}.{temp_table_name}",
-            job_config=job_config,
+@app.route("/append_klaviyo_data")
+def append_klaviyo_data():
+    """Start a Klaviyo load and report its job
+
+    With KLAVIYO_TASK_QUEUE, the load is queued for the worker service and
+    the request answers 202 at once with a job id to poll at /jobs/<job_id>.
+    Otherwise it runs within the request, answering 200 when it succeeds and
+    500 when it fails. Pass ?profile=1 (or set KLAVIYO_PROFILE) to capture a
+    CPU and allocation profile of the run.
+    """
+    try:
+        profile = request.args.get("profile", "").lower() in ("1", "true")
+        profile = profiling_enabled or profile
+        if not job_runner.queue:
+            job = job_runner.run(load_klaviyo_data, profile=profile)
+            status_code = 200 if job.status == "succeeded" else 500
+            return jsonify(job.to_dict()), status_code
+
+        job = job_runner.enqueue("load_klaviyo_data", profile=profile)
+        return (
+            jsonify(
+                {
+                    "job_id": job.id,
+                    "status": job.status,
+                    "status_url": url_for("job_status", job_id=job.id),
+                }
+            ),
+            202,
         )
-        job.result()
-        print(f"Loaded {klaviyo_df.shape[0]} rows into {temp_table_name}")
-        logging.info(f"Loaded {klaviyo_df.shape[0]} rows into {temp_table_name}")
-
-        # Merge the temp_klaviyo table into the main table
-        merge_query = f"""
-        MERGE `{project_id}.{dataset_id}.{table_name}` T
-        USING (SELECT DISTINCT * FROM `{project_id}.{dataset_id}.{temp_table_name}`) S
-        ON T.date = S.date AND T.title = S.title
-        WHEN MATCHED THEN
-            UPDATE SET
-                T.open_rate = S.open_rate,
-                T.click_rate = S.click_rate,
-                T.unsubscribed_rate = S.unsubscribed_rate,
-                T.bounce_rate = S.bounce_rate,
-                T.delivery_rate = S.delivery_rate,
-                T.conversion_rate = S.conversion_rate,
-                T.revenue_per_email = S.revenue_per_email,
-                T.product_purchase_rate = S.product_purchase_rate,
-                T.average_order_value = S.average_order_value,
-                T.new_subscribers = S.new_subscribers,
-                T.subscriber_counts = S.subscriber_counts
-        WHEN NOT MATCHED THEN
-            INSERT (date, title, open_rate, click_rate, unsubscribed_rate, delivery_rate, bounce_rate, conversion_rate, revenue_per_email, product_purchase_rate, average_order_value, new_subscribers, subscriber_counts)
-            VALUES (S.date, S.title, S.open_rate, S.click_rate, S.unsubscribed_rate, S.delivery_rate, S.bounce_rate, S.conversion_rate, S.revenue_per_email, S.product_purchase_rate, S.average_order_value, S.new_subscribers, S.subscriber_counts);
-        """
-
-        merge_job = client.query(merge_query)
-        merge_job.result()
-        print(f"Merged data from {temp_table_name} into {table_name}")
-        logging.info(f"Merged data from {temp_table_name} into {table_name}")
-
-        # Remove duplicates (if any) from the table
-        dedup_query = f"""
-        CREATE OR REPLACE TABLE `{project_id}.{dataset_id}.{table_name}` AS
-        SELECT DISTINCT date, title, open_rate, click_rate, unsubscribed_rate, delivery_rate, bounce_rate, conversion_rate, revenue_per_email, product_purchase_rate, average_order_value, new_subscribers, subscriber_counts
-        FROM `{project_id}.{dataset_id}.{table_name}`;
-        """
-        dedup_job = client.query(dedup_query)
-        dedup_job.result()
-        print(f"Removed duplicates from {table_name}")
-        logging.info(f"Removed duplicates from {table_name}")
-
-        # Delete the temp_klaviyo table
-        client.delete_table(f"{project_id}.{dataset_id}.{temp_table_name}")
-        print(f"Deleted table {temp_table_name}")
-        logging.info(f"Deleted table {temp_table_name}")
-
-        return "Klaviyo Results Logged!"
     except Exception as ex:
         ex_type, ex_value, ex_traceback = sys.exc_info()
         trace_back = traceback.extract_tb(ex_traceback)
@@ -225,7 +140,38 @@ def append_klaviyo_data():
         logging.error(
             f"File : {stack_trace[0]} , Line : {stack_trace[1]}, Func.Name : {stack_trace[2]}, Message : {stack_trace[3]}, Exception type: {ex_type}, Exception message: {ex_value}"
         )
-        return str(stack_trace)
+        return str(stack_trace), 500
+
+
+@app.route("/metrics")
+def prometheus_metrics():
+    """Request, scan, job phase and BigQuery instrumentation of this worker"""
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/jobs/<job_id>")
+def job_status(job_id: str):
+    """Status, phase timings and result of a queued Klaviyo load"""
+    job = job_runner.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Unknown job {job_id}"}), 404
+    return jsonify(job)
+
+
+@app.route("/jobs/<job_id>/run", methods=["POST"])
+def run_job(job_id: str):
+    """Run a queued Klaviyo load on the worker service, as Cloud Tasks sends it
+
+    Answers 500 when the load fails, so the queue retries it.
+    """
+    # App Engine drops this header from requests that do not come from a queue
+    if not request.headers.get("X-AppEngine-QueueName"):
+        return jsonify({"error": "Jobs are only run from the task queue"}), 403
+    job = job_runner.resume(job_id, load_klaviyo_data)
+    if job is None:
+        return jsonify({"error": f"Unknown job {job_id}"}), 404
+    return jsonify(job.to_dict()), 200 if job.status == "succeeded" else 500
+
 
 if __name__ == "__main__":
     # This is used when running locally only. When deploying to Google App
@@ -0,0 +1,40 @@
+import argparse
+import logging
+import os
+import sys
+
+from dotenv import load_dotenv
+
+from accounts import default_account
+from warehouse import ensure_table, get_client, klaviyo_schema, migrate_to_partitioned
+
+
+def main(argv: list = None) -> int:
+    load_dotenv()
+    parser = argparse.ArgumentParser(
+        description="Rebuild the Klaviyo table as a date-partitioned, clustered "
+        "table, keeping the original as <table>_legacy"
+    )
+    parser.add_argument(
+        "--table",
+        default=(
+            f"{os.environ.get('PROJECT_ID', '')}.{os.environ.get('DATASET_ID', '')}"
+            f".{os.environ.get('TABLE_NAME', '')}"
+        ),
+        help="project.dataset.table (default: from PROJECT_ID, DATASET_ID, TABLE_NAME)",
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    client = get_client()
+    migrate_to_partitioned(client, args.table)
+    # New columns, their defaults and the clustering, as a load would
+    ensure_table(
+        client, args.table, klaviyo_schema, defaults={"account": default_account}
+    )
+    print(f"{args.table} is partitioned on date and up to date")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
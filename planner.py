@@ -0,0 +1,108 @@
+from concurrent.futures import Executor, Future
+
+from incremental import IncrementalAggregateStore
+from utils import get_metrics
+
+
+def split_measurements(report_results, measurement: tuple):
+    """Keep only `measurement` in each row of a merged aggregate response"""
+    if not isinstance(report_results, list):
+        return report_results
+    rows = []
+    for row in report_results:
+        if isinstance(row, dict) and isinstance(row.get("measurements"), dict):
+            row = dict(row)
+            row["measurements"] = {
+                name: values
+                for name, values in row["measurements"].items()
+                if name in measurement
+            }
+        rows.append(row)
+    return rows
+
+
+class AggregateQueryPlanner:
+    """Coalesce metric-aggregate queries that only differ in measurement
+
+    Queries are collected with `add` as (metric_id, by, measurement, filter).
+    Identical queries are deduplicated and queries sharing metric, grouping
+    and filter are merged into one request asking for all of their
+    measurements; `execute` splits each response back out per query.
+    """
+
+    def __init__(self):
+        self.groups = {}
+
+    def add(self, metric_id: str, by: list, measurement: list, filter: list) -> tuple:
+        """Register a query, returning the key of its result in `execute`"""
+        group_key = (metric_id, tuple(by), tuple(sorted(filter)))
+        group = self.groups.setdefault(
+            group_key, {"by": list(by), "filter": list(filter), "queries": []}
+        )
+        query_key = group_key + (tuple(measurement),)
+        if query_key not in group["queries"]:
+            group["queries"].append(query_key)
+        return query_key
+
+    def execute(
+        self,
+        executor: Executor,
+        url: str,
+        klaviyo_api_key: str,
+        incremental_store: IncrementalAggregateStore = None,
+    ) -> dict:
+        """Submit one request per merged group, returning a Future per query key
+
+        With an `incremental_store`, additive queries in a group are sent as a
+        separate request answered from the store's daily partials.
+        """
+        futures = {}
+        for (metric_id, _, _), group in self.groups.items():
+            batches = {get_metrics: []}
+            for query_key in group["queries"]:
+                futures[query_key] = Future()
+                fetch = get_metrics
+                if incremental_store is not None and incremental_store.supports(
+                    query_key[-1], group["filter"]
+                ):
+                    fetch = incremental_store.get_metrics
+                batches.setdefault(fetch, []).append(query_key)
+
+            for fetch, queries in batches.items():
+                if not queries:
+                    continue
+                measurement = []
+                for query_key in queries:
+                    measurement.extend(
+                        name for name in query_key[-1] if name not in measurement
+                    )
+                request = executor.submit(
+                    fetch,
+                    group["by"],
+                    metric_id,
+                    url,
+                    measurement,
+                    group["filter"],
+                    klaviyo_api_key,
+                )
+                request.add_done_callback(
+                    lambda request, queries=queries: self.resolve(
+                        request, queries, futures
+                    )
+                )
+        return futures
+
+    @staticmethod
+    def resolve(request: Future, queries: list, futures: dict):
+        if request.cancelled():
+            for query_key in queries:
+                futures[query_key].cancel()
+            return
+        error = request.exception()
+        for query_key in queries:
+            if error is not None:
+                futures[query_key].set_exception(error)
+            else:
+                futures[query_key].set_result(
+                    split_measurements(request.result(), query_key[-1])
+                )
@@ -0,0 +1,115 @@
+from array import array
+from datetime import datetime, timezone
+from typing import Iterable
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# Email marketing consent states by their uint8 code; anything else is 0
+CONSENT_STATES = ("", "SUBSCRIBED", "UNSUBSCRIBED", "NEVER_SUBSCRIBED")
+consent_codes = {state: code for code, state in enumerate(CONSENT_STATES)}
+
+# Timestamps parsed together; parsing is batched across pages of 100
+parse_batch_size = 10_000
+
+# Stored for a missing or unparseable timestamp, so it is never "before" anything
+MISSING_TIMESTAMP = np.iinfo(np.int64).max
+
+
+def parse_timestamps_us(timestamps: list) -> np.ndarray:
+    """ISO 8601 timestamps as int64 UTC epoch microseconds, parsed as one batch
+
+    Missing or unparseable ones become MISSING_TIMESTAMP.
+    """
+    values = pa.array(timestamps, type=pa.string())
+    parsed = pc.strptime(
+        values, format="%Y-%m-%dT%H:%M:%S%z", unit="us", error_is_null=True
+    )
+    epoch_us = (
+        pc.fill_null(parsed.cast(pa.int64()), MISSING_TIMESTAMP)
+        .to_numpy(zero_copy_only=False)
+        .copy()
+    )
+    # Rare formats the fast path rejects (e.g. fractional seconds)
+    unparsed = pc.and_(pc.is_null(parsed), pc.is_valid(values))
+    for index in np.flatnonzero(unparsed.to_numpy(zero_copy_only=False)):
+        try:
+            moment = datetime.fromisoformat(timestamps[index]).astimezone(timezone.utc)
+        except ValueError:
+            continue
+        epoch_us[index] = round(moment.timestamp() * 1_000_000)
+    return epoch_us
+
+
+def marketing_consent(profile: dict) -> dict:
+    try:
+        marketing = profile["attributes"]["subscriptions"]["email"]["marketing"]
+    except (KeyError, TypeError):
+        return {}
+    return marketing if isinstance(marketing, dict) else {}
+
+
+class ProfileColumns:
+    """Consent state and consent timestamp of scanned profiles as typed columns
+
+    Each page of profiles is reduced to a uint8 consent code and an int64
+    epoch-microsecond timestamp per profile (9 bytes) as it arrives, so the
+    nested profile dicts never outlive their page. Timestamp strings wait
+    for at most parse_batch_size profiles before being parsed.
+    """
+
+    def __init__(self):
+        self.consent = array("B")
+        self.consent_timestamp = array("q")
+        self.pending = []
+
+    def __len__(self) -> int:
+        return len(self.consent)
+
+    @property
+    def nbytes(self) -> int:
+        self.flush()
+        size = self.consent.itemsize * len(self.consent)
+        size += self.consent_timestamp.itemsize * len(self.consent_timestamp)
+        return size
+
+    def extend(self, profiles: list):
+        """Append one page of profile records"""
+        codes = bytearray(len(profiles))
+        pending = self.pending
+        for index, profile in enumerate(profiles):
+            try:
+                marketing = profile["attributes"]["subscriptions"]["email"]["marketing"]
+                codes[index] = consent_codes.get(marketing["consent"], 0)
+                pending.append(marketing["consent_timestamp"])
+            except (KeyError, TypeError):
+                marketing = marketing_consent(profile)
+                codes[index] = consent_codes.get(marketing.get("consent"), 0)
+                pending.append(marketing.get("consent_timestamp"))
+        self.consent.frombytes(codes)
+        if len(self.pending) >= parse_batch_size:
+            self.flush()
+
+    def flush(self):
+        """Parse the timestamps still held as strings"""
+        if self.pending:
+            parsed = parse_timestamps_us(self.pending)
+            self.consent_timestamp.frombytes(parsed.tobytes())
+            self.pending = []
+
+    @classmethod
+    def from_pages(cls, pages: Iterable[list]):
+        columns = cls()
+        for page in pages:
+            columns.extend(page)
+        return columns
+
+    def count_consented_before(self, cutoff: datetime, consent: str = "SUBSCRIBED"):
+        """Profiles in `consent` state whose consent timestamp is before `cutoff`"""
+        self.flush()
+        cutoff_us = round(cutoff.timestamp() * 1_000_000)
+        timestamps = np.frombuffer(self.consent_timestamp, dtype=np.int64)
+        consents = np.frombuffer(self.consent, dtype=np.uint8)
+        mask = (timestamps < cutoff_us) & (consents == consent_codes[consent])
+        return int(np.count_nonzero(mask))
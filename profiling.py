@@ -0,0 +1,206 @@
+import cProfile
+import io
+import os
+import pstats
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, Optional
+
+# Profile every run, as if ?profile=1 was passed
+profiling_enabled = os.environ.get("KLAVIYO_PROFILE", "").lower() in ("1", "true")
+profile_dir = os.environ.get(
+    "KLAVIYO_PROFILE_DIR", os.path.join(tempfile.gettempdir(), "klaviyo_profiles")
+)
+
+# Functions and allocation sites listed per section of the report
+profile_top = int(os.environ.get("KLAVIYO_PROFILE_TOP", "25"))
+
+# Stack frames kept per traced allocation
+traceback_frames = 10
+
+# The run profiler of the current thread, if it runs profiled work
+_active = threading.local()
+
+
+class RunProfiler:
+    """cProfile and tracemalloc capture of one pipeline run, tagged by phase
+
+    The calling thread is profiled from `start` to `stop`. Work the run
+    hands to other threads is profiled only when wrapped with `profiled`
+    (or submitted to a ProfiledThreadPoolExecutor), each thread into its
+    own cProfile profiler for the phase that was running when the work was
+    handed over, enabled only while that work runs. `stop` writes
+    <run_id>.prof with the whole run, <run_id>.<phase>.prof per phase and
+    <run_id>.txt with the top functions and allocation sites per phase.
+    """
+
+    def __init__(self, path: str, run_id: str, top: int = profile_top):
+        self.path = path
+        self.run_id = run_id
+        self.top = top
+        self.phase = "run"
+        self.profilers = {}
+        self.thread_profilers = {}
+        self.current = None
+        self.sections = []
+        self.started = None
+        self.owns_tracemalloc = False
+        self.lock = threading.Lock()
+
+    def add_profiler(self, phase: str) -> cProfile.Profile:
+        profiler = cProfile.Profile()
+        with self.lock:
+            self.profilers.setdefault(phase, []).append(profiler)
+        return profiler
+
+    def thread_profiler(self, phase: str) -> cProfile.Profile:
+        """This thread's profiler for `phase`, reused across its tasks"""
+        key = (threading.get_ident(), phase)
+        profiler = self.thread_profilers.get(key)
+        if profiler is None:
+            profiler = self.thread_profilers[key] = self.add_profiler(phase)
+        return profiler
+
+    def profiled(self, fn: Callable) -> Callable:
+        """Wrap `fn` to be profiled into the current phase on whatever thread"""
+        phase = self.phase
+
+        @wraps(fn)
+        def run(*args, **kwargs):
+            profiler = self.thread_profiler(phase)
+            previous = getattr(_active, "profiler", None)
+            _active.profiler = self
+            profiler.enable()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                profiler.disable()
+                _active.profiler = previous
+
+        return run
+
+    def switch(self, phase: str):
+        """Profile the run thread into `phase` from now on"""
+        if self.current is not None:
+            self.current.disable()
+        self.phase = phase
+        self.current = self.add_profiler(phase)
+        self.current.enable()
+
+    def start(self):
+        self.started = time.perf_counter()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(traceback_frames)
+            self.owns_tracemalloc = True
+        _active.profiler = self
+        self.switch("run")
+
+    @contextmanager
+    def tag(self, phase: str):
+        """Attribute CPU time and allocations inside the block to `phase`"""
+        previous = self.phase
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        started = time.perf_counter()
+        self.switch(phase)
+        try:
+            yield
+        finally:
+            self.current.disable()
+            seconds = time.perf_counter() - started
+            _, peak = tracemalloc.get_traced_memory()
+            growth = tracemalloc.take_snapshot().compare_to(before, "lineno")
+            self.sections.append((phase, seconds, peak, growth[: self.top]))
+            self.switch(previous)
+
+    def stats(self, profilers: list) -> pstats.Stats:
+        stats = pstats.Stats(profilers[0])
+        for profiler in profilers[1:]:
+            stats.add(profiler)
+        return stats
+
+    def top_functions(self, stats: pstats.Stats) -> str:
+        out = io.StringIO()
+        stats.stream = out
+        stats.sort_stats("cumulative").print_stats(self.top)
+        return out.getvalue()
+
+    def stop(self) -> list:
+        """Stop profiling and write the artifacts, returning their paths"""
+        _active.profiler = None
+        self.current.disable()
+        seconds = time.perf_counter() - self.started
+        current, peak = tracemalloc.get_traced_memory()
+        # Each phase resets the traced peak
+        peak = max([peak] + [section[2] for section in self.sections])
+        remaining = tracemalloc.take_snapshot().statistics("lineno")[: self.top]
+        if self.owns_tracemalloc:
+            tracemalloc.stop()
+
+        os.makedirs(self.path, exist_ok=True)
+        paths = []
+        with self.lock:
+            phases = {
+                phase: list(profilers) for phase, profilers in self.profilers.items()
+            }
+        stats = self.stats(
+            [profiler for profilers in phases.values() for profiler in profilers]
+        )
+        paths.append(os.path.join(self.path, f"{self.run_id}.prof"))
+        stats.dump_stats(paths[-1])
+        report = [
+            f"Run {self.run_id}: {seconds:.3f}s, traced memory "
+            f"{current / 2**20:.1f} MiB, peak {peak / 2**20:.1f} MiB",
+            "",
+            self.top_functions(stats),
+        ]
+        for phase, phase_seconds, phase_peak, growth in self.sections:
+            phase_stats = self.stats(phases[phase])
+            paths.append(os.path.join(self.path, f"{self.run_id}.{phase}.prof"))
+            phase_stats.dump_stats(paths[-1])
+            report += [
+                f"Phase {phase}: {phase_seconds:.3f}s, "
+                f"peak {phase_peak / 2**20:.1f} MiB",
+                "",
+                f"Top {self.top} allocation sites by growth:",
+                *[str(difference) for difference in growth],
+                "",
+                self.top_functions(phase_stats),
+            ]
+        report += [
+            f"Top {self.top} allocation sites still live at the end:",
+            *[str(statistic) for statistic in remaining],
+        ]
+        paths.append(os.path.join(self.path, f"{self.run_id}.txt"))
+        with open(paths[-1], "w") as f:
+            f.write("\n".join(report) + "\n")
+        return paths
+
+
+def active_profiler() -> Optional[RunProfiler]:
+    """Profiler of the run executing on this thread, if it is profiled"""
+    return getattr(_active, "profiler", None)
+
+
+def profiled(fn: Callable) -> Callable:
+    """`fn` profiled into this thread's run wherever it runs, if there is one"""
+    profiler = active_profiler()
+    return fn if profiler is None else profiler.profiled(fn)
+
+
+class ProfiledThreadPoolExecutor(ThreadPoolExecutor):
+    """Thread pool whose tasks are profiled into the run that created it"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.profiler = active_profiler()
+
+    def submit(self, fn, /, *args, **kwargs):
+        if self.profiler is not None:
+            fn = self.profiler.profiled(fn)
+        return super().submit(fn, *args, **kwargs)
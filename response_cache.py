@@ -0,0 +1,237 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, datetime, timezone
+from typing import Optional
+
+# Set to 0 to send every request to the API
+response_cache_enabled = os.environ.get("KLAVIYO_RESPONSE_CACHE", "1").lower() in (
+    "1",
+    "true",
+)
+response_cache_dir = os.environ.get(
+    "KLAVIYO_RESPONSE_CACHE_DIR",
+    os.path.join(tempfile.gettempdir(), "klaviyo_response_cache"),
+)
+# On App Engine standard /tmp is in-memory and counts against instance RAM,
+# so the disk tier is off there unless sized explicitly
+on_app_engine = os.environ.get("GAE_ENV", "").startswith("standard")
+response_cache_memory_bytes = (
+    int(os.environ.get("KLAVIYO_RESPONSE_CACHE_MEMORY_MB", "16")) * 1024 * 1024
+)
+response_cache_disk_bytes = (
+    int(
+        os.environ.get(
+            "KLAVIYO_RESPONSE_CACHE_DISK_MB", "0" if on_app_engine else "32"
+        )
+    )
+    * 1024
+    * 1024
+)
+
+# Seconds an aggregate over a window that includes today is reused
+open_ttl = int(os.environ.get("KLAVIYO_RESPONSE_CACHE_OPEN_TTL", "900"))
+
+window_end_pattern = re.compile(r"^less-than\(datetime,([0-9-]{10})\)$")
+
+
+def canonical_key(*parts) -> str:
+    """sha256 of the parts serialized as canonical JSON"""
+    return hashlib.sha256(
+        json.dumps(parts, sort_keys=True, separators=(",", ":")).encode()
+    ).hexdigest()
+
+
+def account_id(klaviyo_api_key: str) -> str:
+    return hashlib.sha256(klaviyo_api_key.encode()).hexdigest()[:16]
+
+
+def aggregate_key(
+    klaviyo_api_key: str,
+    metric_id: str,
+    by: list,
+    measurement: list,
+    filter: list,
+    interval: str,
+) -> str:
+    """Key of a metric-aggregate query; filter conditions are ANDed, so unordered"""
+    return canonical_key(
+        "metric-aggregate",
+        account_id(klaviyo_api_key),
+        metric_id,
+        list(by),
+        sorted(measurement),
+        sorted(filter),
+        interval,
+    )
+
+
+def metrics_key(klaviyo_api_key: str, day: date, settings: dict) -> str:
+    """Key of the Metrics computed for one account, local day and settings"""
+    return canonical_key(
+        "metrics", account_id(klaviyo_api_key), day.isoformat(), settings
+    )
+
+
+def aggregate_ttl(filter: list, today: date = None) -> Optional[int]:
+    """None (cache forever) for a window closed before today, else open_ttl
+
+    Klaviyo reads bare filter dates as UTC.
+    """
+    today = today or datetime.now(timezone.utc).date()
+    for condition in filter:
+        match = window_end_pattern.match(condition)
+        if match and date.fromisoformat(match.group(1)) <= today:
+            return None
+    return open_ttl
+
+
+class ResponseCache:
+    """Klaviyo responses and Metrics by key, in an LRU memory tier over a disk tier
+
+    Entries are JSON values with an optional expiry. Both tiers are bounded
+    in bytes and evict the least recently used entries first; the disk tier
+    is shared by every process using `path`, and off with `disk_bytes` 0.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        memory_bytes: int = response_cache_memory_bytes,
+        disk_bytes: int = response_cache_disk_bytes,
+    ):
+        self.path = path
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.entries = OrderedDict()
+        self.memory_size = 0
+        self.disk_size = None
+        self.lock = threading.Lock()
+
+    def file_path(self, key: str) -> str:
+        return os.path.join(self.path, key[:2], f"{key}.json")
+
+    def get(self, key: str):
+        """Cached value for `key`, or None when missing or expired"""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expires, text = entry
+                if expires is None or now < expires:
+                    self.entries.move_to_end(key)
+                    return json.loads(text)
+                self.drop_memory(key)
+        if not self.disk_bytes:
+            return None
+
+        file_path = self.file_path(key)
+        try:
+            with open(file_path) as f:
+                cached = json.load(f)
+            expires = cached["expires"]
+            if expires is not None and now >= expires:
+                os.remove(file_path)
+                raise KeyError(key)
+            # Reads count as use for the disk LRU
+            os.utime(file_path)
+        except (OSError, ValueError, KeyError):
+            return None
+
+        with self.lock:
+            self.remember(key, expires, json.dumps(cached["value"]))
+        return cached["value"]
+
+    def put(self, key: str, value, ttl: Optional[int] = None):
+        """Store `value`, forever or for `ttl` seconds"""
+        expires = None if ttl is None else time.time() + ttl
+        text = json.dumps(value)
+        with self.lock:
+            self.remember(key, expires, text)
+        if not self.disk_bytes:
+            return
+
+        file_path = self.file_path(key)
+        directory = os.path.dirname(file_path)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                f.write(f'{{"expires": {json.dumps(expires)}, "value": {text}}}')
+            os.replace(tmp_path, file_path)
+        except OSError as e:
+            logging.error(f"Error writing response cache entry {key}: {e}")
+            return
+        with self.lock:
+            if self.disk_size is not None:
+                self.disk_size += os.path.getsize(file_path)
+        self.evict_disk()
+
+    def remember(self, key: str, expires: Optional[float], text: str):
+        """Insert into the memory tier, evicting from its cold end (lock held)"""
+        self.drop_memory(key)
+        if len(text) > self.memory_bytes:
+            return
+        self.entries[key] = (expires, text)
+        self.memory_size += len(text)
+        while self.memory_size > self.memory_bytes:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.memory_size -= len(evicted)
+
+    def drop_memory(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.memory_size -= len(entry[1])
+
+    def cache_files(self) -> list:
+        """(last used, size, path) of every file in the disk tier"""
+        files = []
+        for root, _, names in os.walk(self.path):
+            for name in names:
+                file_path = os.path.join(root, name)
+                try:
+                    stat = os.stat(file_path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, file_path))
+        return files
+
+    def evict_disk(self):
+        """Delete least recently used files until the disk tier fits disk_bytes"""
+        with self.lock:
+            if self.disk_size is not None and self.disk_size <= self.disk_bytes:
+                return
+            files = self.cache_files()
+            self.disk_size = sum(size for _, size, _ in files)
+            if self.disk_size <= self.disk_bytes:
+                return
+            for _, size, file_path in sorted(files):
+                try:
+                    os.remove(file_path)
+                except OSError:
+                    continue
+                self.disk_size -= size
+                if self.disk_size <= self.disk_bytes:
+                    break
+            logging.info(f"Evicted response cache down to {self.disk_size} bytes")
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    """Process-level response cache, or None when disabled"""
+    global _cache
+    if not response_cache_enabled:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache(response_cache_dir)
+        return _cache
@@ -0,0 +1,110 @@
+from concurrent.futures import Executor
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+from catalog import MetricCatalog
+from incremental import IncrementalAggregateStore
+from planner import AggregateQueryPlanner
+
+
+@dataclass(frozen=True)
+class AggregateSpec:
+    """Sum of one aggregate measurement of a metric into a target counter
+
+    `dimensions(row_dimensions, context)` optionally selects which result
+    rows are summed, e.g. only the account's report message.
+    """
+
+    metric: str
+    target: str
+    by: tuple
+    measurement: str
+    filter: tuple = ()
+    dimensions: Optional[Callable[[list, object], bool]] = None
+
+
+@dataclass(frozen=True)
+class ProfileCountSpec:
+    """Profile scan run once when the account has `metric`
+
+    `count(context)` returns a {target: value} dict.
+    """
+
+    metric: str
+    targets: tuple
+    count: Callable[[object], dict]
+
+
+class MetricPlan:
+    """Executes a registry of metric specs as one deduplicated, concurrent plan"""
+
+    def __init__(self, specs: list, window_filter: list):
+        self.specs = specs
+        self.window_filter = list(window_filter)
+
+    def targets(self) -> list:
+        targets = []
+        for spec in self.specs:
+            if isinstance(spec, ProfileCountSpec):
+                names = spec.targets
+            else:
+                names = (spec.target,)
+            targets.extend(name for name in names if name not in targets)
+        return targets
+
+    def run(
+        self,
+        catalog: MetricCatalog,
+        executor: Executor,
+        url: str,
+        klaviyo_api_key: str,
+        context: object = None,
+        incremental_store: IncrementalAggregateStore = None,
+    ) -> dict:
+        """Run every spec, returning {target: total}"""
+        planner = AggregateQueryPlanner()
+        aggregates = []
+        scans = []
+        for spec in self.specs:
+            metric_ids = catalog.ids(spec.metric)
+            if isinstance(spec, ProfileCountSpec):
+                if metric_ids:
+                    scans.append(spec)
+                continue
+            for metric_id in metric_ids:
+                query_key = planner.add(
+                    metric_id,
+                    list(spec.by),
+                    [spec.measurement],
+                    self.window_filter + list(spec.filter),
+                )
+                aggregates.append((spec, query_key))
+
+        futures = planner.execute(
+            executor, url, klaviyo_api_key, incremental_store=incremental_store
+        )
+        scan_futures = [
+            (spec, executor.submit(spec.count, context)) for spec in scans
+        ]
+
+        totals = dict.fromkeys(self.targets(), 0)
+        for spec, query_key in aggregates:
+            report_results = futures[query_key].result()
+            if not isinstance(report_results, list):
+                raise ValueError(f"{spec.target} is not a list: {report_results}")
+            for row in report_results:
+                if not (
+                    isinstance(row, dict)
+                    and "measurements" in row
+                    and spec.measurement in row["measurements"]
+                ):
+                    raise ValueError(f"Unexpected {spec.target} structure: {row}")
+                if spec.dimensions is None or spec.dimensions(
+                    row["dimensions"], context
+                ):
+                    totals[spec.target] += sum(row["measurements"][spec.measurement])
+
+        for spec, future in scan_futures:
+            for target, value in future.result().items():
+                totals[target] += value
+        return totals
@@ -0,0 +1,60 @@
+import json
+
+import pytest
+
+import accounts
+
+
+def set_accounts(monkeypatch, entries: list):
+    monkeypatch.delenv("KLAVIYO_ACCOUNTS_FILE", raising=False)
+    monkeypatch.setenv("KLAVIYO_ACCOUNTS", json.dumps(entries))
+
+
+def test_accounts_keep_their_own_message_and_segment(monkeypatch):
+    monkeypatch.setenv("KLAVIYO_API_KEY_US", "pk_us")
+    set_accounts(
+        monkeypatch,
+        [
+            {
+                "name": "us",
+                "api_key_env": "KLAVIYO_API_KEY_US",
+                "report_message_id": "A",
+            },
+            {
+                "name": "eu",
+                "api_key": "pk_eu",
+                "report_message_id": "B",
+                "subscriber_segment": "EU Subscribers",
+            },
+        ],
+    )
+    assert accounts.load_accounts() == [
+        {
+            "name": "us",
+            "api_key": "pk_us",
+            "report_message_id": "A",
+            "subscriber_segment": accounts.subscriber_segment,
+        },
+        {
+            "name": "eu",
+            "api_key": "pk_eu",
+            "report_message_id": "B",
+            "subscriber_segment": "EU Subscribers",
+        },
+    ]
+
+
+def test_account_without_report_message_is_rejected(monkeypatch):
+    set_accounts(monkeypatch, [{"name": "eu", "api_key": "pk_eu"}])
+    with pytest.raises(ValueError, match="report_message_id"):
+        accounts.load_accounts()
+
+
+def test_single_account_uses_the_configured_message(monkeypatch):
+    monkeypatch.delenv("KLAVIYO_ACCOUNTS_FILE", raising=False)
+    monkeypatch.delenv("KLAVIYO_ACCOUNTS", raising=False)
+    monkeypatch.setenv("KLAVIYO_API_KEY", "pk_default")
+    (account,) = accounts.load_accounts()
+    assert account["api_key"] == "pk_default"
+    assert account["report_message_id"] == accounts.report_message_id
+    assert account["subscriber_segment"] == accounts.subscriber_segment
@@ -0,0 +1,35 @@
+import json
+
+import pytest
+
+import decoding
+
+decoders = [False] + ([True] if decoding.orjson is not None else [])
+
+
+@pytest.fixture(params=decoders, ids=lambda use: "orjson" if use else "json")
+def use_orjson(request, monkeypatch):
+    monkeypatch.setattr(decoding, "use_orjson", request.param)
+    return request.param
+
+
+def test_loads_page(use_orjson):
+    page = {
+        "data": [{"type": "profile", "id": "P1", "attributes": {"email": "é@x.com"}}],
+        "links": {"next": None},
+    }
+    assert decoding.loads(json.dumps(page).encode()) == page
+
+
+def test_loads_top_level_array(use_orjson):
+    assert decoding.loads(b'[1, {"a": [true, null]}]') == [1, {"a": [True, None]}]
+
+
+def test_loads_str(use_orjson):
+    assert decoding.loads('{"a": 1.5}') == {"a": 1.5}
+
+
+@pytest.mark.parametrize("body", [b"", b"{", b'{"a": 1,}', b"[1] x", b"\xff"])
+def test_loads_invalid_raises_value_error(use_orjson, body):
+    with pytest.raises(ValueError):
+        decoding.loads(body)
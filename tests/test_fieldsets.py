@@ -0,0 +1,110 @@
+from datetime import datetime, timezone
+
+import pytest
+
+import data
+from fieldsets import api_url, fieldset_params
+
+BASE = "https://a.klaviyo.com/api"
+CUTOFF = datetime(2024, 5, 1, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def requested(monkeypatch):
+    """URLs the data counters request, in order, answered with canned records"""
+    urls = []
+    monkeypatch.setattr(data, "klaviyo_url", BASE)
+
+    def pages(url, key):
+        urls.append(url)
+        yield []
+
+    def segments(url, key):
+        urls.append(url)
+        return [{"id": "SEGALL", "attributes": {"name": data.subscriber_segment}}]
+
+    def segment(url, key):
+        urls.append(url)
+        return {"data": {"attributes": {"profile_count": 10}}}
+
+    def count(url, key, predicate=None):
+        urls.append(url)
+        return 0
+
+    monkeypatch.setattr(data, "iter_pagination_pages", pages)
+    monkeypatch.setattr(data, "get_pagination_metrics", segments)
+    monkeypatch.setattr(data, "get_subscribers", segment)
+    monkeypatch.setattr(data, "count_pagination_metrics", count)
+    return urls
+
+
+def context() -> data.RunContext:
+    return data.RunContext("pk", CUTOFF, timezone.utc)
+
+
+def test_unsubscribed_scan_url(requested, monkeypatch):
+    monkeypatch.setattr(
+        data,
+        "unsubscribed_filter",
+        'equals(subscriptions.email.marketing.suppression.reason,"UNSUBSCRIBE")',
+    )
+    data.count_unsubscribed(context())
+    assert requested == [
+        f"{BASE}/profiles/?additional-fields[profile]=subscriptions"
+        "&fields[profile]=subscriptions.email.marketing.consent"
+        '&filter=equals(subscriptions.email.marketing.suppression.reason,"UNSUBSCRIBE")'
+        "&page[size]=100"
+    ]
+
+
+def test_consent_scan_url(requested):
+    data.count_subscribed_before("SEGALL", context())
+    assert requested == [
+        f"{BASE}/segments/SEGALL/profiles/?additional-fields[profile]=subscriptions"
+        "&fields[profile]=subscriptions.email.marketing.consent,"
+        "subscriptions.email.marketing.consent_timestamp&page[size]=100"
+    ]
+
+
+def test_joined_scan_urls(requested):
+    data.count_joined_since("SEGALL", context())
+    data.count_joins_by_day("SEGALL", context(), CUTOFF)
+    assert requested == [
+        f"{BASE}/segments/SEGALL/profiles/?fields[profile]=external_id"
+        "&filter=greater-or-equal(joined_group_at,2024-05-01T00:00:00Z)"
+        "&page[size]=100",
+        f"{BASE}/segments/SEGALL/profiles/?fields[profile]=joined_group_at"
+        "&filter=greater-or-equal(joined_group_at,2024-05-01T00:00:00Z)"
+        "&page[size]=100",
+    ]
+
+
+def test_segment_lookup_urls(requested):
+    assert data.subscriber_segments(context()) == [("SEGALL", 10)]
+    assert requested == [
+        f"{BASE}/segments/?fields[segment]=name",
+        f"{BASE}/segments/SEGALL/?additional-fields[segment]=profile_count"
+        "&fields[segment]=name",
+    ]
+
+
+def test_additional_attribute_read_whole_is_only_an_additional_field():
+    assert fieldset_params("segment", ["attributes.profile_count"]) == [
+        ("additional-fields[segment]", "profile_count"),
+        ("fields[segment]", "name"),
+    ]
+
+
+def test_paths_inside_an_additional_attribute_narrow_fields():
+    assert fieldset_params(
+        "profile", ["id", "attributes.email", "attributes.subscriptions.sms"]
+    ) == [
+        ("additional-fields[profile]", "subscriptions"),
+        ("fields[profile]", "email,subscriptions.sms"),
+    ]
+
+
+def test_metric_catalog_url():
+    assert api_url(BASE, "metrics", "metric", ("attributes.name",)) == (
+        f"{BASE}/metrics/?fields[metric]=name"
+    )
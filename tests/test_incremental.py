@@ -0,0 +1,136 @@
+from datetime import date, timedelta
+
+import pytest
+
+import incremental
+
+TODAY = date(2024, 5, 20)
+
+
+def daily_value(day: date) -> float:
+    return float(day.toordinal() % 7 + 1)
+
+
+def window(start: date, end: date) -> list:
+    return [
+        f"greater-or-equal(datetime,{start.isoformat()})",
+        f"less-than(datetime,{end.isoformat()})",
+    ]
+
+
+class StubAggregates:
+    """get_metric_aggregates answering per-day counts, recording each range"""
+
+    def __init__(self):
+        self.ranges = []
+        self.before_reply = None
+
+    def __call__(self, by, metric_id, url, measurement, filter, key, interval):
+        assert interval == "day"
+        start, end, _ = incremental.split_window(filter)
+        self.ranges.append((start, end))
+        if self.before_reply is not None:
+            before_reply, self.before_reply = self.before_reply, None
+            before_reply()
+        days = [start + timedelta(days=n) for n in range((end - start).days)]
+        return {
+            "dates": [f"{day.isoformat()}T00:00:00+00:00" for day in days],
+            "data": [
+                {
+                    "dimensions": ["UjjW7L"],
+                    "measurements": {
+                        name: [daily_value(day) for day in days] for name in measurement
+                    },
+                }
+            ],
+        }
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    stub = StubAggregates()
+    monkeypatch.setattr(incremental, "get_metric_aggregates", stub)
+    return stub
+
+
+@pytest.fixture
+def store(tmp_path):
+    return incremental.IncrementalAggregateStore(str(tmp_path / "partials.sqlite3"))
+
+
+def get_count(store, start: date, end: date, today: date = TODAY) -> float:
+    (row,) = store.get_metrics(
+        ["$message"], "M1", "url", ["count"], window(start, end), "pk", today=today
+    )
+    assert row["dimensions"] == ["UjjW7L"]
+    return row["measurements"]["count"][0]
+
+
+def full_window_count(start: date, end: date) -> float:
+    return sum(
+        daily_value(start + timedelta(days=n)) for n in range((end - start).days)
+    )
+
+
+def test_second_run_fetches_only_days_after_the_watermark(stub, store):
+    start = date(2024, 1, 1)
+    get_count(store, start, date(2024, 5, 1), today=date(2024, 5, 1))
+    get_count(store, start, date(2024, 5, 4), today=date(2024, 5, 4))
+    assert stub.ranges[-1] == (date(2024, 5, 1), date(2024, 5, 4))
+    assert store.watermark(store.query_key("M1", ["$message"], []), "count") == (
+        start,
+        date(2024, 5, 3),
+    )
+
+
+def test_totals_equal_a_full_window_fetch(stub, store):
+    start = date(2023, 12, 1)
+    for end in (date(2024, 3, 1), date(2024, 3, 2), date(2024, 4, 15)):
+        assert get_count(store, start, end, today=end) == full_window_count(start, end)
+    # A window starting before everything stored is fetched whole again
+    earlier = date(2023, 11, 1)
+    assert get_count(store, earlier, date(2024, 4, 15), today=date(2024, 4, 15)) == (
+        full_window_count(earlier, date(2024, 4, 15))
+    )
+
+
+def test_an_older_concurrent_range_never_lowers_the_watermark(stub, store):
+    start = date(2024, 1, 1)
+    query = store.query_key("M1", ["$message"], [])
+    # The newer day finishes while the older one is still fetching
+    stub.before_reply = lambda: get_count(store, start, date(2024, 3, 1))
+    assert get_count(store, start, date(2024, 2, 1)) == full_window_count(
+        start, date(2024, 2, 1)
+    )
+    assert store.watermark(query, "count") == (start, date(2024, 2, 29))
+    assert get_count(store, start, date(2024, 3, 1)) == full_window_count(
+        start, date(2024, 3, 1)
+    )
+    assert len(stub.ranges) == 2
+
+
+def test_todays_data_is_never_stored(stub, store):
+    start = date(2024, 5, 1)
+    end = TODAY + timedelta(days=1)
+    assert get_count(store, start, end) == full_window_count(start, end)
+    query = store.query_key("M1", ["$message"], [])
+    assert store.watermark(query, "count") == (start, TODAY - timedelta(days=1))
+    with store.connect() as connection:
+        (latest,) = connection.execute("SELECT MAX(day) FROM partials").fetchone()
+    assert latest == (TODAY - timedelta(days=1)).isoformat()
+
+    # Today is fetched again by the next run, the closed days are not
+    assert get_count(store, start, end) == full_window_count(start, end)
+    assert stub.ranges[-1] == (TODAY, end)
+
+
+def test_upsert_keeps_the_later_of_two_disjoint_ranges(store):
+    with store.connect() as connection:
+        for first_day, day in (
+            ("2024-02-01", "2024-02-10"),
+            ("2024-01-01", "2024-01-05"),
+        ):
+            connection.execute(
+                incremental.upsert_watermark, ("q", "count", first_day, day)
+            )
+    assert store.watermark("q", "count") == (date(2024, 2, 1), date(2024, 2, 10))
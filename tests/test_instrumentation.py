@@ -0,0 +1,25 @@
+import math
+
+from instrumentation import Counter, Histogram, Registry, format_sample
+
+
+def test_format_sample_keeps_every_digit():
+    assert format_sample(123456789) == "123456789.0"
+    assert format_sample(123456789.5 + 1) == "123456790.5"
+    assert format_sample(0.1) == "0.1"
+    assert format_sample(math.inf) == "+Inf"
+    assert format_sample(math.nan) == "NaN"
+
+
+def test_render_large_counter_and_histogram():
+    registry = Registry()
+    sent = registry.register(Counter("bytes_total", "Bytes", ("endpoint",)))
+    latency = registry.register(Histogram("seconds", "Latency", buckets=(1,)))
+    sent.inc(123456789, endpoint="profiles")
+    sent.inc(1, endpoint="profiles")
+    latency.observe(0.5)
+    lines = registry.render().splitlines()
+    assert 'bytes_total{endpoint="profiles"} 123456790.0' in lines
+    assert 'seconds_bucket{le="1.0"} 1.0' in lines
+    assert 'seconds_bucket{le="+Inf"} 1.0' in lines
+    assert "seconds_sum 0.5" in lines
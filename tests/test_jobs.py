@@ -0,0 +1,73 @@
+import json
+
+import pytest
+
+from jobs import JobRunner, LocalJobStore
+
+
+class RecordingTasks:
+    def __init__(self):
+        self.tasks = []
+
+    def create_task(self, parent, task):
+        self.tasks.append((parent, task))
+
+
+class MemoryStore:
+    """Stands in for the bucket store every service shares"""
+
+    def __init__(self):
+        self.states = {}
+
+    def write(self, job_id, state):
+        self.states[job_id] = json.loads(state)
+
+    def read(self, job_id):
+        return self.states.get(job_id)
+
+
+queue = "projects/p/locations/l/queues/klaviyo-loads"
+
+
+def test_enqueue_hands_the_job_to_the_worker(monkeypatch):
+    tasks = RecordingTasks()
+    monkeypatch.setattr("jobs.get_tasks_client", lambda: tasks)
+    runner = JobRunner(MemoryStore(), queue=queue)
+
+    job = runner.enqueue("load_klaviyo_data", profile=True)
+
+    [(parent, task)] = tasks.tasks
+    assert parent == queue
+    request = task["app_engine_http_request"]
+    assert request["relative_uri"] == f"/jobs/{job.id}/run"
+    assert request["app_engine_routing"] == {"service": "worker"}
+    assert runner.get(job.id)["status"] == "queued"
+
+
+def test_resume_runs_the_stored_job_under_its_id(tmp_path):
+    store = LocalJobStore(str(tmp_path))
+    runner = JobRunner(store, queue="")
+    queued = runner.run(lambda job: "first", name="load_klaviyo_data")
+
+    def load(job):
+        with job.phase("get_data"):
+            pass
+        return "done"
+
+    job = runner.resume(queued.id, load)
+    state = runner.get(queued.id)
+    assert job.id == queued.id
+    assert state["status"] == "succeeded" and state["result"] == "done"
+    assert state["created_at"] == queued.created_at
+    assert [phase["name"] for phase in state["phases"]] == ["get_data"]
+
+
+def test_resume_of_an_unknown_job_runs_nothing(tmp_path):
+    runner = JobRunner(LocalJobStore(str(tmp_path)), queue="")
+    assert runner.resume("0123abcd", lambda job: pytest.fail("ran")) is None
+    assert runner.get("../etc") is None
+
+
+def test_a_queue_needs_shared_job_state(tmp_path):
+    with pytest.raises(ValueError):
+        JobRunner(LocalJobStore(str(tmp_path)), queue=queue)
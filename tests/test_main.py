@@ -0,0 +1,55 @@
+import pytest
+
+import main
+from jobs import Job, LocalJobStore
+
+
+class RecordingRunner:
+    """Records how main starts a load instead of running it"""
+
+    def __init__(self, path: str, queue: str = ""):
+        self.store = LocalJobStore(path)
+        self.queue = queue
+        self.started = []
+
+    def start(self, how: str, profile: bool) -> Job:
+        self.started.append((how, profile))
+        job = Job(self.store, "load_klaviyo_data")
+        job.status = "succeeded"
+        return job
+
+    def run(self, fn, profile=False):
+        return self.start("run", profile)
+
+    def enqueue(self, name, profile=False):
+        return self.start("enqueue", profile)
+
+
+@pytest.fixture
+def client():
+    return main.app.test_client()
+
+
+@pytest.mark.parametrize(
+    "query, profile", [("", False), ("?profile=0", False), ("?profile=1", True)]
+)
+def test_profile_flag_is_parsed(monkeypatch, tmp_path, client, query, profile):
+    runner = RecordingRunner(str(tmp_path))
+    monkeypatch.setattr(main, "job_runner", runner)
+    monkeypatch.setattr(main, "profiling_enabled", False)
+    assert client.get(f"/append_klaviyo_data{query}").status_code == 200
+    assert runner.started == [("run", profile)]
+
+
+def test_cron_queues_the_load_when_a_queue_is_set(monkeypatch, tmp_path, client):
+    runner = RecordingRunner(str(tmp_path), queue="projects/p/locations/l/queues/q")
+    monkeypatch.setattr(main, "job_runner", runner)
+    response = client.get(
+        "/append_klaviyo_data", headers={"X-Appengine-Cron": "true"}
+    )
+    assert response.status_code == 202
+    assert runner.started[0][0] == "enqueue"
+
+
+def test_only_the_task_queue_runs_jobs(client):
+    assert client.post("/jobs/0123abcd/run").status_code == 403
@@ -0,0 +1,46 @@
+import accounts
+from data import Metrics
+from response_cache import ResponseCache
+
+
+def account(name: str, report_message_id: str = "Msg001") -> dict:
+    return {
+        "name": name,
+        "api_key": f"pk_{name}",
+        "report_message_id": report_message_id,
+        "subscriber_segment": "All Subscribers Segment",
+    }
+
+
+def test_a_rerun_reuses_each_accounts_metrics(monkeypatch, tmp_path):
+    calls = []
+
+    def get_data(klaviyo_api_key, report_message_id, subscriber_segment):
+        calls.append(klaviyo_api_key)
+        return Metrics(delivered_email_count=len(calls))
+
+    cache = ResponseCache(str(tmp_path), disk_bytes=0)
+    monkeypatch.setattr(accounts, "get_data", get_data)
+    monkeypatch.setattr(accounts, "get_response_cache", lambda: cache)
+
+    first, errors = accounts.fetch_all_accounts([account("us")])
+    assert not errors
+    assert accounts.fetch_all_accounts([account("us")]) == (first, {})
+    assert calls == ["pk_us"]
+
+    # Another message id is another result
+    accounts.fetch_all_accounts([account("us", "Msg002")])
+    assert calls == ["pk_us", "pk_us"]
+
+
+def test_failed_accounts_are_not_cached(monkeypatch, tmp_path):
+    def get_data(klaviyo_api_key, report_message_id, subscriber_segment):
+        return ["stack trace"]
+
+    cache = ResponseCache(str(tmp_path), disk_bytes=0)
+    monkeypatch.setattr(accounts, "get_data", get_data)
+    monkeypatch.setattr(accounts, "get_response_cache", lambda: cache)
+
+    results, errors = accounts.fetch_all_accounts([account("us")])
+    assert results == {} and "us" in errors
+    assert cache.get(accounts.metrics_cache_key(account("us"))) is None
@@ -0,0 +1,28 @@
+from utils import RateWindow, window_margin
+
+
+def release(window: RateWindow, now: float) -> float:
+    at = window.earliest(now)
+    window.record(at)
+    return at
+
+
+def test_never_more_than_the_quota_in_any_window():
+    window = RateWindow(3, 1.0)
+    releases = [release(window, 0.5) for _ in range(10)]
+    for start in releases:
+        assert sum(start <= at < start + 1.0 for at in releases) <= 3
+
+
+def test_the_first_quota_goes_at_once_and_the_next_a_window_later():
+    window = RateWindow(3, 1.0)
+    releases = [release(window, 10.0) for _ in range(4)]
+    assert releases[:3] == [10.0] * 3
+    assert releases[3] == 10.0 + 1.0 + window_margin
+
+
+def test_drain_counts_requests_the_server_saw_from_elsewhere():
+    window = RateWindow(60, 60.0)
+    release(window, 0.0)
+    window.drain(remaining=0, now=1.0)
+    assert window.earliest(1.0) == 60.0 * (1 + window_margin)
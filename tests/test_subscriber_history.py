@@ -0,0 +1,44 @@
+from collections import Counter
+from datetime import date
+
+from data import (
+    Metrics,
+    SubscriberHistory,
+    calculate_rates,
+    count_subscribers,
+    count_unsubscribed,
+    past_day_specs,
+)
+
+
+def test_counts_rewind_the_joins_after_each_day():
+    history = SubscriberHistory(
+        100, Counter({date(2024, 1, 1): 3, date(2024, 1, 2): 5, date(2024, 1, 4): 2})
+    )
+    assert history.counts(date(2024, 1, 4)) == {
+        "subscriber_count": 100,
+        "new_subscriber_count": 2,
+    }
+    assert history.counts(date(2024, 1, 3)) == {
+        "subscriber_count": 98,
+        "new_subscriber_count": 0,
+    }
+    assert history.counts(date(2024, 1, 1)) == {
+        "subscriber_count": 93,
+        "new_subscriber_count": 3,
+    }
+
+
+def test_past_day_skips_the_unsubscribed_scan():
+    counts = {"subscriber_count": 7, "new_subscriber_count": 1}
+    specs = past_day_specs(counts)
+    scans = [spec.count for spec in specs if hasattr(spec, "count")]
+    assert count_unsubscribed not in scans
+    assert count_subscribers not in scans
+    assert [scan(None) for scan in scans] == [counts]
+
+
+def test_unknown_unsubscribed_count_has_no_rate():
+    rates = calculate_rates(Metrics(delivered_email_count=10, unsubscribed_count=None))
+    assert rates["unsubscribed_rate"] is None
+    assert calculate_rates(Metrics(delivered_email_count=10))["unsubscribed_rate"] == 0
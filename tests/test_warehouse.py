@@ -0,0 +1,244 @@
+import re
+from datetime import date
+
+import pytest
+from google.api_core.exceptions import NotFound
+from google.cloud import bigquery
+
+import warehouse
+
+
+class FakeJob:
+    total_bytes_processed = 0
+    total_bytes_billed = 0
+    num_dml_affected_rows = 0
+
+    def result(self):
+        return self
+
+
+class FakeClient:
+    """In-memory stand-in for the bigquery.Client calls warehouse makes
+
+    Tables are bigquery.Table objects by id. Queries are recorded; the
+    migration DDL is applied to the tables, and a query containing
+    `fail_on` raises `failure`.
+    """
+
+    def __init__(self, tables: list = ()):
+        self.tables = {table_id(table): table for table in tables}
+        self.calls = []
+        self.queries = []
+        self.fail_on = None
+        self.failure = RuntimeError
+
+    def get_table(self, table_id: str) -> bigquery.Table:
+        self.calls.append(("get_table", table_id))
+        if table_id not in self.tables:
+            raise NotFound(table_id)
+        return self.tables[table_id]
+
+    def create_table(self, table: bigquery.Table):
+        self.calls.append(("create_table", table_id(table)))
+        self.tables[table_id(table)] = table
+
+    def update_table(self, table: bigquery.Table, fields: list) -> bigquery.Table:
+        self.calls.append(("update_table", tuple(fields)))
+        self.tables[table_id(table)] = table
+        return table
+
+    def query(self, sql: str, job_config=None) -> FakeJob:
+        self.calls.append(("query", sql))
+        self.queries.append((sql, job_config))
+        for statement in sql.split(";"):
+            if self.fail_on and self.fail_on in statement:
+                raise self.failure(f"Failed: {statement.strip()}")
+            self.apply(statement)
+        return FakeJob()
+
+    def apply(self, statement: str):
+        created = re.search(r"CREATE OR REPLACE TABLE `([^`]+)`", statement)
+        renamed = re.search(r"ALTER TABLE `([^`]+)` RENAME TO `([^`]+)`", statement)
+        if created:
+            source = re.search(r"FROM `([^`]+)`", statement).group(1)
+            self.tables[created.group(1)] = warehouse.new_table(
+                created.group(1), self.tables[source].schema
+            )
+        elif renamed:
+            table = self.tables.pop(renamed.group(1))
+            project, dataset, _ = renamed.group(1).split(".")
+            new_id = f"{project}.{dataset}.{renamed.group(2)}"
+            self.tables[new_id] = bigquery.Table(new_id, schema=table.schema)
+            self.tables[new_id].time_partitioning = table.time_partitioning
+            self.tables[new_id].clustering_fields = table.clustering_fields
+
+
+def table_id(table: bigquery.Table) -> str:
+    return f"{table.project}.{table.dataset_id}.{table.table_id}"
+
+
+TABLE = "project.dataset.klaviyo"
+
+
+@pytest.fixture(autouse=True)
+def fresh_cache(monkeypatch):
+    monkeypatch.setattr(warehouse, "_verified_tables", {})
+
+
+def legacy_table() -> bigquery.Table:
+    schema = [
+        bigquery.SchemaField("date", "STRING"),
+        bigquery.SchemaField("title", "STRING"),
+    ]
+    return bigquery.Table(TABLE, schema=schema)
+
+
+def test_ensure_table_refuses_to_rebuild_an_unpartitioned_table():
+    client = FakeClient([legacy_table()])
+    with pytest.raises(RuntimeError, match="migrate.py"):
+        warehouse.ensure_table(client, TABLE, warehouse.klaviyo_schema)
+    assert client.queries == []
+    assert TABLE not in warehouse._verified_tables
+
+
+def test_ensure_table_does_not_create_over_an_unfinished_migration():
+    client = FakeClient([warehouse.new_table(f"{TABLE}_partitioned", [])])
+    with pytest.raises(RuntimeError, match="unfinished"):
+        warehouse.ensure_table(client, TABLE, warehouse.klaviyo_schema)
+    assert TABLE not in client.tables
+
+
+def test_migration_keeps_the_original_as_legacy():
+    client = FakeClient([legacy_table()])
+    warehouse.migrate_to_partitioned(client, TABLE)
+    (copy, _), (renames, _) = client.queries
+    assert f"CREATE OR REPLACE TABLE `{TABLE}_partitioned`" in copy
+    assert "PARSE_DATE('%m-%d-%Y', date)" in copy
+    assert warehouse.is_partitioned(client.tables[TABLE])
+    assert not warehouse.is_partitioned(client.tables[f"{TABLE}_legacy"])
+    assert f"{TABLE}_partitioned" not in client.tables
+
+
+def test_migration_resumes_after_the_second_rename_failed():
+    client = FakeClient([legacy_table()])
+    client.fail_on = "RENAME TO `klaviyo`"
+    with pytest.raises(RuntimeError):
+        warehouse.migrate_to_partitioned(client, TABLE)
+    assert TABLE not in client.tables
+
+    client.fail_on = None
+    warehouse.migrate_to_partitioned(client, TABLE)
+    assert warehouse.is_partitioned(client.tables[TABLE])
+    assert f"{TABLE}_legacy" in client.tables
+    assert f"{TABLE}_partitioned" not in client.tables
+
+
+def test_migration_of_a_partitioned_table_does_nothing():
+    client = FakeClient([warehouse.new_table(TABLE, warehouse.klaviyo_schema)])
+    warehouse.migrate_to_partitioned(client, TABLE)
+    assert client.queries == []
+
+
+def test_right_schema_with_wrong_clustering_is_reconciled():
+    table = warehouse.new_table(TABLE, warehouse.klaviyo_schema)
+    table.clustering_fields = ["title"]
+    client = FakeClient([table])
+    warehouse.ensure_table(client, TABLE, warehouse.klaviyo_schema)
+    assert ("update_table", ("clustering_fields",)) in client.calls
+    assert client.tables[TABLE].clustering_fields == warehouse.clustering_columns
+    assert warehouse.table_fingerprint(
+        client.tables[TABLE]
+    ) == warehouse.schema_fingerprint(warehouse.klaviyo_schema)
+
+
+def test_right_schema_with_wrong_partitioning_is_not_verified():
+    table = warehouse.new_table(TABLE, warehouse.klaviyo_schema)
+    table.time_partitioning = bigquery.TimePartitioning(
+        type_=bigquery.TimePartitioningType.MONTH, field="date"
+    )
+    client = FakeClient([table])
+    assert warehouse.table_fingerprint(table) != warehouse.schema_fingerprint(
+        warehouse.klaviyo_schema
+    )
+    with pytest.raises(RuntimeError, match="not partitioned by day"):
+        warehouse.ensure_table(client, TABLE, warehouse.klaviyo_schema)
+    assert TABLE not in warehouse._verified_tables
+
+
+def test_verified_table_is_not_fetched_again():
+    client = FakeClient([warehouse.new_table(TABLE, warehouse.klaviyo_schema)])
+    warehouse.ensure_table(client, TABLE, warehouse.klaviyo_schema)
+    assert client.calls == [("get_table", TABLE)]
+    warehouse.ensure_table(client, TABLE, warehouse.klaviyo_schema)
+    assert client.calls == [("get_table", TABLE)]
+
+
+def test_not_found_on_upsert_drops_the_verified_table():
+    client = FakeClient([warehouse.new_table(TABLE, warehouse.klaviyo_schema)])
+    warehouse.ensure_table(client, TABLE, warehouse.klaviyo_schema)
+    client.fail_on, client.failure = "MERGE", NotFound
+    row = dict.fromkeys(field.name for field in warehouse.klaviyo_schema)
+    row.update(date=date(2024, 5, 1), title="Viewed Product", account="us")
+    with pytest.raises(NotFound):
+        warehouse.upsert_rows(client, TABLE, [row], warehouse.klaviyo_schema)
+    assert TABLE not in warehouse._verified_tables
+
+    warehouse.ensure_table(client, TABLE, warehouse.klaviyo_schema)
+    assert client.calls.count(("get_table", TABLE)) == 2
+
+
+def metric_row(day: date, account: str = "us", title: str = "Viewed Product"):
+    row = dict.fromkeys(field.name for field in warehouse.klaviyo_schema)
+    row.update(
+        date=day, title=title, account=account, open_rate=12.5, new_subscribers=3
+    )
+    return row
+
+
+def test_upsert_rows_sends_one_pinned_merge():
+    client = FakeClient([warehouse.new_table(TABLE, warehouse.klaviyo_schema)])
+    rows = [
+        metric_row(date(2024, 5, 1)),
+        metric_row(date(2024, 5, 1), title="Active on Site"),
+        metric_row(date(2024, 4, 30), account="eu"),
+    ]
+    warehouse.upsert_rows(client, TABLE, rows, warehouse.klaviyo_schema)
+    ((sql, job_config),) = client.queries
+    sql = " ".join(sql.split())
+
+    assert f"MERGE `{TABLE}` T" in sql
+    assert "SELECT * FROM UNNEST(@rows)" in sql
+    assert (
+        "ON T.account = S.account AND T.date = S.date AND T.title = S.title "
+        "AND T.date IN UNNEST(@partitions)"
+    ) in sql
+    updates = sql.split("UPDATE SET ")[1].split(" WHEN NOT MATCHED")[0]
+    assert re.findall(r"T\.(\w+) = ", updates) == [
+        field.name
+        for field in warehouse.klaviyo_schema
+        if field.name not in warehouse.key_columns
+    ]
+    assert "T.open_rate = COALESCE(S.open_rate, T.open_rate)" in updates
+    assert (
+        f"INSERT ({', '.join(field.name for field in warehouse.klaviyo_schema)})"
+        in sql
+    )
+
+    rows_parameter, partitions = [
+        parameter.to_api_repr() for parameter in job_config.query_parameters
+    ]
+    assert partitions["name"] == "partitions"
+    assert partitions["parameterType"]["arrayType"] == {"type": "DATE"}
+    assert partitions["parameterValue"]["arrayValues"] == [
+        {"value": "2024-04-30"},
+        {"value": "2024-05-01"},
+    ]
+    types = {
+        field["name"]: field["type"]["type"]
+        for field in rows_parameter["parameterType"]["arrayType"]["structTypes"]
+    }
+    assert types["date"] == "DATE"
+    assert types["open_rate"] == "FLOAT64"
+    assert types["new_subscribers"] == "INT64"
+    assert types["account"] == "STRING"
+    assert len(rows_parameter["parameterValue"]["arrayValues"]) == 3
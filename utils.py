@@ -1,15 +1,370 @@
+import bisect
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Callable, Iterator, Optional
+from urllib.parse import urlparse
+
 import requests
+from requests.adapters import HTTPAdapter
+
+from decoding import loads
+from instrumentation import (
+    compression_saved_bytes,
+    request_bytes,
+    request_retries,
+    request_seconds,
+    response_cache_lookups,
+    response_encodings,
+    scan_pages,
+)
+from profiling import profiled
+from response_cache import (
+    aggregate_key,
+    aggregate_ttl,
+    get_response_cache,
+)
+
+API_REVISION = "2024-02-15"
+
+# Throttled and transient server errors are retried, everything else is raised
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Pages a scan fetches ahead of the one being processed; 0 fetches on demand
+page_prefetch = int(os.environ.get("KLAVIYO_PAGE_PREFETCH", "2"))
+
+# Published Klaviyo limits per endpoint class as (burst per second, steady per minute)
+RATE_LIMITS = {
+    "metric-aggregates": (3, 60),
+    "metrics": (10, 150),
+    "profiles": (75, 700),
+    "segments": (75, 700),
+    "default": (10, 150),
+}
+
+
+# Extra share of a window waited out before reusing its quota, so jitter
+# between a request leaving and reaching Klaviyo cannot squeeze it into the
+# window the server counts it in
+window_margin = 0.05
+
+
+class RateWindow:
+    """At most `quota` releases in any `window` seconds
+
+    Release times are logged, so the quota-th last release has to be a whole
+    window old before the next one. A token bucket refilled at quota/window
+    does not give that: a full bucket plus its refill can release twice the
+    quota within one of Klaviyo's windows.
+    """
+
+    def __init__(self, quota: int, window: float):
+        self.quota = quota
+        self.window = window
+        self.releases = []
+
+    def earliest(self, now: float) -> float:
+        """Earliest time from `now` the next release keeps to the quota"""
+        if len(self.releases) < self.quota:
+            return now
+        return max(
+            now, self.releases[-self.quota] + self.window * (1 + window_margin)
+        )
+
+    def record(self, at: float):
+        bisect.insort(self.releases, at)
+        del self.releases[: -self.quota]
+
+    def drain(self, remaining: float, now: float):
+        """Count releases we did not make once the server says fewer are left"""
+        recent = sum(at > now - self.window for at in self.releases)
+        for _ in range(int(self.quota - remaining) - recent):
+            self.record(now)
+
+
+class RateLimitScheduler:
+    """Per-endpoint-class burst and steady rate windows for one account
+
+    Windows start from RATE_LIMITS and are corrected from the RateLimit-*
+    headers of every response, so concurrent callers are released at the
+    fastest rate Klaviyo currently allows instead of tripping 429s.
+    """
+
+    def __init__(self, rate_limits: dict = None):
+        self.rate_limits = dict(RATE_LIMITS if rate_limits is None else rate_limits)
+        self.windows = {}
+        self.blocked_until = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def endpoint_class(url: str) -> str:
+        """Endpoint class of an API url, e.g. /api/segments/X/profiles -> segments"""
+        parts = [part for part in urlparse(url).path.split("/") if part]
+        if parts and parts[0] == "api":
+            parts = parts[1:]
+        return parts[0] if parts else "default"
+
+    def get_windows(self, endpoint: str) -> tuple:
+        windows = self.windows.get(endpoint)
+        if windows is None:
+            burst, steady = self.rate_limits.get(endpoint, self.rate_limits["default"])
+            windows = self.windows[endpoint] = (
+                RateWindow(burst, 1.0),
+                RateWindow(steady, 60.0),
+            )
+        return windows
+
+    def acquire(self, url: str):
+        """Block until a request to `url` may be sent"""
+        endpoint = self.endpoint_class(url)
+        with self.lock:
+            now = time.monotonic()
+            windows = self.get_windows(endpoint)
+            at = max(window.earliest(now) for window in windows)
+            at = max(at, self.blocked_until.get(endpoint, 0.0))
+            for window in windows:
+                window.record(at)
+        delay = at - now
+        if delay > 0:
+            time.sleep(delay)
+
+    def pause(self, url: str, seconds: float):
+        """Hold back every request to the endpoint class for `seconds`"""
+        endpoint = self.endpoint_class(url)
+        with self.lock:
+            until = time.monotonic() + seconds
+            self.blocked_until[endpoint] = max(
+                self.blocked_until.get(endpoint, 0.0), until
+            )
+
+    def observe(self, url: str, headers: dict):
+        """Feed RateLimit-Limit/-Remaining/-Reset response headers into the windows"""
+        endpoint = self.endpoint_class(url)
+        limit = headers.get("RateLimit-Limit")
+        remaining = headers.get("RateLimit-Remaining")
+        reset = headers.get("RateLimit-Reset")
+        with self.lock:
+            now = time.monotonic()
+            burst, steady = self.get_windows(endpoint)
+            # e.g. "3, 3;w=1, 60;w=60"
+            for quota, seconds in re.findall(r"(\d+)\s*;\s*w=(\d+)", limit or ""):
+                window = burst if float(seconds) <= 1 else steady
+                window.quota, window.window = int(quota), float(seconds)
+            try:
+                remaining = float(remaining)
+                reset = float(reset) if reset is not None else 0.0
+            except (TypeError, ValueError):
+                return
+            steady.drain(remaining, now)
+            if remaining <= 0 and reset > 0:
+                self.blocked_until[endpoint] = max(
+                    self.blocked_until.get(endpoint, 0.0), now + reset
+                )
+
+
+class KlaviyoClient:
+    """Pooled keep-alive session for one Klaviyo account with retry/backoff"""
+
+    def __init__(
+        self,
+        klaviyo_api_key: str,
+        max_retries: int = 5,
+        backoff_factor: float = 1.0,
+        max_backoff: float = 60.0,
+        pool_size: int = 16,
+        timeout: float = 60.0,
+        scheduler: RateLimitScheduler = None,
+    ):
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.scheduler = scheduler if scheduler is not None else RateLimitScheduler()
+        self.session = requests.Session()
+        self.session.headers.update(
+            {
+                "accept": "application/json",
+                "accept-encoding": "gzip, deflate",
+                "revision": API_REVISION,
+                "content-type": "application/json",
+                "Authorization": "Klaviyo-API-Key " + klaviyo_api_key,
+            }
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def backoff(self, attempt: int) -> float:
+        """Exponential backoff with full jitter"""
+        delay = min(self.max_backoff, self.backoff_factor * (2**attempt))
+        return random.uniform(0, delay)
+
+    def retry_after(self, response: requests.Response) -> Optional[float]:
+        """Seconds to wait from a Retry-After header, or None if absent"""
+        value = response.headers.get("Retry-After")
+        if value is None:
+            return None
+        try:
+            return min(self.max_backoff, max(0.0, float(value)))
+        except ValueError:
+            pass
+        try:
+            retry_at = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        delay = (retry_at - datetime.now(timezone.utc)).total_seconds()
+        return min(self.max_backoff, max(0.0, delay))
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """Send a request, retrying throttled, 5xx and connection failures
+
+        Every attempt's latency and bytes, and every retry, are recorded.
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        endpoint = RateLimitScheduler.endpoint_class(url)
+        for attempt in range(self.max_retries + 1):
+            self.scheduler.acquire(url)
+            started = time.perf_counter()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                request_seconds.observe(
+                    time.perf_counter() - started,
+                    endpoint=endpoint,
+                    method=method,
+                    status="error",
+                )
+                if attempt == self.max_retries:
+                    raise
+                request_retries.inc(endpoint=endpoint, reason=type(e).__name__)
+                delay = self.backoff(attempt)
+                logging.warning(
+                    f"{method} {url} failed ({e}), retrying in {delay:.1f}s"
+                )
+                time.sleep(delay)
+                continue
+
+            request_seconds.observe(
+                time.perf_counter() - started,
+                endpoint=endpoint,
+                method=method,
+                status=response.status_code,
+            )
+            self.record_bytes(endpoint, response)
+            self.scheduler.observe(url, response.headers)
+            if (
+                response.status_code not in RETRY_STATUS_CODES
+                or attempt == self.max_retries
+            ):
+                response.raise_for_status()
+                return response
+
+            delay = self.retry_after(response)
+            if delay is None:
+                delay = self.backoff(attempt)
+            if response.status_code == 429:
+                self.scheduler.pause(url, delay)
+            request_retries.inc(endpoint=endpoint, reason=response.status_code)
+            logging.warning(
+                f"{method} {url} returned {response.status_code}, retrying in {delay:.1f}s"
+            )
+            response.close()
+            time.sleep(delay)
+
+    @staticmethod
+    def record_bytes(endpoint: str, response: requests.Response):
+        """Body bytes sent and received as on the wire, and what compression saved"""
+        body = response.request.body or b""
+        request_bytes.inc(len(body), endpoint=endpoint, direction="sent")
+        decoded = len(response.content)
+        received = response.headers.get("Content-Length")
+        if received is None:
+            # Bytes read from the socket, before decompression
+            received = response.raw.tell() if response.raw is not None else decoded
+        received = int(received)
+        request_bytes.inc(received, endpoint=endpoint, direction="received")
+        encoding = response.headers.get("Content-Encoding", "identity")
+        response_encodings.inc(endpoint=endpoint, encoding=encoding)
+        compression_saved_bytes.inc(max(0, decoded - received), endpoint=endpoint)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(klaviyo_api_key: str) -> KlaviyoClient:
+    """Shared client per API key so connections are reused across calls"""
+    with _clients_lock:
+        client = _clients.get(klaviyo_api_key)
+        if client is None:
+            client = _clients[klaviyo_api_key] = KlaviyoClient(klaviyo_api_key)
+        return client
+
+
+def get_json(url: str, klaviyo_api_key: str) -> dict:
+    """GET `url` and decode its JSON body (GETs are never cached)"""
+    return loads(get_client(klaviyo_api_key).get(url).content)
+
 
 def get_subscribers(url: str, klaviyo_api_key: str)-> dict:
     """Get subscribers for counting"""
-    headers = {
-        "accept": "application/json",
-        "revision": "2024-02-15",
-        "content-type": "application/json",
-        "Authorization": "Klaviyo-API-Key " + klaviyo_api_key,
+    return get_json(url, klaviyo_api_key)
+
+
+def get_metric_aggregates(
+    by: list,
+    metric_id: str,
+    url: str,
+    measurement: list,
+    filter: list,
+    klaviyo_api_key: str,
+    interval: str = "month",
+) -> dict:
+    """Post an aggregate query, returning the `dates` and `data` attributes
+
+    Responses are cached by query: forever once the window is closed,
+    for open_ttl seconds while it still includes today.
+    """
+    cache = get_response_cache()
+    if cache is not None:
+        key = aggregate_key(
+            klaviyo_api_key, metric_id, by, measurement, filter, interval
+        )
+        attributes = cache.get(key)
+        response_cache_lookups.inc(
+            kind="aggregate", result="miss" if attributes is None else "hit"
+        )
+        if attributes is not None:
+            return attributes
+    payload = {
+        "data": {
+            "type": "metric-aggregate",
+            "attributes": {
+                "measurements": measurement,
+                "filter": filter,
+                "by": by,
+                "interval": interval,
+                "metric_id": metric_id,
+            },
+        }
     }
-    data = requests.get(url, headers=headers)
-    return data.json()
+    data = get_client(klaviyo_api_key).post(url, json=payload)
+    attributes = loads(data.content)["data"]["attributes"]
+    if cache is not None:
+        cache.put(key, attributes, aggregate_ttl(filter))
+    return attributes
 
 
 def get_metrics(
@@ -17,49 +372,119 @@ def get_metrics(
 : str) -> list:
     """Get Post Aggregate Metrics"""
     try:
-        headers = {
-            "accept": "application/json",
-            "revision": "2024-02-15",
-            "content-type": "application/json",
-            "Authorization": "Klaviyo-API-Key " + klaviyo_api_key,
-        }
-        payload = {
-            "data": {
-                "type": "metric-aggregate",
-                "attributes": {
-                    "measurements": measurement,
-                    "filter": filter,
-                    "by": by,
-                    "interval": "month",
-                    "metric_id": metric_id,
-                },
-            }
-        }
-
-        data = requests.post(url, headers=headers, json=payload)
-        reports = data.json()
-        report_results = reports["data"]["attributes"]["data"]
+        reports = get_metric_aggregates(
+            by, metric_id, url, measurement, filter, klaviyo_api_key
+        )
+        report_results = reports["data"]
         return report_results
     except Exception as e:
         return str(e)
 
 
-def get_pagination_metrics(url: str, klaviyo_api_key: str) -> list:
-    """Get Metrics With Pagination Data"""
+def fetch_pages(
+    url: str,
+    klaviyo_api_key: str,
+    pages: queue.Queue,
+    stopped: threading.Event,
+):
+    """Fetch pages in order into `pages` until the last one or `stopped`
+
+    Puts (records, None) per page, then (None, None) at the end or
+    (None, error) if a fetch fails. Each next page is requested as soon as
+    the previous one's cursor is known, while the consumer is still busy.
+    """
+    endpoint = RateLimitScheduler.endpoint_class(url)
+    count = 0
+
+    def put(item: tuple) -> bool:
+        while not stopped.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
     try:
-        metrics = []
-        headers = {
-            "accept": "application/json",
-            "revision": "2024-02-15",
-            "content-type": "application/json",
-            "Authorization": "Klaviyo-API-Key " + klaviyo_api_key,
-        }
         while url:
-            data = requests.get(url, headers=headers)
-            data_pagination = data.json()
-            metrics.extend(data_pagination["data"])
+            data_pagination = get_json(url, klaviyo_api_key)
+            count += 1
             url = data_pagination.get("links", {}).get("next")
-        return metrics
+            if not put((data_pagination["data"], None)):
+                return
+        put((None, None))
+    except Exception as e:
+        put((None, e))
+    finally:
+        scan_pages.observe(count, endpoint=endpoint)
+
+
+def iter_pagination_pages(
+    url: str, klaviyo_api_key: str, prefetch: int = None
+) -> Iterator[list]:
+    """Yield the records of each page in turn, following the next links
+
+    Up to `prefetch` (default page_prefetch) pages are fetched ahead by a
+    producer thread, so network waits overlap processing of the current
+    page; with 0 each page is fetched when asked for.
+    """
+    prefetch = page_prefetch if prefetch is None else prefetch
+    if prefetch <= 0:
+        endpoint = RateLimitScheduler.endpoint_class(url)
+        count = 0
+        try:
+            while url:
+                data_pagination = get_json(url, klaviyo_api_key)
+                count += 1
+                yield data_pagination["data"]
+                url = data_pagination.get("links", {}).get("next")
+        finally:
+            scan_pages.observe(count, endpoint=endpoint)
+        return
+
+    pages = queue.Queue(maxsize=prefetch)
+    stopped = threading.Event()
+    producer = threading.Thread(
+        target=profiled(fetch_pages),
+        args=(url, klaviyo_api_key, pages, stopped),
+        name="klaviyo-pages",
+        daemon=True,
+    )
+    producer.start()
+    try:
+        while True:
+            records, error = pages.get()
+            if error is not None:
+                raise error
+            if records is None:
+                return
+            yield records
+    finally:
+        # Also stops the producer when the consumer gives up early
+        stopped.set()
+
+
+def iter_pagination_metrics(url: str, klaviyo_api_key: str) -> Iterator[dict]:
+    """Yield records page by page, holding only the current page in memory"""
+    for page in iter_pagination_pages(url, klaviyo_api_key):
+        yield from page
+
+
+def count_pagination_metrics(
+    url: str, klaviyo_api_key: str, predicate: Callable[[dict], bool] = None
+) -> int:
+    """Count records (matching `predicate`) across all pages without keeping them"""
+    count = 0
+    for record in iter_pagination_metrics(url, klaviyo_api_key):
+        if predicate is None or predicate(record):
+            count += 1
+    return count
+
+
+def get_pagination_metrics(url: str, klaviyo_api_key: str) -> list:
+    """Get Metrics With Pagination Data"""
+    try:
+        return list(iter_pagination_metrics(url, klaviyo_api_key))
     except Exception as e:
         return str(e)
 
@@ -0,0 +1,406 @@
+import hashlib
+import json
+import logging
+import threading
+import uuid
+from datetime import date, datetime, timedelta, timezone
+from typing import Optional
+
+from google.api_core.exceptions import NotFound
+from google.cloud import bigquery
+
+from data import Metrics, calculate_rates
+from instrumentation import record_query_job
+
+klaviyo_schema = [
+    bigquery.SchemaField("date", "DATE"),
+    bigquery.SchemaField("title", "STRING"),
+    bigquery.SchemaField("open_rate", "FLOAT"),
+    bigquery.SchemaField("click_rate", "FLOAT"),
+    bigquery.SchemaField("unsubscribed_rate", "FLOAT"),
+    bigquery.SchemaField("bounce_rate", "FLOAT"),
+    bigquery.SchemaField("delivery_rate", "FLOAT"),
+    bigquery.SchemaField("conversion_rate", "FLOAT"),
+    bigquery.SchemaField("revenue_per_email", "FLOAT"),
+    bigquery.SchemaField("product_purchase_rate", "FLOAT"),
+    bigquery.SchemaField("average_order_value", "FLOAT"),
+    bigquery.SchemaField("new_subscribers", "INTEGER"),
+    bigquery.SchemaField("subscriber_counts", "INTEGER"),
+    bigquery.SchemaField("account", "STRING"),
+]
+
+# Columns identifying a row; a re-run for the same keys updates in place
+key_columns = ["account", "date", "title"]
+
+partition_column = "date"
+clustering_columns = ["account", "title"]
+
+# Format of the date column before it was a DATE
+legacy_date_format = "%m-%d-%Y"
+
+# Query parameter types for the table's legacy schema type names
+parameter_types = {
+    "FLOAT": "FLOAT64",
+    "INTEGER": "INT64",
+    "BOOLEAN": "BOOL",
+}
+
+
+_client = None
+_client_lock = threading.Lock()
+
+# table id -> fingerprint of the schema and layout last verified in this process
+_verified_tables = {}
+
+
+def get_client() -> bigquery.Client:
+    """Process-level BigQuery client, reused by every run on a warm worker"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = bigquery.Client()
+        return _client
+
+
+def schema_columns(schema: list) -> list:
+    return [
+        [field.name, field.field_type, field.mode or "NULLABLE"] for field in schema
+    ]
+
+
+def schema_fingerprint(
+    schema: list,
+    partitioning: Optional[tuple] = (partition_column, "DAY"),
+    clustering: Optional[list] = clustering_columns,
+) -> str:
+    """Stable hash of the column names, types and modes plus the table layout
+
+    The defaults describe the layout tables should have; see table_fingerprint
+    for the layout a live table actually has.
+    """
+    layout = [list(partitioning) if partitioning else None, list(clustering or [])]
+    return hashlib.sha256(
+        json.dumps([schema_columns(schema), layout]).encode()
+    ).hexdigest()
+
+
+def table_fingerprint(table: bigquery.Table) -> str:
+    """schema_fingerprint of a live table's columns, partitioning and clustering"""
+    partitioning = None
+    if table.time_partitioning is not None:
+        partitioning = (table.time_partitioning.field, table.time_partitioning.type_)
+    return schema_fingerprint(table.schema, partitioning, table.clustering_fields)
+
+
+def to_parameter_value(value):
+    """Plain Python value for a query parameter (numpy scalars included)"""
+    return value.item() if hasattr(value, "item") else value
+
+
+def rows_parameter(name: str, rows: list, schema: list) -> bigquery.ArrayQueryParameter:
+    """ARRAY<STRUCT> query parameter holding `rows` typed by `schema`"""
+    return bigquery.ArrayQueryParameter(
+        name,
+        "STRUCT",
+        [
+            bigquery.StructQueryParameter(
+                None,
+                *[
+                    bigquery.ScalarQueryParameter(
+                        field.name,
+                        parameter_types.get(field.field_type, field.field_type),
+                        to_parameter_value(row[field.name]),
+                    )
+                    for field in schema
+                ],
+            )
+            for row in rows
+        ],
+    )
+
+
+def is_partitioned(table: bigquery.Table) -> bool:
+    return (
+        table.time_partitioning is not None
+        and table.time_partitioning.field == partition_column
+        and table.time_partitioning.type_ == bigquery.TimePartitioningType.DAY
+    )
+
+
+def new_table(table_id: str, schema: list) -> bigquery.Table:
+    table = bigquery.Table(table_id, schema=schema)
+    table.time_partitioning = bigquery.TimePartitioning(
+        type_=bigquery.TimePartitioningType.DAY, field=partition_column
+    )
+    table.clustering_fields = clustering_columns
+    return table
+
+
+def table_exists(client: bigquery.Client, table_id: str) -> bool:
+    try:
+        client.get_table(table_id)
+    except NotFound:
+        return False
+    return True
+
+
+def migrate_to_partitioned(client: bigquery.Client, table_id: str):
+    """Rebuild a table as DATE-partitioned and clustered, keeping the original
+
+    Run once by hand (see migrate.py), never from a load. A STRING date
+    column in legacy_date_format is parsed into a DATE. The rebuilt copy is
+    made as <table>_partitioned, then the original is renamed to
+    <table>_legacy (left in place for rollback) and the copy takes its name.
+    Each step can be re-run: a failure between the renames leaves no table
+    under the live name, and the next run only finishes the last rename.
+    """
+    staging_id = f"{table_id}_partitioned"
+    table_name = table_id.split(".")[-1]
+    try:
+        table = client.get_table(table_id)
+    except NotFound:
+        if not table_exists(client, staging_id):
+            raise
+        finish_query = f"ALTER TABLE `{staging_id}` RENAME TO `{table_name}`;"
+        logging.info(f"Finishing the interrupted migration of {table_id}")
+    else:
+        if is_partitioned(table):
+            logging.info(f"{table_id} is already partitioned on {partition_column}")
+            return
+        field_types = {field.name: field.field_type for field in table.schema}
+        clustering = [column for column in clustering_columns if column in field_types]
+        date_expression = partition_column
+        if field_types.get(partition_column) == "STRING":
+            date_expression = f"PARSE_DATE('{legacy_date_format}', {partition_column})"
+        # OR REPLACE: a copy left by a run that failed before the renames is redone
+        copy_job = client.query(
+            f"""
+            CREATE OR REPLACE TABLE `{staging_id}`
+            PARTITION BY {partition_column}
+            CLUSTER BY {", ".join(clustering)}
+            AS SELECT * REPLACE ({date_expression} AS {partition_column})
+            FROM `{table_id}`
+            """
+        )
+        copy_job.result()
+        record_query_job("migrate", copy_job)
+        finish_query = f"""
+        ALTER TABLE `{table_id}` RENAME TO `{table_name}_legacy`;
+        ALTER TABLE `{staging_id}` RENAME TO `{table_name}`;
+        """
+    rename_job = client.query(finish_query)
+    rename_job.result()
+    record_query_job("migrate", rename_job)
+    _verified_tables.pop(table_id, None)
+    logging.info(
+        f"Migrated {table_id} to a {partition_column}-partitioned table, "
+        f"previous table kept as {table_name}_legacy"
+    )
+
+
+def ensure_table(
+    client: bigquery.Client, table_id: str, schema: list, defaults: dict = None
+):
+    """Create the table partitioned and clustered, or bring an existing one in line
+
+    Columns added to an existing table are filled with their value from
+    `defaults`, if any. Skipped without any metadata call once this process
+    has verified the same schema for `table_id`; otherwise the live table's
+    columns, partitioning and clustering are compared with the expected ones.
+    A table not partitioned by day on the date column (e.g. a legacy STRING
+    date) is never rebuilt here: that raises, as does a missing table while
+    a migration is unfinished. See migrate.py.
+    """
+    fingerprint = schema_fingerprint(schema)
+    if _verified_tables.get(table_id) == fingerprint:
+        return
+
+    try:
+        table = client.get_table(table_id)
+    except NotFound:
+        if table_exists(client, f"{table_id}_partitioned"):
+            raise RuntimeError(
+                f"{table_id} is missing while its migration is unfinished; "
+                "re-run python migrate.py"
+            )
+        client.create_table(new_table(table_id, schema))
+        logging.info(f"Created table {table_id}.")
+        _verified_tables[table_id] = fingerprint
+        return
+    if table_fingerprint(table) == fingerprint:
+        _verified_tables[table_id] = fingerprint
+        return
+
+    if not is_partitioned(table):
+        raise RuntimeError(
+            f"{table_id} is not partitioned by day on {partition_column}; "
+            "run python migrate.py to rebuild it"
+        )
+
+    if schema_columns(table.schema) != schema_columns(schema):
+        existing = {field.name for field in table.schema}
+        table.schema = schema
+        table = client.update_table(table, ["schema"])
+        logging.info(f"Updated schema for table {table_id}.")
+        for field in schema:
+            if field.name not in existing and field.name in (defaults or {}):
+                fill_column(client, table_id, field, defaults[field.name])
+
+    if table.clustering_fields != clustering_columns:
+        table.clustering_fields = clustering_columns
+        client.update_table(table, ["clustering_fields"])
+        logging.info(f"Clustered table {table_id} on {clustering_columns}.")
+    _verified_tables[table_id] = fingerprint
+
+
+def fill_column(
+    client: bigquery.Client, table_id: str, field: bigquery.SchemaField, value
+):
+    """One-off fill of a newly added column on the existing rows"""
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[
+            bigquery.ScalarQueryParameter(
+                "value", parameter_types.get(field.field_type, field.field_type), value
+            )
+        ]
+    )
+    fill_job = client.query(
+        f"UPDATE `{table_id}` SET {field.name} = @value WHERE {field.name} IS NULL",
+        job_config=job_config,
+    )
+    fill_job.result()
+    record_query_job("fill_column", fill_job)
+    logging.info(f"Filled new column {field.name} of {table_id} with {value!r}.")
+
+
+def build_rows(account: str, date: date, metrics: Metrics) -> list:
+    """Table rows for one account and day"""
+    rates = calculate_rates(metrics)
+    return [
+        {
+            "date": date,
+            "title": title,
+            "open_rate": rates["open_rate"],
+            "click_rate": rates["click_rate"],
+            "unsubscribed_rate": rates["unsubscribed_rate"],
+            "bounce_rate": rates["bounce_rate"],
+            "delivery_rate": rates["delivery_rate"],
+            "conversion_rate": conversion_rate,
+            "revenue_per_email": rates["revenue_per_email"],
+            "product_purchase_rate": rates["product_purchase_rate"],
+            "average_order_value": rates["average_order_value"],
+            "new_subscribers": metrics.new_subscriber_count,
+            "subscriber_counts": metrics.subscriber_count,
+            "account": account,
+        }
+        for title, conversion_rate in [
+            ("Active on Site", rates["conversion_active_on_site_rate"]),
+            ("Viewed Product", rates["conversion_viewed_product_rate"]),
+        ]
+    ]
+
+
+def merge_query(table_id: str, source: str, schema: list) -> str:
+    """MERGE of `source` rows into `table_id`, deduplicated on key_columns
+
+    The target is restricted to the @partitions dates so only their
+    partitions are scanned. A NULL value keeps the stored one, so a
+    backfilled row (which has no unsubscribed_rate) never erases what the
+    daily load wrote for that day.
+    """
+    columns = [field.name for field in schema]
+    value_columns = [column for column in columns if column not in key_columns]
+    updates = ", ".join(
+        f"T.{column} = COALESCE(S.{column}, T.{column})" for column in value_columns
+    )
+    return f"""
+    MERGE `{table_id}` T
+    USING (
+        SELECT * FROM {source}
+        WHERE TRUE
+        QUALIFY ROW_NUMBER() OVER (PARTITION BY {", ".join(key_columns)}) = 1
+    ) S
+    ON {" AND ".join(f"T.{column} = S.{column}" for column in key_columns)}
+    AND T.{partition_column} IN UNNEST(@partitions)
+    WHEN MATCHED THEN
+        UPDATE SET {updates}
+    WHEN NOT MATCHED THEN
+        INSERT ({", ".join(columns)})
+        VALUES ({", ".join(f"S.{column}" for column in columns)})
+    """
+
+
+def partitions_parameter(rows: list) -> bigquery.ArrayQueryParameter:
+    return bigquery.ArrayQueryParameter(
+        "partitions", "DATE", sorted({row[partition_column] for row in rows})
+    )
+
+
+def upsert_rows(
+    client: bigquery.Client, table_id: str, rows: list, schema: list
+) -> bigquery.QueryJob:
+    """Atomically upsert `rows` into `table_id` with a single parameterized MERGE
+
+    Rows are sent inline as a query parameter and only rows with matching
+    keys are touched, so re-running a day is idempotent and the cost stays
+    proportional to the rows written.
+    """
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[
+            rows_parameter("rows", rows, schema),
+            partitions_parameter(rows),
+        ]
+    )
+    try:
+        merge_job = client.query(
+            merge_query(table_id, "UNNEST(@rows)", schema), job_config=job_config
+        )
+        merge_job.result()
+        record_query_job("upsert", merge_job)
+    except NotFound:
+        # The table went away behind our back; verify it again next time
+        _verified_tables.pop(table_id, None)
+        raise
+    return merge_job
+
+
+def to_json_value(value):
+    value = to_parameter_value(value)
+    return value.isoformat() if isinstance(value, date) else value
+
+
+def bulk_upsert_rows(
+    client: bigquery.Client, table_id: str, rows: list, schema: list
+) -> bigquery.QueryJob:
+    """Upsert any number of `rows` through one load job and one MERGE
+
+    The rows are loaded into a short-lived staging table next to `table_id`,
+    which is merged like upsert_rows and then dropped.
+    """
+    staging_id = f"{table_id}_staging_{uuid.uuid4().hex[:12]}"
+    staging = bigquery.Table(staging_id, schema=schema)
+    staging.expires = datetime.now(timezone.utc) + timedelta(days=1)
+    client.create_table(staging)
+    try:
+        client.load_table_from_json(
+            [
+                {field.name: to_json_value(row[field.name]) for field in schema}
+                for row in rows
+            ],
+            staging_id,
+            job_config=bigquery.LoadJobConfig(schema=schema),
+        ).result()
+        merge_job = client.query(
+            merge_query(table_id, f"`{staging_id}`", schema),
+            job_config=bigquery.QueryJobConfig(
+                query_parameters=[partitions_parameter(rows)]
+            ),
+        )
+        merge_job.result()
+        record_query_job("bulk_upsert", merge_job)
+    except NotFound:
+        _verified_tables.pop(table_id, None)
+        raise
+    finally:
+        client.delete_table(staging_id, not_found_ok=True)
+    return merge_job